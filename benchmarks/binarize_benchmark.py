@@ -0,0 +1,101 @@
+"""
+Compares the grayscale preprocessing (load as BGR, convert to gray, scale,
+blur and invert) with the palette-aware binarization on synthetic
+palette-indexed subtitle PNGs of outlined text, like the ones BDSup2Sub
+writes.
+
+Both modes convert the same BDSup2Sub style XML file through the
+SubFileProcessor with its default settings, coalescing included, so the
+times are those of a real run, from the PNG files to the SRT file. The
+number of images binarized by their palette entries shows that the palette
+mode did not fall back to gray levels. The character error rate of each
+mode is reported from the written SRT file.
+
+Usage: python benchmarks/binarize_benchmark.py [--events N] [--engine NAME] [--jobs N]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from tempfile import TemporaryDirectory
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'src'))
+
+import fixtures  # noqa: E402
+from run_benchmarks import character_error_rate  # noqa: E402
+from job_queue import QueueItem  # noqa: E402
+from exceptions import MissingDependencyError  # noqa: E402
+import preprocess  # noqa: E402
+import sub  # noqa: E402
+
+
+def read_srt_texts(filename):
+    """ The subtitle texts of an SRT file, in order """
+    with open(filename) as srt_file:
+        blocks = srt_file.read().strip().split('\n\n')
+    return ['\n'.join(block.split('\n')[2:]) for block in blocks if block]
+
+
+def run(mode, xml_filename, texts, args, work_dir):
+    """
+    Converts the XML file with a preprocessing mode.
+
+    :return: A tuple of the conversion seconds and the CER
+    """
+    output_path = os.path.join(work_dir, mode)
+    os.makedirs(output_path, exist_ok=True)
+    processor = sub.SubFileProcessor(
+        logger=logging.getLogger('benchmark'), working_dir=work_dir, progress=False, overwrite=True, jobs=args.jobs,
+        engine=args.engine, cache_dir=None, resume=False, preprocess=mode
+    )
+    # count the images binarized by their palette rather than by gray levels,
+    # with a single job every image is prepared in this process
+    palette_images = [0]
+    prepare_palette_image = preprocess.prepare_palette_image
+
+    def counting_prepare_palette_image(indexes, levels=preprocess.GRAY_LEVELS, *args, **kwargs):
+        palette_images[0] += levels is not preprocess.GRAY_LEVELS
+        return prepare_palette_image(indexes, levels, *args, **kwargs)
+
+    preprocess.prepare_palette_image = counting_prepare_palette_image
+    try:
+        start = time.perf_counter()
+        out_file = processor.convert(QueueItem(xml_filename, output_path))
+        elapsed = time.perf_counter() - start
+    finally:
+        preprocess.prepare_palette_image = prepare_palette_image
+        processor.close()
+    cer = character_error_rate(texts, read_srt_texts(out_file))
+
+    print(
+        f"{mode:<8} convert: {elapsed:>6.2f} s ({elapsed * 1000 / len(texts):.1f} ms/image)  CER: {cer:.2%}"
+        + (f"  binarized by palette: {palette_images[0]}" if args.jobs == 1 else "")
+    )
+    return elapsed, cer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the grayscale and the palette-aware preprocessing.")
+    parser.add_argument('--events', type=int, default=100, help="The number of synthetic events. Default: 100")
+    parser.add_argument('--engine', default='auto', help="The OCR engine. Default: 'auto'")
+    parser.add_argument('--jobs', type=int, default=1, help="The number of OCR worker processes. Default: 1")
+    args = parser.parse_args()
+
+    texts = fixtures.subtitle_texts(args.events)
+    with TemporaryDirectory(prefix='sup2srt-binarize-') as work_dir:
+        xml_filename = fixtures.write_xml(os.path.join(work_dir, 'xml'), texts, indexed=True)
+        print(f"{len(texts)} palette-indexed images of outlined text")
+        try:
+            gray = run('gray', xml_filename, texts, args, work_dir)
+            palette = run('palette', xml_filename, texts, args, work_dir)
+        except MissingDependencyError as e:
+            print(f"Skipped, no OCR engine: {e}")
+            sys.exit(1)
+
+    print(f"palette mode: {gray[0] / max(palette[0], 1e-9):.1f}x faster, CER {gray[1]:.2%} -> {palette[1]:.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Generates synthetic subtitle fixtures with known text.
+
+Every fixture is rendered locally with PIL, so the benchmarks run without
+network access or sample discs:
+- BDSup2Sub style XML with one PNG per event, optionally palette-indexed
+  with an outline like the PNGs BDSup2Sub writes
+- SUP (PGS) streams, written by a minimal PGS encoder
+- MKV files, muxed from the SUP stream with mkvmerge when it is installed
+"""
+import os
+import shutil
+import struct
+import subprocess
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+FRAME_RATE = 25
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog where are you going tonight "
+    "we have to leave before morning light I never said that about him "
+    "listen to me carefully this is important what did you see"
+).split()
+
+
+def subtitle_texts(count, seed=0):
+    """
+    Builds reproducible subtitle texts of one or two lines.
+
+    :param count: The number of subtitles
+    :param seed: The random seed
+    :return: A list of subtitle texts
+    """
+    rng = np.random.default_rng(seed)
+    texts = []
+    for index in range(count):
+        lines = []
+        for _ in range(1 + index % 2):
+            words = rng.choice(WORDS, size=rng.integers(3, 7))
+            lines.append(' '.join(words).capitalize())
+        texts.append('\n'.join(lines))
+    return texts
+
+
+def render_text(text, width=1920, height=200, font_size=44):
+    """
+    Renders subtitle text as white text on a transparent canvas.
+
+    :return: An RGBA PIL image
+    """
+    image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=font_size)
+    box = draw.multiline_textbbox((0, 0), text, font=font, align='center')
+    x = (width - (box[2] - box[0])) // 2
+    y = height - (box[3] - box[1]) - font_size // 2
+    draw.multiline_text((x, y), text, fill=(255, 255, 255, 255), font=font, align='center')
+    return image
+
+
+def render_outlined(text, width=1920, height=200, font_size=44, outline=3):
+    """
+    Renders subtitle text with an outline on a transparent canvas, as a
+    palette-indexed image like the PNGs BDSup2Sub writes: entry 0 is the
+    transparent background, 1 the gray outline and 2 the white fill.
+
+    :return: A 'P' mode PIL image
+    """
+    image = Image.new('P', (width, height), 0)
+    image.putpalette([0, 0, 0, 64, 64, 64, 235, 235, 235])
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=font_size)
+    box = draw.multiline_textbbox((0, 0), text, font=font, align='center', stroke_width=outline)
+    x = (width - (box[2] - box[0])) // 2
+    y = height - (box[3] - box[1]) - font_size // 2
+    draw.multiline_text((x, y), text, fill=2, font=font, align='center', stroke_width=outline, stroke_fill=1)
+    image.info['transparency'] = bytes([0, 255, 255])
+    return image
+
+
+def frames_to_timecode(frames, frame_rate=FRAME_RATE):
+    seconds, frame = divmod(frames, frame_rate)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02}:{frame:02}"
+
+
+def event_times(count, duration=2, pause=1):
+    """ The (start, end) times of the events, in seconds """
+    return [(index * (duration + pause), index * (duration + pause) + duration) for index in range(count)]
+
+
+def write_xml(directory, texts, name='subtitles', indexed=False):
+    """
+    Writes a BDSup2Sub style XML file with a PNG for each subtitle.
+
+    :param indexed: Write palette-indexed PNGs of outlined text instead of RGBA PNGs
+    :return: The XML filename
+    """
+    os.makedirs(directory, exist_ok=True)
+    events = []
+    for index, ((start, end), text) in enumerate(zip(event_times(len(texts)), texts)):
+        image = render_outlined(text) if indexed else render_text(text)
+        filename = f"{name}_{index:04}.png"
+        image.save(os.path.join(directory, filename), **({'transparency': image.info['transparency']} if indexed else {}))
+        events.append(
+            f'<Event InTC="{frames_to_timecode(start * FRAME_RATE)}" OutTC="{frames_to_timecode(end * FRAME_RATE)}" Forced="False">'
+            f'<Graphic Width="{image.width}" Height="{image.height}" X="0" Y="880">{filename}</Graphic></Event>'
+        )
+    xml_filename = os.path.join(directory, f"{name}.xml")
+    with open(xml_filename, 'w') as xml_file:
+        xml_file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<BDN Version="0.93"><Description>'
+            f'<Name Title="{name}" Content=""/><Language Code="en"/>'
+            f'<Format VideoFormat="1080p" FrameRate="{FRAME_RATE}" DropFrame="False"/>'
+            f'<Events Type="Graphic" NumberofEvents="{len(events)}"/></Description>'
+            f'<Events>{"".join(events)}</Events></BDN>\n'
+        )
+    return xml_filename
+
+
+def encode_rle(bitmap):
+    """ Run-length encodes a palette index bitmap in the PGS object format """
+    data = bytearray()
+    for row in bitmap:
+        # split the row into runs of the same color
+        changes = np.flatnonzero(np.diff(row)) + 1
+        starts = np.concatenate(([0], changes))
+        ends = np.concatenate((changes, [len(row)]))
+        for start, end in zip(starts, ends):
+            color = int(row[start])
+            length = int(end - start)
+            while length:
+                run = min(length, 16383)
+                length -= run
+                if color and run < 3:
+                    data += bytes([color]) * run
+                elif color == 0:
+                    data += bytes([0, run]) if run < 64 else bytes([0, 0x40 | (run >> 8), run & 0xFF])
+                else:
+                    data += bytes([0, 0x80 | run, color]) if run < 64 else bytes([0, 0xC0 | (run >> 8), run & 0xFF, color])
+        data += b'\x00\x00'
+    return bytes(data)
+
+
+def pgs_segment(pts, segment_type, payload):
+    return b'PG' + struct.pack('>IIBH', pts, 0, segment_type, len(payload)) + payload
+
+
+def pgs_display_set(pts, number, bitmap=None, x=0, y=880, width=1920, height=1080):
+    """
+    Encodes a PGS display set showing a bitmap, or clearing the screen.
+
+    :param bitmap: A palette index bitmap where 1 is the text color, or None to clear
+    :return: The encoded segments
+    """
+    if bitmap is None:
+        composition = struct.pack('>HHBHBBBB', width, height, 0x10, number, 0x00, 0, 0, 0)
+        return pgs_segment(pts, 0x16, composition) + pgs_segment(pts, 0x80, b'')
+
+    rows, columns = bitmap.shape
+    composition = struct.pack('>HHBHBBBB', width, height, 0x10, number, 0x80, 0, 0, 1)
+    composition += struct.pack('>HBBHH', 0, 0, 0, x, y)
+    window = struct.pack('>BBHHHH', 1, 0, x, y, columns, rows)
+    palette = struct.pack('>BB', 0, 0) + struct.pack('>BBBBB', 1, 235, 128, 128, 255)
+    data = encode_rle(bitmap)
+    obj = struct.pack('>HBB', 0, 0, 0xC0) + (len(data) + 4).to_bytes(3, 'big') + struct.pack('>HH', columns, rows) + data
+    return (pgs_segment(pts, 0x16, composition) + pgs_segment(pts, 0x17, window) +
+            pgs_segment(pts, 0x14, palette) + pgs_segment(pts, 0x15, obj) + pgs_segment(pts, 0x80, b''))
+
+
+def write_sup(filename, texts):
+    """
+    Writes a SUP (PGS) stream with a display set for each subtitle and
+    one clearing it.
+
+    :return: The SUP filename
+    """
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'wb') as sup_file:
+        for index, ((start, end), text) in enumerate(zip(event_times(len(texts)), texts)):
+            alpha = np.array(render_text(text))[:, :, 3]
+            bitmap = (alpha > 127).astype(np.uint8)
+            sup_file.write(pgs_display_set(start * 90000, 2 * index, bitmap))
+            sup_file.write(pgs_display_set(end * 90000, 2 * index + 1))
+    return filename
+
+
+def write_mkv(filename, sup_filename, language='eng'):
+    """
+    Muxes a SUP stream into an MKV file with mkvmerge.
+
+    :return: The MKV filename, or None when mkvmerge is not installed
+    """
+    mkvmerge = shutil.which('mkvmerge')
+    if not mkvmerge:
+        return None
+    result = subprocess.run(
+        [mkvmerge, '--quiet', '-o', filename, '--language', f'0:{language}', sup_filename],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    # mkvmerge exits with 1 for warnings
+    if result.returncode > 1:
+        raise RuntimeError(f"mkvmerge failed: {result.stdout.strip()}")
+    return filename
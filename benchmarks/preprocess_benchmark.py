@@ -0,0 +1,95 @@
+"""
+Compares the fixed 2x preprocessing with the crop and adaptive-scale
+preprocessing on synthetic subtitle graphics.
+
+The graphics are drawn on wide, mostly empty canvases like the ones
+found on UHD discs, mixed with blank clear-screen frames. The OCR time
+is measured with the installed engine when tesseract is available.
+
+Usage: python benchmarks/preprocess_benchmark.py [--events N] [--no-ocr]
+"""
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from preprocess import prepare_image  # noqa: E402
+
+
+def fixed_preprocess(image):
+    # the preprocessing before the adaptive pipeline
+    image = cv2.resize(image, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    return cv2.bitwise_not(image)
+
+
+def make_events(count, width=3840, height=400, font_size=48, blank_every=4):
+    font = ImageFont.load_default(size=font_size)
+    events = []
+    for index in range(count):
+        canvas = Image.new('L', (width, height), 0)
+        if index % blank_every:
+            draw = ImageDraw.Draw(canvas)
+            draw.text((width // 3, height - 3 * font_size), f"Subtitle line number {index}", fill=255, font=font)
+            draw.text((width // 3, height - 2 * font_size + 8), "with a second line of text", fill=255, font=font)
+        events.append(np.array(canvas))
+    return events
+
+
+def run(name, preprocess, events, engine):
+    pixels = 0
+    scanned = 0
+    start = time.perf_counter()
+    prepared = []
+    for image in events:
+        image = preprocess(image)
+        if image is not None:
+            pixels += image.size
+            prepared.append(image)
+    preprocess_time = time.perf_counter() - start
+
+    ocr_time = None
+    if engine:
+        start = time.perf_counter()
+        for image in prepared:
+            engine.recognize(image)
+            scanned += 1
+        ocr_time = time.perf_counter() - start
+
+    print(
+        f"{name:<10} images: {len(prepared):>4}  pixels: {pixels / 1e6:>8.1f} M  "
+        f"preprocess: {preprocess_time * 1000:>8.1f} ms  "
+        + (f"OCR: {ocr_time:>6.2f} s ({scanned} scans)" if ocr_time is not None else "OCR: skipped")
+    )
+    return pixels, preprocess_time, ocr_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the subtitle image preprocessing.")
+    parser.add_argument('--events', type=int, default=40, help="The number of synthetic events. Default: 40")
+    parser.add_argument('--no-ocr', action='store_true', help="Only measure the preprocessing.")
+    args = parser.parse_args()
+
+    engine = None
+    if not args.no_ocr:
+        try:
+            from ocr import create_engine
+            engine = create_engine('auto')
+        except Exception as e:
+            print(f"OCR timing skipped: {e}")
+
+    events = make_events(args.events)
+    print(f"{len(events)} events of {events[0].shape[1]}x{events[0].shape[0]} pixels")
+    before = run('fixed 2x', fixed_preprocess, events, engine)
+    after = run('adaptive', prepare_image, events, engine)
+
+    print(f"pixels: {before[0] / max(after[0], 1):.1f}x fewer, preprocess: {before[1] / max(after[1], 1e-9):.1f}x faster"
+          + (f", OCR: {before[2] / max(after[2], 1e-9):.1f}x faster" if engine else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+Times each conversion stage on synthetic fixtures and writes the results
+as JSON, so runs of different commits can be compared.
+
+The stages that need a tool which is not installed (mkvmerge, mkvextract,
+Java with BDSup2Sub, tesseract) are reported as skipped. Nothing is
+downloaded, so the suite runs without network access.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--events N] [--output results.json] [--compare baseline.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import resource
+import subprocess
+from tempfile import TemporaryDirectory
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'src'))
+
+import fixtures  # noqa: E402
+from job_queue import QueueItem  # noqa: E402
+from pgs import read_sup_events, PgsDecoder, split_block_segments  # noqa: E402
+from mkv import supTrackExporter, mkvDemuxer  # noqa: E402
+import sub  # noqa: E402
+
+
+def peak_rss_mb():
+    """ The peak resident set size of this process and its children, in MB """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return max(own, children) / scale
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def character_error_rate(references, hypotheses):
+    """
+    The character error rate of the recognized texts: the edit distance
+    to the known texts over the number of known characters. Whitespace
+    runs are compared as a single space.
+    """
+    errors = 0
+    characters = 0
+    for reference, hypothesis in zip(references, hypotheses):
+        reference = ' '.join(reference.split())
+        hypothesis = ' '.join((hypothesis or '').split())
+        errors += edit_distance(reference, hypothesis)
+        characters += len(reference)
+    return errors / max(characters, 1)
+
+
+class Benchmark:
+    def __init__(self, events):
+        self.events = events
+        self.stages = {}
+
+    def run(self, name, func, events=None):
+        """
+        Times a stage.
+
+        :param name: The stage name
+        :param func: A function running the stage, returning its result
+        :param events: The number of events the stage handles, for the events/sec rate
+        :return: The stage's result, or None when it failed or was skipped
+        """
+        events = self.events if events is None else events
+        start = time.perf_counter()
+        try:
+            result = func()
+        except Skipped as e:
+            self.stages[name] = {'skipped': str(e)}
+            print(f"{name:<18} skipped: {e}")
+            return None
+        except Exception as e:
+            self.stages[name] = {'error': f"{type(e).__name__}: {e}"}
+            print(f"{name:<18} failed: {type(e).__name__}: {e}")
+            return None
+        elapsed = time.perf_counter() - start
+        self.stages[name] = {
+            'seconds': round(elapsed, 6),
+            'events': events,
+            'events_per_sec': round(events / elapsed, 2) if elapsed else None,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        print(f"{name:<18} {elapsed * 1000:>10.1f} ms  {self.stages[name]['events_per_sec'] or 0:>10.1f} events/s  "
+              f"peak RSS {self.stages[name]['peak_rss_mb']:.1f} MB")
+        return result
+
+
+class Skipped(Exception):
+    pass
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(args, work_dir):
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.WARNING)
+    texts = fixtures.subtitle_texts(args.events)
+    bench = Benchmark(len(texts))
+
+    # Fixtures
+    start = time.perf_counter()
+    xml_filename = fixtures.write_xml(os.path.join(work_dir, 'xml'), texts)
+    sup_filename = fixtures.write_sup(os.path.join(work_dir, 'subtitles.sup'), texts)
+    mkv_filename = fixtures.write_mkv(os.path.join(work_dir, 'movie.mkv'), sup_filename)
+    print(f"Generated {len(texts)} events in {time.perf_counter() - start:.1f}s"
+          + ("" if mkv_filename else " (no MKV: mkvmerge is not installed)"))
+
+    # MKV probe and extraction
+    def mkv_probe():
+        if not mkv_filename:
+            raise Skipped("mkvmerge is not installed")
+        exporter = supTrackExporter('all', work_dir, ['eng'], logger, demuxer='native')
+        return exporter.select_tracks(QueueItem(mkv_filename, work_dir))
+    tracks = bench.run('mkv_probe', mkv_probe, events=0)
+
+    def mkv_extract():
+        if not tracks or not shutil.which('mkvextract'):
+            raise Skipped("mkvextract is not installed")
+        exporter = supTrackExporter('all', work_dir, ['eng'], logger, demuxer='mkvextract')
+        return exporter.export(QueueItem(mkv_filename, os.path.join(work_dir, 'extracted')))
+    os.makedirs(os.path.join(work_dir, 'extracted'), exist_ok=True)
+    bench.run('mkv_extract', mkv_extract)
+
+    def mkv_demux():
+        if not tracks:
+            raise Skipped("no MKV fixture")
+        count = 0
+        track_number = tracks[0].track_number
+        decoder = PgsDecoder()
+        with mkvDemuxer(mkv_filename) as demuxer:
+            for _, pts, payload in demuxer.packets([track_number]):
+                for segment in split_block_segments(pts, payload):
+                    count += decoder.feed(*segment) is not None
+        return count + (decoder.flush() is not None)
+    bench.run('mkv_demux_native', mkv_demux)
+
+    # SUP decoding
+    bench.run('sup_decode_native', lambda: sum(1 for _ in read_sup_events(sup_filename)))
+
+    def sup_to_xml():
+        jar = args.bdsup2sub_jar or os.environ.get('BDSUP2SUB')
+        if not jar or not os.path.exists(jar) or not shutil.which('java'):
+            raise Skipped("BDSup2Sub or Java is not installed")
+        from sup import supFileConverter
+        converter = supFileConverter(bdsup2sub_jar=jar, working_dir=work_dir, logger=logger)
+        return converter.process(QueueItem(sup_filename, work_dir))
+    bench.run('sup_to_xml', sup_to_xml)
+
+    # XML parsing and preprocessing
+    processor = sub.SubFileProcessor(
+        logger=logger, working_dir=work_dir, progress=False, jobs=1, engine=args.engine,
+        cache_dir=None, coalesce_threshold=None, batch_size=args.ocr_batch
+    )
+    try:
+        job_item = QueueItem(xml_filename, work_dir)
+        events = bench.run('xml_parse', lambda: list(processor.read_xml(job_item)[1]))
+        images = [sub.load_image(image) for _, _, image in events]
+        prepared = bench.run('preprocess', lambda: [sub.preprocess_image(image) for image in images])
+
+        # OCR
+        def ocr():
+            if not shutil.which('tesseract') and processor.engine == 'pytesseract':
+                raise Skipped("tesseract is not installed")
+            return [text for text, _ in processor.ocr_events(images)]
+        recognized = bench.run('ocr', ocr)
+        if recognized:
+            bench.stages['ocr']['ms_per_event'] = round(bench.stages['ocr']['seconds'] * 1000 / len(texts), 2)
+            bench.stages['ocr']['cer'] = round(character_error_rate(texts, recognized), 4)
+            print(f"{'':<18} {bench.stages['ocr']['ms_per_event']:.1f} ms/event, CER {bench.stages['ocr']['cer']:.2%}")
+
+        def srt_write():
+            with open(os.path.join(work_dir, 'benchmark.srt'), 'w') as srt_file:
+                for index, ((start_time, end_time, _), text) in enumerate(zip(events, recognized or texts), start=1):
+                    srt_file.write(f"{index}\n{start_time} --> {end_time}\n{text}\n\n")
+        bench.run('srt_write', srt_write)
+    finally:
+        processor.close()
+
+    return {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'engine': processor.engine,
+        'ocr_batch': args.ocr_batch,
+        'events': len(texts),
+        'prepared_pixels': sum(image.size for image in prepared or [] if image is not None),
+        'stages': bench.stages,
+    }
+
+
+def compare(results, baseline):
+    """ Prints the change of each stage's time against a baseline run """
+    print(f"\nCompared to {baseline.get('commit') or 'the baseline'}:")
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name, {})
+        if 'seconds' not in stage or 'seconds' not in before:
+            continue
+        change = (stage['seconds'] - before['seconds']) / before['seconds'] if before['seconds'] else 0
+        print(f"{name:<18} {before['seconds'] * 1000:>10.1f} ms -> {stage['seconds'] * 1000:>10.1f} ms  ({change:+.0%})")
+    if 'cer' in results['stages'].get('ocr', {}) and 'cer' in baseline.get('stages', {}).get('ocr', {}):
+        print(f"{'CER':<18} {baseline['stages']['ocr']['cer']:.2%} -> {results['stages']['ocr']['cer']:.2%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the subtitle conversion stages on synthetic fixtures.")
+    parser.add_argument('--events', type=int, default=100, help="The number of synthetic subtitle events. Default: 100")
+    parser.add_argument('--engine', default='auto', help="The OCR engine. Default: 'auto'")
+    parser.add_argument('--ocr-batch', type=int, default=1, help="The number of images per OCR page. Default: 1")
+    parser.add_argument('--bdsup2sub-jar', default=None, help="The BDSup2Sub.jar for the SUP to XML stage")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--compare', default=None, help="A results JSON file of an earlier run to compare with")
+    parser.add_argument('--keep', default=None, help="Generate the fixtures in this directory and keep them")
+    args = parser.parse_args()
+
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        results = run_suite(args, args.keep)
+    else:
+        with TemporaryDirectory(prefix='sup2srt-benchmark-') as work_dir:
+            results = run_suite(args, work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"Results written to '{args.output}'")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Times the cold start of sup2srt: the runs that end before any conversion,
+--help, --version and an invalid input, which should only pay for the
+interpreter and argument parsing.
+
+When run from the sources, it also lists the heavy modules (OpenCV, NumPy,
+Pillow, pytesseract, iso639) each run imported, which should be none of
+them. Exits with status 1 when the median --help time exceeds the limit.
+
+Usage:
+    python benchmarks/startup_benchmark.py [--runs N] [--max-seconds S] [--command dist/sup2srt/sup2srt]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(BENCHMARK_DIR, '..', 'src', '__main__.py')
+
+# The modules the runs that end before the conversion stages should not import
+HEAVY_MODULES = ['cv2', 'numpy', 'PIL', 'pytesseract', 'tesserocr', 'iso639']
+
+CASES = {
+    'help': ['--help'],
+    'version': ['--version'],
+    'invalid input': ['--in', os.path.join(BENCHMARK_DIR, 'missing.mkv')],
+}
+
+
+def time_run(command, runs):
+    """
+    Times a command.
+
+    :param command: The command line
+    :param runs: The number of runs
+    :return: A list of the wall clock seconds of each run
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def imported_modules(arguments):
+    """ The heavy modules a run of the sources imports, from python's -X importtime report """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', MAIN, *arguments], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    imported = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            imported.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cold start of sup2srt.")
+    parser.add_argument('--runs', type=int, default=10, help="The number of runs of each case. Default: 10")
+    parser.add_argument('--max-seconds', type=float, default=1.0, help="The limit of the median --help time. Default: 1.0")
+    parser.add_argument('--command', default=None,
+                        help="The sup2srt executable to time, e.g. a onedir build. Default: the sources")
+    args = parser.parse_args()
+
+    command = [args.command] if args.command else [sys.executable, MAIN]
+    baseline = statistics.median(time_run([sys.executable, '-c', 'pass'], args.runs))
+    print(f"{'interpreter':<14} {baseline * 1000:>8.0f} ms")
+
+    medians = {}
+    for name, arguments in CASES.items():
+        timings = time_run(command + arguments, args.runs)
+        medians[name] = statistics.median(timings)
+        heavy = [] if args.command else imported_modules(arguments)
+        print(f"{name:<14} {medians[name] * 1000:>8.0f} ms  (min {min(timings) * 1000:.0f} ms)"
+              + (f"  imports: {', '.join(heavy)}" if heavy else ""))
+
+    if medians['help'] > args.max_seconds:
+        print(f"--help took {medians['help']:.2f}s, over the limit of {args.max_seconds:.2f}s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,153 @@
 import sys
 import os
+import time
+import signal
 import logging
-from pprint import pprint
+import threading
 from config import Config
-from job_queue import QueueItem
+from job_queue import QueueItem, JobStore, jobPipeline
+from functions import find_files
+from tracing import tracer
+from command import RunCommand
+from manifest import Manifest, OUTPUT_OPTIONS
 from mkv import supTrackExporter
 from sup import supFileConverter
 from sub import SubFileProcessor
+from watch import FolderWatcher
+from exceptions import MissingDependencyError
+
+
+def mirrored_output_path(config, mkv_file):
+    """ The output directory of an MKV file found under the input directory, mirroring its tree in the output path """
+    output_path = os.path.dirname(mkv_file)
+    if getattr(config.args, 'out'):
+        output_path = os.path.normpath(os.path.join(config.output_path, os.path.relpath(output_path, config.input_file)))
+        os.makedirs(output_path, exist_ok=True)
+    return output_path
+
+
+def finished_callback(config, pipeline, manifest, failures):
+    """
+    Builds the on_finished callback of the long running modes, which records
+    each converted source file in the manifest as soon as it is finished.
+
+    :param failures: A dict the last failure of each source file whose last run failed is kept in
+    """
+    def finished(source, outputs, failed):
+        # the results and failures of a finished file are not needed again, a daemon would only accumulate them
+        source_failures = pipeline.forget(source)
+        if failed:
+            failures[source] = source_failures[-1]
+            return
+        failures.pop(source, None)
+        manifest.record(source, outputs)
+        manifest.save()
+        for output in outputs if config.uid else []:
+            os.chown(output, uid=int(config.uid), gid=int(config.gid or config.uid))
+        landed = time.time() - os.path.getmtime(source) if os.path.exists(source) else 0
+        config.logger.info(f"Converted '{source}' into {len(outputs)} SRT file(s), {landed:.1f}s after it was written")
+    return finished
+
+
+def claim_limit(pipeline):
+    """ The number of job store jobs a process keeps in flight: enough to keep its widest stage busy """
+    return max(stage['workers'] for stage in pipeline.stages)
+
+
+def watch_folder(config, pipeline, manifest, store=None):
+    """
+    Runs the pipeline until the watch is stopped, converting each MKV file
+    that lands in the watched directory once it is fully written. The stages,
+    their OCR workers and loaded models stay up between files. With a job
+    store the files are submitted to it, and converted as they are claimed
+    from it.
+
+    :return: A list of (stage_name, job_item, exception) tuples of the failed jobs
+    """
+    watcher = FolderWatcher(
+        config.input_file, 'mkv', config.logger, settle=config.watch_settle,
+        poll_interval=config.poll_interval or 5, polling=config.poll_interval is not None
+    )
+    # docker stop sends SIGTERM, finish the jobs in flight like on Ctrl-C
+    signal.signal(signal.SIGTERM, lambda *args: watcher.stop())
+
+    failures = {}
+    pipeline.on_finished = finished_callback(config, pipeline, manifest, failures)
+    threads = pipeline.start()
+    stop = threading.Event()
+    feeder = None
+    if store:
+        def feed():
+            pipeline.feed(store, stop, jobs=claim_limit(pipeline), wait=True)
+            # a worker fault stops the feed, and nothing would convert the files the watch submits
+            watcher.stop()
+
+        feeder = threading.Thread(target=feed, name='job-store', daemon=True)
+        feeder.start()
+    try:
+        for mkv_file in watcher.watch():
+            if not config.force and manifest.is_current(mkv_file):
+                config.logger.info(f"Skipping unchanged input: '{mkv_file}'")
+                continue
+            config.logger.info(f"New input: '{mkv_file}'")
+            job_item = QueueItem(input_file=mkv_file, output_path=mirrored_output_path(config, mkv_file))
+            if store:
+                store.submit(job_item, 'mkv', config.priority)
+            else:
+                pipeline.submit(job_item)
+    except KeyboardInterrupt:
+        pass
+    config.logger.info("Stopping the watch, finishing the files in progress.")
+    stop.set()
+    while feeder and feeder.is_alive():
+        feeder.join(timeout=0.5)
+    pipeline.close()
+    pipeline.join(threads)
+    return list(failures.values())
+
+
+def run_job_store(config, pipeline, manifest, store, job_items, input_stage):
+    """
+    Submits the inputs to the job store and converts its pending jobs,
+    including the ones other processes submitted, until none are left.
+
+    :return: A list of (stage_name, job_item, exception) tuples of the failed jobs
+    """
+    for job_item in job_items:
+        config.logger.info(f"Submitted job {store.submit(job_item, input_stage, config.priority)}: '{job_item}'")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    failures = {}
+    pipeline.on_finished = finished_callback(config, pipeline, manifest, failures)
+    threads = pipeline.start()
+    try:
+        pipeline.feed(store, stop, jobs=claim_limit(pipeline))
+    finally:
+        pipeline.close()
+        pipeline.join(threads)
+    return list(failures.values())
+
+
+def print_jobs(store):
+    """ Prints the jobs of a job store """
+    jobs = store.jobs()
+    print(f"{'ID':>6}  {'STATE':<8} {'STAGE':<5} {'PRIO':>4} {'TRIES':>5}  {'WORKER':<24} INPUT")
+    for job_id, input_file, stage, priority, state, attempts, worker, error in jobs:
+        print(f"{job_id:>6}  {state:<8} {stage:<5} {priority:>4} {attempts:>5}  {worker or '-':<24} {input_file}")
+        if error and state != 'done':
+            print(f"{'':>8}{error}")
+    counts = {state: sum(1 for job in jobs if job[4] == state) for state in JobStore.STATES}
+    print(', '.join(f"{state}: {count}" for state, count in counts.items()))
+
 
 # Main entry point
 if __name__=="__main__":
+    # the OCR workers of a frozen build are started by running the executable again
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+
     try:
         config = Config()
         logger = config.logger
@@ -21,47 +159,142 @@ if __name__=="__main__":
     # print(config.__dict__)
     # exit()
 
-    # load the first jou into the appropriate queue
-    config.logger.debug(f"Loading {config.input_type} queue with the start job.")
-    init_queue = getattr(config.queue, config.input_type)
-    init_queue.put(
+    if config.headless:
+        RunCommand.HEADLESS = True
+
+    # Trace before any stage is set up, so the OCR workers are started with tracing on
+    if config.profile:
+        tracer.enable()
+
+    store = JobStore(config.queue_db, retries=config.retries) if config.queue_db else None
+    if config.queue_status:
+        print_jobs(store)
+        sys.exit(0)
+
+    # Build the pipeline stages, starting with the stage of the input type.
+    # With the native decoder SUP files go straight to the OCR stage, and
+    # with the native demuxer so do the tracks of MKV files.
+    pipeline = jobPipeline(logger=logger)
+    stages = ['mkv', 'sup', 'sub']
+    if config.sup_decoder == 'native':
+        stages.remove('sup')
+    input_stage = 'sub' if config.input_type == 'sup' and 'sup' not in stages else config.input_type
+    # The jobs of a job store start at the stage of their own input type, so its pipeline has every stage
+    if not store:
+        stages = stages[stages.index(input_stage):]
+
+    if config.watch or config.worker:
+        # The watcher schedules the files as they land, and a worker takes them from the job store
+        job_items = []
+    elif config.batch:
+        # Schedule every MKV file under the input directory, mirroring
+        # the directory tree in the output path when one was given
+        job_items = [
+            QueueItem(input_file=mkv_file, output_path=mirrored_output_path(config, mkv_file))
+            for mkv_file in find_files(config.input_file, 'mkv')
+        ]
+        logger.info(f"Batch mode: found {len(job_items)} MKV file(s) in '{config.input_file}'")
+    else:
+        job_items = [
             QueueItem(
                 input_file=config.input_file,
                 output_path=config.output_path
             )
-        )
+        ]
+
+    if config.submit:
+        for job_item in job_items:
+            logger.info(f"Submitted job {store.submit(job_item, input_stage, config.priority)}: '{job_item}'")
+        sys.exit(0)
 
     # export tracks from MKV file(s) to SUP
-    if not config.queue.mkv.empty():
-        config.sup_filename = supTrackExporter(
-            queue=config.queue.mkv,
-            next_queue=config.queue.sup,
+    if 'mkv' in stages:
+        exporter = supTrackExporter(
             mode=config.mode,
             working_dir=config.working_dir.name,
             language=config.language,
-            logger = logger
+            logger = logger,
+            demuxer=config.demuxer
         )
+        pipeline.add_stage('mkv', exporter.process, queue=config.queue.mkv, workers=config.mkv_workers, resource='io')
 
     # Convert SUP file(s) to SUB
-    if not config.queue.sup.empty():
-        config.sub_filename = supFileConverter(
-            queue=config.queue.sup,
-            next_queue=config.queue.sub,
+    if 'sup' in stages:
+        converter = supFileConverter(
             bdsup2sub_jar=config.bdsup2sub_jar,
             working_dir=config.working_dir.name,
-            logger = logger
+            logger = logger,
+            cache_dir=None if config.no_cache else config.cache_dir,
+            limit=config.limit
             )
+        pipeline.add_stage('sup', converter.process, queue=config.queue.sup, workers=config.sup_workers, resource='cpu')
 
     # Convert SUB File(s) to SRT
-    if not config.queue.sub.empty():
-        config.outfile = SubFileProcessor(
-            queue=config.queue.sub,
+    try:
+        processor = SubFileProcessor(
             logger = logger,
             limit=config.limit,
-            progress=config.progress,
+            progress=config.progress and config.sub_workers == 1,
             overwrite=config.force,
             working_dir=config.working_dir.name,
+            jobs=config.jobs,
+            omp_threads=config.omp_threads,
+            engine=config.engine,
+            cache_dir=None if config.no_cache else config.cache_dir,
+            cache_size=config.cache_size,
+            coalesce_threshold=None if config.no_coalesce else config.coalesce_threshold,
+            batch_size=config.ocr_batch,
+            resume=not config.no_resume,
+            language=config.language,
+            preprocess=config.preprocess,
         )
+    except MissingDependencyError as e:
+        print(f"[FATAL ERROR]: {e}")
+        sys.exit(1)
+    pipeline.add_stage('sub', processor.process, queue=config.queue.sub, workers=config.sub_workers, resource='cpu')
+
+    # Limit the I/O and CPU heavy jobs across the stages
+    if config.io_jobs:
+        pipeline.limit('io', config.io_jobs)
+    if config.cpu_jobs:
+        pipeline.limit('cpu', config.cpu_jobs)
+
+    # Skip the inputs that were converted before from the same content, with the same tools and options
+    tools = {'sup2srt': config.APP['version'], 'ocr': processor.engine_version()}
+    if 'mkv' in stages:
+        tools['mkv'] = exporter.version()
+    if 'sup' in stages:
+        tools['sup'] = converter.version()
+    manifest = Manifest(config.output_path, {option: getattr(config, option) for option in OUTPUT_OPTIONS}, tools)
+    if not config.force:
+        unchanged = [job_item for job_item in job_items if manifest.is_current(job_item.source_file)]
+        for job_item in unchanged:
+            logger.info(f"Skipping unchanged input: '{job_item.source_file}'")
+        job_items = [job_item for job_item in job_items if job_item not in unchanged]
+
+    # load the start job(s) into the first stage and run all the stages
+    config.logger.debug(f"Loading {input_stage} queue with the start job.")
+    start = time.monotonic()
+    try:
+        if config.watch:
+            failures = watch_folder(config, pipeline, manifest, store)
+        elif store:
+            failures = run_job_store(config, pipeline, manifest, store, job_items, input_stage)
+        else:
+            failures = pipeline.run(job_items)
+    finally:
+        processor.close()
+        if store:
+            store.close()
+        for source, outputs in pipeline.succeeded().items():
+            manifest.record(source, outputs)
+        manifest.save()
+    if config.batch:
+        pipeline.log_summary([job_item.input_file for job_item in job_items], time.monotonic() - start)
+    if config.profile:
+        tracer.write_chrome_trace(config.profile)
+        tracer.log_summary(logger)
+        logger.info(f"Saved the trace to: {config.profile}")
 
     # If a uid and or gid was specified, change the ownership of the out files
     if config.uid:
@@ -69,5 +302,7 @@ if __name__=="__main__":
         for file in os.listdir(config.output_path):
             if file.lower().endswith('.sup') or file.lower().endswith('.srt'):
                 os.chown(os.path.join(config.output_path, file), uid=int(config.uid), gid=int(config.gid))
-    sys.exit(0)
+        for file in pipeline.results:
+            os.chown(file, uid=int(config.uid), gid=int(config.gid))
+    sys.exit(1 if failures or pipeline.worker_fault else 0)
 
@@ -0,0 +1,238 @@
+import io
+import os
+import logging
+import threading
+from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from functions import pts_to_srt_time
+from pgs import PTS_RATE, PgsDecoder, read_sup_segments, split_block_segments
+from mkv import mkvDemuxer
+from ocr import ocr_language
+from sub import SubFileProcessor
+
+
+class Cue:
+    """ A recognized subtitle, with its times in milliseconds """
+    __slots__ = ('index', 'start', 'end', 'text')
+
+    def __init__(self, index, start, end, text):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.text = text
+
+    @property
+    def start_time(self):
+        """ The start time in SRT format """
+        return pts_to_srt_time(self.start, clock_rate=1000)
+
+    @property
+    def end_time(self):
+        """ The end time in SRT format """
+        return pts_to_srt_time(self.end, clock_rate=1000)
+
+    def to_srt(self):
+        return f"{self.index}\n{self.start_time} --> {self.end_time}\n{self.text}\n\n"
+
+    def __repr__(self):
+        return f"Cue({self.index}, {self.start_time}, {self.end_time}, {self.text!r})"
+
+
+def cues_to_srt(cues):
+    """
+    Formats cues as the content of an SRT file.
+
+    :param cues: An iterable of Cue objects
+    :return: The SRT text
+    """
+    return ''.join(cue.to_srt() for cue in cues)
+
+
+class Converter:
+    """
+    Converts subtitles in memory, for embedding the converter in a long-lived
+    process instead of starting a process per file.
+
+    The OCR engines, and the worker processes with jobs > 1, are started once
+    and stay warm for every call until the converter is closed. Nothing is
+    written to disk except the optional OCR cache.
+
+    Example usage:
+        with Converter(jobs=4, language='eng') as converter:
+            cues = converter.convert_sup(open('movie.sup', 'rb'))
+            tracks = converter.convert_mkv('movie.mkv', tracks=['eng', 'ger'])
+    """
+    def __init__(self, engine='auto', language='eng', jobs=1, omp_threads=1, batch_size=1, cache_dir=None, cache_size=256,
+                 coalesce_threshold=2, preprocess='gray', logger=None):
+        """
+        :param engine: The OCR engine, one of ENGINES or 'auto'
+        :param language: The language of the subtitles whose language is not known, e.g. of SUP streams
+        :param jobs: The number of OCR worker processes
+        :param omp_threads: The number of OpenMP threads each tesseract instance may use
+        :param batch_size: The number of subtitle images OCR scanned per page
+        :param cache_dir: The OCR result cache directory, None disables the cache
+        :param cache_size: The OCR result cache size limit in MB
+        :param coalesce_threshold: The percent of differing text pixels up to which adjacent
+                                   events are merged, None disables merging
+        :param preprocess: The preprocessing mode, 'gray' or 'palette'
+        :param logger: The logger, by default the 'sup2srt' logger
+        """
+        self.logger = logger or logging.getLogger('sup2srt')
+        self.coalesce_threshold = coalesce_threshold
+        self.working_dir = TemporaryDirectory(prefix='sup2srt-')
+        self.processor = SubFileProcessor(
+            logger=self.logger, working_dir=self.working_dir.name, progress=False, jobs=jobs, omp_threads=omp_threads,
+            engine=engine, cache_dir=cache_dir, cache_size=cache_size, coalesce_threshold=coalesce_threshold,
+            batch_size=batch_size, resume=False, language=language, preprocess=preprocess
+        )
+
+    def close(self):
+        """ Stops the OCR workers and unloads the engines """
+        self.processor.close()
+        self.working_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def ocr_events(self, events, language=None):
+        """
+        OCR scans subtitle events.
+
+        :param events: An iterable of (start, end, image) tuples with the times in milliseconds,
+                       where the image is a grayscale NumPy array or an image filename
+        :param language: The ISO 639 code of the subtitle language, None for the converter's language
+        :return: A generator of Cue objects, without the blank events
+        """
+        if self.coalesce_threshold is not None:
+            events = self.processor.create_coalescer().coalesce(events)
+
+        # the times wait in order for the OCR results of their images
+        times = deque()
+
+        def images():
+            for start, end, image in events:
+                times.append((start, end))
+                yield image
+
+        index = 0
+        for text, _ in self.processor.ocr_events(images(), ocr_language(language)):
+            start, end = times.popleft()
+            if text is None:
+                continue
+            index += 1
+            yield Cue(index, start, end, text)
+
+    def convert_sup(self, source, language=None):
+        """
+        Converts a SUP (PGS) stream.
+
+        :param source: The SUP data as bytes, a binary stream or a filename
+        :param language: The ISO 639 code of the subtitle language, None for the converter's language
+        :return: A list of Cue objects
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as stream:
+                return self.convert_sup(stream, language)
+
+        events = (
+            (start_pts * 1000 // PTS_RATE, end_pts * 1000 // PTS_RATE, image)
+            for start_pts, end_pts, image in PgsDecoder().decode(read_sup_segments(source))
+        )
+        return list(self.ocr_events(events, language))
+
+    def convert_mkv(self, source, tracks=None):
+        """
+        Converts the PGS subtitle tracks of an MKV file in a single pass over
+        the file. Each track is OCR scanned in its own language while the
+        file is being demuxed, so only the events in flight are held in memory.
+
+        :param source: The MKV filename, or a seekable binary stream
+        :param tracks: The tracks to convert, as track numbers or ISO 639 language codes,
+                       None for every PGS track
+        :return: A dict of the lists of Cue objects by track number
+        """
+        with mkvDemuxer(source) as demuxer:
+            selected = {}
+            for track in demuxer.tracks():
+                properties = track['properties']
+                if properties['codec_id'] != 'S_HDMV/PGS':
+                    continue
+                if tracks is None or properties['number'] in tracks or any(
+                    isinstance(code, str) and ocr_language(code) == ocr_language(properties['language']) for code in tracks
+                ):
+                    selected[properties['number']] = properties['language']
+
+            # The tracks' blocks are interleaved, so the demuxer hands each track's events
+            # to the thread OCR scanning it through a bounded queue. A full queue blocks
+            # the demuxer until that track catches up, which bounds the memory.
+            queues = {track_number: Queue(maxsize=self.processor.TRACK_QUEUE_SIZE) for track_number in selected}
+
+            def scan_track(track_number):
+                ended = []
+
+                def track_events():
+                    for start_pts, end_pts, image in iter(queues[track_number].get, None):
+                        yield start_pts * 1000 // PTS_RATE, end_pts * 1000 // PTS_RATE, image
+                    ended.append(True)
+
+                try:
+                    return list(self.ocr_events(track_events(), selected[track_number]))
+                finally:
+                    # a track that failed must not block the demuxer
+                    if not ended:
+                        for _ in iter(queues[track_number].get, None):
+                            pass
+
+            decoders = {track_number: PgsDecoder() for track_number in selected}
+            with ThreadPoolExecutor(max_workers=max(1, len(selected)), thread_name_prefix='track') as executor:
+                futures = {track_number: executor.submit(scan_track, track_number) for track_number in selected}
+                try:
+                    for track_number, pts, payload in demuxer.packets(selected):
+                        for segment in split_block_segments(pts, payload):
+                            event = decoders[track_number].feed(*segment)
+                            if event:
+                                queues[track_number].put(event)
+                    for track_number, decoder in decoders.items():
+                        event = decoder.flush()
+                        if event:
+                            queues[track_number].put(event)
+                finally:
+                    for track_queue in queues.values():
+                        track_queue.put(None)
+                return {track_number: future.result() for track_number, future in futures.items()}
+
+
+# The converter shared by the module level functions, started on first use
+default_converter = None
+default_converter_lock = threading.Lock()
+
+
+def get_converter():
+    """ The shared converter, whose engines stay warm between calls """
+    global default_converter
+    with default_converter_lock:
+        if default_converter is None:
+            default_converter = Converter()
+        return default_converter
+
+
+def convert_sup(source, language=None):
+    """ Converts a SUP stream with the shared converter, see Converter.convert_sup() """
+    return get_converter().convert_sup(source, language)
+
+
+def convert_mkv(source, tracks=None):
+    """ Converts the PGS tracks of an MKV file with the shared converter, see Converter.convert_mkv() """
+    return get_converter().convert_mkv(source, tracks)
+
+
+def ocr_events(events, language=None):
+    """ OCR scans subtitle events with the shared converter, see Converter.ocr_events() """
+    return get_converter().ocr_events(events, language)
@@ -2,6 +2,8 @@ import os
 import argparse
 import tempfile
 import shutil
+from ocr import ENGINES
+from cache import default_cache_dir
 
 
 class Arguments:
@@ -9,10 +11,35 @@ class Arguments:
         'first': {"description": "Find the first subtitle track and convert it."},
         'all': {"description": "Find all subtitle tracks and convert them."}
     }
+    SUP_DECODERS = {
+        'native': {"description": "Decode SUP files in memory with the built-in PGS decoder."},
+        'bdsup2sub': {"description": "Convert SUP files to SUB/XML and images with BDSup2Sub (requires Java)."}
+    }
+    DEMUXERS = {
+        'native': {"description": "Stream the PGS tracks out of the MKV file straight into OCR, without writing SUP files."},
+        'mkvextract': {"description": "Extract the tracks to SUP files with mkvextract first (requires MKVToolNix)."}
+    }
+    PREPROCESSORS = {
+        'gray': {"description": "Load the images as grayscale, then scale, blur and invert them."},
+        'palette': {"description": "Classify the palette entries as text fill, outline or background and binarize the "
+                                   "images with a single lookup table, without blurring."}
+    }
     def __init__(self, APP):
         mode_help = ""
         for mode, metadata in self.RUN_MODES.items():
             mode_help += f"\n\n - '{mode}': {metadata['description']}\n"
+        decoder_help = ""
+        for decoder, metadata in self.SUP_DECODERS.items():
+            decoder_help += f"\n\n - '{decoder}': {metadata['description']}\n"
+        demuxer_help = ""
+        for demuxer, metadata in self.DEMUXERS.items():
+            demuxer_help += f"\n\n - '{demuxer}': {metadata['description']}\n"
+        preprocess_help = ""
+        for preprocess, metadata in self.PREPROCESSORS.items():
+            preprocess_help += f"\n\n - '{preprocess}': {metadata['description']}\n"
+        engine_help = ""
+        for engine, metadata in ENGINES.items():
+            engine_help += f"\n\n - '{engine}': {metadata['description']}\n"
 
         parser = argparse.ArgumentParser(
             prog=f"{APP['name']}",
@@ -25,22 +52,97 @@ class Arguments:
                             help="The full path to the import file. This can be a SUP, XML, MKV file, or a directory containing the MKV file.")
         parser.add_argument('-o', '--out', metavar='/Videos/subtitles', default=None,
                             help="The full path to save the generated SRT file(s). Default uses the path of the input file or directory.")
+        parser.add_argument('-b', '--batch', action="store_true", default=False,
+                            help="Convert every MKV file found under the input directory, without prompting.")
+        parser.add_argument('-w', '--watch', metavar='/Videos/incoming', default=None,
+                            help="Keep running and convert each MKV file that lands under this directory once it is fully written, "
+                                 "keeping the OCR workers warm between files. Stop it with Ctrl-C or SIGTERM.")
+        parser.add_argument('--watch-settle', metavar='SECONDS', default=10, type=float,
+                            help="The number of seconds a watched file must be unchanged before it is converted. Default: 10")
+        parser.add_argument('--poll-interval', metavar='SECONDS', default=None, type=float,
+                            help="Rescan the watched directory every SECONDS instead of using inotify, e.g. for network shares "
+                                 "whose writes inotify does not see. Default: inotify, or every 5 seconds where it is not available")
+        parser.add_argument('--queue-db', metavar='jobs.sqlite3', default=None,
+                            help="Keep the jobs in a durable SQLite job store, shared by the sup2srt processes of this host. "
+                                 "The inputs are submitted to it, and this process converts its pending jobs, including the ones "
+                                 "other processes submitted, until none are left. Jobs of crashed processes are taken over.")
+        parser.add_argument('--submit', action="store_true", default=False,
+                            help="Only submit the inputs to the --queue-db job store, for the worker processes to convert.")
+        parser.add_argument('--worker', action="store_true", default=False,
+                            help="Convert the pending jobs of the --queue-db job store, without an input of its own.")
+        parser.add_argument('--queue-status', action="store_true", default=False,
+                            help="List the jobs of the --queue-db job store and exit.")
+        parser.add_argument('--priority', metavar='N', default=None, type=int,
+                            help="The priority of the submitted jobs, higher first. Default: by input type, XML before SUP before MKV")
+        parser.add_argument('--retries', metavar='N', default=2, type=int,
+                            help="The number of times a failed job of the job store is retried, with exponential backoff. Default: 2")
         parser.add_argument('-u', '--uid', default=None, help="When running in docker, set the output file ownership to this uid.")
         parser.add_argument('-g', '--gid', default=None, help="When running in docker, set the output file ownership to this gid.")            
         parser.add_argument('-t', '--tmpdir', metavar='/tmp', default=f'{tempfile.gettempdir()}',
                             help="The temp path/working directory")
+        parser.add_argument('-d', '--sup-decoder', default='native', choices=self.SUP_DECODERS.keys(),
+                            help=f"How SUP files are decoded.{decoder_help}. Default: 'native'")
+        parser.add_argument('--demuxer', default=None, choices=self.DEMUXERS.keys(),
+                            help=f"How subtitle tracks are read from MKV files.{demuxer_help}. Default: 'native', or 'mkvextract' with the bdsup2sub decoder")
         parser.add_argument('--bdsup2sub-jar', metavar='/opt/BDSup2Sub.jar', default=None,
                             help="The path to the BDSup2Sub.jar file", action=EnvDefault, envvar="BDSUP2SUB")
-        # Disabled util this supports languages other than English
-        # parser.add_argument('-l', '--language', default=['eng'],
-        #                     help="The language of subtitle tracks to extract from an MKV file, in ISO-639-1 format.",
-        #                     action="append")
+        parser.add_argument('-l', '--language', default=None, action="append",
+                            help="The language of the subtitle tracks to extract from an MKV file, in ISO-639 format. "
+                                 "Repeat it for several languages, each track is OCR scanned with the tesseract model "
+                                 "of its own language. SUP and XML inputs, whose language is not known, are OCR scanned "
+                                 "with the models of all the languages combined. Default: 'eng'")
+        parser.add_argument('--no-resume', action="store_true", default=False,
+                            help="Do not resume an interrupted conversion from its OCR journal.")
+        parser.add_argument('--profile', metavar='out.json', default=None,
+                            help="Trace the commands, pipeline stages and OCR steps, write a Chrome trace to this file "
+                                 "and log the p50/p95/max time of each span.")
         parser.add_argument('-L', '--limit', metavar=100, default=None, type=int,
-                            help="Only process this many subtitles from a SUB file.")
+                            help="Only process this many subtitles from each file, counted after duplicate events "
+                                 "are coalesced. The bdsup2sub decoder only converts the display sets of the first "
+                                 "subtitles, of which coalescing can leave fewer.")
+        parser.add_argument('-j', '--jobs', metavar='N', default=1, type=int,
+                            help="The number of OCR worker processes. Use 0 for one per CPU core. Default: 1")
+        parser.add_argument('--mkv-workers', metavar='N', default=1, type=int,
+                            help="The number of MKV files to export tracks from at the same time. Default: 1")
+        parser.add_argument('--sup-workers', metavar='N', default=1, type=int,
+                            help="The number of SUP files to convert with BDSup2Sub at the same time, each in its own JVM. "
+                                 "Use 0 for one per CPU core. Default: 1")
+        parser.add_argument('--sub-workers', metavar='N', default=1, type=int,
+                            help="The number of subtitle tracks to OCR at the same time, sharing the OCR workers. Default: 1")
+        parser.add_argument('--io-jobs', metavar='N', default=None, type=int,
+                            help="The number of I/O heavy jobs (mkvinfo/mkvextract) that may run at the same time. Default: 2 in batch mode, else unlimited")
+        parser.add_argument('--cpu-jobs', metavar='N', default=None, type=int,
+                            help="The number of CPU heavy jobs (BDSup2Sub/OCR) that may run at the same time. Default: 2 in batch mode, else unlimited")
+        parser.add_argument('--queue-size', metavar='N', default=20, type=int,
+                            help="The number of jobs that may wait between two stages. Default: 20")
+        parser.add_argument('-e', '--engine', default='auto', choices=['auto', *ENGINES.keys()],
+                            help=f"The OCR engine.{engine_help}. Default: 'auto', the first installed engine in the order listed")
+        parser.add_argument('--omp-threads', metavar='N', default=1, type=int,
+                            help="The number of OpenMP threads each tesseract process may use. Default: 1")
+        parser.add_argument('--preprocess', default='gray', choices=self.PREPROCESSORS.keys(),
+                            help=f"How subtitle images are prepared for OCR.{preprocess_help}. Default: 'gray'")
+        parser.add_argument('--ocr-batch', metavar='K', default=1, type=int,
+                            help="OCR scan up to K subtitle images stacked on one page per engine call, "
+                                 "falling back to one image per call when the lines can not be mapped back. Default: 1")
+        parser.add_argument('--coalesce-threshold', metavar='PERCENT', default=2, type=float,
+                            help="Merge adjacent subtitle events whose image hashes differ in at most this percent of text pixels. "
+                                 "Use 0 to only merge identical images. Default: 2")
+        parser.add_argument('--no-coalesce', action="store_true", default=False,
+                            help="Do not merge adjacent duplicate subtitle events.")
+        parser.add_argument('--cache-dir', metavar='~/.cache/sup2srt', default=default_cache_dir(),
+                            help="The directory of the persistent OCR result cache, the cached BDSup2Sub version "
+                                 "and its class data sharing archive.", action=EnvDefault, envvar="SUP2SRT_CACHE_DIR")
+        parser.add_argument('--cache-size', metavar='MB', default=256, type=int,
+                            help="The OCR result cache size limit in MB. Default: 256")
+        parser.add_argument('--no-cache', action="store_true", default=False,
+                            help="Do not use the OCR result cache, nor cache the BDSup2Sub version and classes.")
         parser.add_argument('-f', '--force', action="store_true", default=False,
                             help='Force the overwrite of the output file if it exists.')
         parser.add_argument('-p', '--progress', action="store_true", default=True,
                             help='Show a progress bar.')
+        parser.add_argument('--headless', action="store_true", default=False,
+                            help="Do not draw the output windows of mkvextract and BDSup2Sub, log their progress as JSON events instead. "
+                                 "Default when the output is not a terminal.")
         parser.add_argument('-v', '--verbose', action="store_true", default=False,
                             help='Show verbose output.')
         parser.add_argument('-V', '--version', action="version", version=f'%(prog)s v{APP['version']}')
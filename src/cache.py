@@ -0,0 +1,114 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Estimated per-row storage overhead in bytes
+ROW_OVERHEAD = 64
+
+
+def default_cache_dir():
+    # Follow the XDG base directory spec
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sup2srt')
+
+
+class OcrCache:
+    """
+    A persistent, content-addressed cache of OCR results.
+
+    Results are keyed by a hash of the preprocessed image together with
+    the OCR engine and its version, configuration and language, so any
+    change to preprocessing, engine options or an upgraded tesseract misses
+    the cache instead of returning stale text.
+    The cache is shared by every worker process through SQLite and is
+    trimmed back to its size limit by evicting the least recently used rows.
+    """
+    FILENAME = 'ocr_cache.sqlite3'
+
+    def __init__(self, cache_dir, max_size=256):
+        """
+        :param cache_dir: The directory holding the cache database
+        :param max_size: The cache size limit in MB
+        """
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.filename = os.path.join(cache_dir, self.FILENAME)
+        self.max_size = max_size * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS ocr ('
+                'key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS ocr_last_used ON ocr (last_used)')
+
+    @staticmethod
+    def key(image, engine, config, language):
+        """
+        Builds the cache key of a preprocessed image.
+
+        :param image: The preprocessed image as a NumPy array
+        :param engine: The OCR engine name and version, e.g. 'tesserocr tesseract 5.3.0'
+        :param config: The OCR engine configuration string
+        :param language: The OCR language
+        :return: The hex digest key
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{engine}\0{language}\0{config}\0{image.shape}\0{image.dtype}\0".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up a cached OCR result and marks it as recently used.
+
+        :return: The cached text, or None on a miss
+        """
+        with self.lock:
+            row = self.db.execute('SELECT text FROM ocr WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.db:
+                self.db.execute('UPDATE ocr SET last_used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key, text):
+        size = len(key) + len(text.encode()) + ROW_OVERHEAD
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO ocr (key, text, size, last_used) VALUES (?, ?, ?, ?)',
+                (key, text, size, time.time())
+            )
+
+    def evict(self):
+        """
+        Evicts the least recently used results until the cache fits its size limit.
+
+        :return: The number of evicted results
+        """
+        with self.lock, self.db:
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM ocr').fetchone()[0]
+            if total <= self.max_size:
+                return 0
+            rows = self.db.execute('SELECT key, size FROM ocr ORDER BY last_used')
+            expired = []
+            for key, size in rows:
+                if total <= self.max_size:
+                    break
+                expired.append((key,))
+                total -= size
+            self.db.executemany('DELETE FROM ocr WHERE key = ?', expired)
+        return len(expired)
+
+    def close(self):
+        self.db.close()
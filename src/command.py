@@ -1,7 +1,57 @@
 import subprocess
+import threading
+import logging
+import shutil
+import json
 import time
+import sys
 import os
+import re
+from collections import deque
 from exceptions import SubProcessError
+from tracing import tracer
+
+# mkvextract prints "Progress: 42%", or "#GUI#progress 42%" with --gui-mode
+PERCENT_PATTERN = re.compile(r'progress:?\s*(\d{1,3})\s*%', re.IGNORECASE)
+# BDSup2Sub prints a line per caption, e.g. "Decoding frame 12/345 at offset 0x00001234"
+COUNT_PATTERN = re.compile(r'(\d+)\s*/\s*(\d+)')
+
+
+class ProgressEvent:
+    """ The progress of a running command, parsed from a line of its output """
+    def __init__(self, command, line, current=None, total=None, percent=None):
+        self.command = command
+        self.line = line
+        self.current = current
+        self.total = total
+        self.percent = percent
+
+    def to_json(self):
+        return json.dumps({
+            'command': self.command, 'current': self.current, 'total': self.total, 'percent': self.percent
+        })
+
+    def __str__(self):
+        return self.to_json()
+
+
+def parse_progress(command, line):
+    """
+    Parses a progress line of mkvextract or BDSup2Sub.
+
+    :param command: The command name
+    :param line: A line of the command's output
+    :return: A ProgressEvent, or None when the line holds no progress
+    """
+    match = PERCENT_PATTERN.search(line)
+    if match:
+        return ProgressEvent(command, line, percent=min(int(match.group(1)), 100))
+    match = COUNT_PATTERN.search(line)
+    if match and int(match.group(2)) > 0:
+        current, total = int(match.group(1)), int(match.group(2))
+        return ProgressEvent(command, line, current, total, min(current * 100 // total, 100))
+    return None
+
 
 class RunCommand:
     # Get the current environment variables
@@ -9,6 +59,24 @@ class RunCommand:
     if 'RUN_IN_DOCKER' in ENV:
         ENV['LD_LIBRARY_PATH'] = '/usr/lib:/usr/local/lib:/lib/x86_64-linux-gnu/'
 
+    # The number of times per second the scroll window is redrawn
+    REFRESH_RATE = 10
+    # Without a terminal (docker without -t, cron) no window is drawn and
+    # the progress of the command is logged as structured events instead
+    HEADLESS = not sys.stdout.isatty()
+    # The smallest change in percent that is logged in headless mode
+    PROGRESS_STEP = 10
+    # The number of output lines kept for the error message of a failed command
+    TAIL_LINES = 20
+
+    def __init__(self, logger=None, on_progress=None):
+        """
+        :param logger: The logger of the headless progress events
+        :param on_progress: A function called with every ProgressEvent, instead of logging them
+        """
+        self.logger = logger or logging.getLogger(__name__)
+        self.on_progress = on_progress
+
     def run_command_return_output(self, command: list):
         """
         Runs a command in a subprocess and returns the output.
@@ -24,14 +92,15 @@ class RunCommand:
         """
         try:
             # Run the command and capture the output
-            result = subprocess.run(
-                command,
-                stdout=subprocess.PIPE,  # Capture standard output
-                stderr=subprocess.PIPE,  # Capture standard error
-                text=True,               # Treat output as text
-                check=True,              # Raise an exception if the command fails
-                env=self.ENV
-            )
+            with tracer.span(os.path.basename(command[0]), 'command', argv=' '.join(command)):
+                result = subprocess.run(
+                    command,
+                    stdout=subprocess.PIPE,  # Capture standard output
+                    stderr=subprocess.PIPE,  # Capture standard error
+                    text=True,               # Treat output as text
+                    check=True,              # Raise an exception if the command fails
+                    env=self.ENV
+                )
 
             # Return the command's return code, stdout, and stderr
             return result.returncode, result.stdout, result.stderr
@@ -42,21 +111,31 @@ class RunCommand:
             print(f"Error output: {e.stderr}")
             return e.returncode, e.stdout, e.stderr
 
+
     def run_command_with_scroll_window(self, command, height=None, header=None):
         """
         Runs a command in a subprocess and displays the output in a smaller 
-        scrolling window within the terminal.
+        scrolling window within the terminal. The output is read at full
+        speed on its own thread, while the window is redrawn at a fixed rate.
+        In headless mode nothing is drawn and the progress lines of the
+        output are reported as ProgressEvents.
 
         :param command: The command to run, as a list (e.g., ['ping', '-c', '5', 'google.com'])
         :param height: The height of the scrolling window in lines
         :param header: a list of strings to show above the output window
+        :return: The seconds from the start of the command to its first line of output,
+                 which is mostly the startup time of e.g. a JVM, or None without output
 
         Example usage:
         run_command_with_scroll_window(['ping', '-c', '20', 'google.com'], height=10)  # Replace with your desired command
 
         """
-        # Get the terminal size
-        term_columns, term_lines = os.get_terminal_size()
+        with tracer.span(os.path.basename(command[0]), 'command', argv=' '.join(command)):
+            return self.__scroll_window__(command, height, header)
+
+    def __scroll_window__(self, command, height=None, header=None):
+        # Get the terminal size, which falls back to 80x24 without a terminal
+        term_columns, term_lines = shutil.get_terminal_size()
 
         # remove header height from the terminal lines
         if header:
@@ -70,8 +149,10 @@ class RunCommand:
         if isinstance(height, str) and height.endswith('%'):
             height = int(height.replace('%', ''))
             height = (term_lines * (height / 100))
+        height = max(1, int(height))
 
         # Start the subprocess
+        start = time.monotonic_ns()
         process = subprocess.Popen(
             command, 
             stdout=subprocess.PIPE, 
@@ -81,43 +162,20 @@ class RunCommand:
             env=self.ENV
         )
 
-        # ANSI escape sequences for cursor control
-        clear_screen = '\033[2J'   # Clear the screen
-        move_cursor_up = f'\033[{height}A'  # Move cursor up by window height
-        move_cursor_to_top = '\033[H'  # Move cursor to the top of the screen
-
-        # Initialize a list to store lines to display in the window
-        output_buffer = []
-
-        try:      
-            # Clear the screen and print the prepend header once
-            print(clear_screen, end='')  # Clear the screen
-            # if header:
-            #     print(f"first:{header}\n" + "-" * term_columns) 
-
-            # Continuously read from the process output
-            for line in process.stdout:
-                # Append the new line to the buffer
-                output_buffer.append(line)
-
-                # Keep only the last 'height' lines in the buffer
-                if len(output_buffer) > height:
-                    output_buffer.pop(0)
-
-                # Print the scrolling window effect
-                print(move_cursor_to_top, end='')  # Move cursor to the top to maintain the header position
-                if header:
-                    print(f"{header}\n")  # Re-print the header and underline it
-                # print(move_cursor_up, end='')  # Move cursor up to maintain window size
-
-                        
-                # Print the lines in the window
-                for buffered_line in output_buffer:
-                    print(buffered_line, end='')  # Print each line without adding extra newlines
-
-                # Slight delay to simulate real-time output (adjust as needed)
-                time.sleep(0.05)
+        # The last lines of output, shared by the reader thread and the renderer
+        output_buffer = deque(maxlen=max(height, self.TAIL_LINES))
+        first_output = []
+        reader = threading.Thread(
+            target=self.__pump__, args=(process, os.path.basename(command[0]), output_buffer, first_output),
+            name=f"{os.path.basename(command[0])}-output", daemon=True
+        )
 
+        try:
+            reader.start()
+            if self.HEADLESS:
+                reader.join()
+            else:
+                self.__render__(reader, output_buffer, height, header)
         except KeyboardInterrupt:
             process.terminate()
             raise SubProcessError("Process interrupted.")
@@ -125,4 +183,47 @@ class RunCommand:
         # Wait for the process to finish and capture the exit code
         return_code = process.wait()
         if return_code != 0:
-            raise SubProcessError(f"Command exited with code {return_code}")
\ No newline at end of file
+            tail = ''.join(list(output_buffer)[-self.TAIL_LINES:])
+            raise SubProcessError(f"Command exited with code {return_code}" + (f":\n{tail}" if self.HEADLESS and tail else ""))
+        if not first_output:
+            return None
+        # the startup time shows up as its own span in the --profile summary
+        tracer.record(os.path.basename(command[0]), 'startup', start, first_output[0] - start)
+        return (first_output[0] - start) / 1e9
+
+    def __pump__(self, process, name, output_buffer, first_output):
+        """ Reads the output of a process as fast as it is written, until the pipe closes """
+        reported = None
+        for line in process.stdout:
+            if not first_output:
+                first_output.append(time.monotonic_ns())
+            # deque.append is atomic, so the renderer can read the buffer without a lock
+            output_buffer.append(line)
+            if not self.HEADLESS and not self.on_progress:
+                continue
+            event = parse_progress(name, line)
+            if event is None:
+                continue
+            if self.on_progress:
+                self.on_progress(event)
+            elif reported is None or event.percent >= min(reported + self.PROGRESS_STEP, 100) > reported:
+                reported = event.percent
+                self.logger.info(f"progress {event.to_json()}")
+        process.stdout.close()
+
+    def __render__(self, reader, output_buffer, height, header):
+        """ Redraws the scroll window at a fixed rate until the reader thread is done """
+        # ANSI escape sequences for cursor control
+        clear_screen = '\033[2J'   # Clear the screen
+        move_cursor_to_top = '\033[H'  # Move cursor to the top of the screen
+
+        # Clear the screen once, the header is re-printed with every frame
+        print(clear_screen, end='')
+        while reader.is_alive():
+            reader.join(1 / self.REFRESH_RATE)
+            frame = list(output_buffer)[-height:]
+            print(move_cursor_to_top, end='')  # Move cursor to the top to maintain the header position
+            if header:
+                print(f"{header}\n")
+            # Print the lines in the window
+            print(''.join(frame), end='', flush=True)
@@ -27,9 +27,8 @@ class Config:
         self.verbose = False
         self.working_dir = None
         self.output_path = None
-        # Supported language is currently only English
-        self.language = ['eng']
-        self.queue = jobQueue()
+        self.language = None
+        self.queue = None
         self.input_file = None
         self.input_type = None
         self.uid = None
@@ -59,16 +58,64 @@ class Config:
         self.__logging__(self.verbose)
 
         # Verify languages are valid
-        if self.language:
-            for code in self.language:
-               get_language(code)
+        self.language = self.language or ['eng']
+        for code in self.language:
+            get_language(code)
+
+        # BDSup2Sub needs SUP files, so only mkvextract can feed it
+        if self.demuxer is None:
+            self.demuxer = 'mkvextract' if self.sup_decoder == 'bdsup2sub' else 'native'
+        elif self.demuxer == 'native' and self.sup_decoder == 'bdsup2sub':
+            raise ArgumentError("The native demuxer can not be used with the bdsup2sub decoder.")
+
+        # Verify the number of OCR workers
+        if self.jobs < 0:
+            raise ArgumentError(f"Invalid number of jobs: {self.jobs}")
+        elif self.jobs == 0:
+            self.jobs = os.cpu_count() or 1
+        if self.sup_workers == 0:
+            self.sup_workers = os.cpu_count() or 1
+
+        # The job store options need a job store
+        if (self.submit or self.worker or self.queue_status) and not self.queue_db:
+            raise ArgumentError("The --submit, --worker and --queue-status options need a --queue-db job store.")
+        if self.worker and (self.watch or self.batch):
+            raise ArgumentError("A --worker takes its inputs from the job store, it can not --watch or --batch.")
+        if self.retries < 0:
+            raise ArgumentError(f"Invalid number of retries: {self.retries}")
+
+        # In batch, watch and job store mode the stages get enough workers to use the resource limits
+        if self.batch or self.watch or self.queue_db:
+            self.io_jobs = self.io_jobs or 2
+            self.cpu_jobs = self.cpu_jobs or 2
+            self.mkv_workers = max(self.mkv_workers, self.io_jobs)
+            self.sup_workers = max(self.sup_workers, self.cpu_jobs)
+            self.sub_workers = max(self.sub_workers, self.cpu_jobs)
+
+        # Verify the stage workers and create the stage queues
+        for key in ['mkv_workers', 'sup_workers', 'sub_workers', 'queue_size', 'io_jobs', 'cpu_jobs', 'ocr_batch']:
+            if getattr(self, key) is not None and getattr(self, key) < 1:
+                raise ArgumentError(f"Invalid value for {key.replace('_', '-')}: {getattr(self, key)}")
+        self.queue = jobQueue(maxsize=self.queue_size)
 
         # set the working directory
         self.working_dir = tempfile.TemporaryDirectory(prefix=f"{self.APP['name']}-", dir=args.tmpdir)
         
+        # A job store worker takes its inputs from the store
+        if self.worker or self.queue_status:
+            self.output_path = os.path.realpath(args.out) if args.out else os.getcwd()
+            return
+
         # get the input path or filename
-        in_file = os.path.realpath(getattr(args, 'in', None))
+        in_file = os.path.realpath(self.watch or getattr(args, 'in', None))
         
+        if self.batch and not os.path.isdir(in_file):
+            raise ArgumentError(f"Batch mode needs an input directory: '{in_file}'")
+        if self.watch and not os.path.isdir(in_file):
+            raise ArgumentError(f"Watch mode needs a directory: '{in_file}'")
+        if self.watch_settle < 0 or (self.poll_interval is not None and self.poll_interval <= 0):
+            raise ArgumentError("The watch settle time and poll interval must be positive.")
+
         if os.path.isdir(in_file):
             # if the in_file is a directory it will be treated as an MKV path
             if not os.path.exists(in_file):
@@ -1,10 +1,14 @@
 import sys
 import os
 import shutil
-from iso639 import Lang
-from iso639.exceptions import InvalidLanguageValue, DeprecatedLanguageValue
 from exceptions import ArgumentError
 
+# The mode open() creates files with. Reading the umask means setting it,
+# so it is read once at import, before any thread could create a file.
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
 def find_binary_in_path(binary_name):
     # Find the binary in the PATH
     binary_path = shutil.which(binary_name)
@@ -16,6 +20,16 @@ def find_binary_in_path(binary_name):
 def is_directory_writable(directory_path):
     return os.access(directory_path, os.W_OK)
 
+def find_files(directory, extension):
+    # Recursively find the files with an extension, in a stable order
+    matches = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().endswith(f".{extension}"):
+                matches.append(os.path.join(root, file))
+    return matches
+
 def print_progress_bar(iteration, total, bar_length=40):
     # Calculate progress
     progress = (iteration / total)
@@ -41,11 +55,23 @@ def convert_to_srt_time(time_str, frame_rate=25):
 
     return srt_time
 
+def pts_to_srt_time(pts, clock_rate=90000):
+    # Convert the presentation timestamp to milliseconds
+    total_ms = pts * 1000 // clock_rate
+    hours, remainder = divmod(total_ms, 3600000)
+    minutes, remainder = divmod(remainder, 60000)
+    seconds, milliseconds = divmod(remainder, 1000)
+    # Format the time in SRT format: HH:MM:SS,mmm
+    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
+
 
 def get_language(code):
+    # loading the language tables takes a while, so only runs that check a language pay for it
+    from iso639 import Lang
+    from iso639.exceptions import InvalidLanguageValue, DeprecatedLanguageValue
     try:
         return Lang(code)
-    except DeprecatedLanguageValue:
+    except DeprecatedLanguageValue as e:
         return Lang(e.change_to)
 
     except InvalidLanguageValue:
@@ -1,18 +1,498 @@
+import os
+import time
 import queue
+import socket
+import sqlite3
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from tracing import tracer
+from exceptions import MissingDependencyError
+
+# The errors that are the fault of the worker, not of the job: its OCR pool died or a tool is missing
+WORKER_FAULTS = (BrokenProcessPool, MissingDependencyError)
 
 class jobQueue:
-    def __init__(self):
-        self.mkv = queue.Queue(maxsize=20)
-        self.sup = queue.Queue(maxsize=20)
-        self.sub = queue.Queue(maxsize=20)
+    def __init__(self, maxsize=20):
+        self.mkv = queue.Queue(maxsize=maxsize)
+        self.sup = queue.Queue(maxsize=maxsize)
+        self.sub = queue.Queue(maxsize=maxsize)
 
 class QueueItem:
-    def __init__(self, input_file, output_path=None):
+    def __init__(self, input_file, output_path=None, source_file=None, tracks=None, language=None):
         self.input_file = input_file
         self.output_path = output_path
+        # the file the user asked to convert, which this job was derived from
+        self.source_file = source_file or input_file
+        # the mkvTrack objects to demux from an MKV input file
+        self.tracks = tracks
+        # the language of the subtitle track, when it was exported from an MKV file
+        self.language = language
 
 
     def __str__(self):
         return self.input_file
 
-        
\ No newline at end of file
+
+class JobStore:
+    """
+    A durable store of conversion jobs, shared through SQLite by the sup2srt
+    processes of a host, so pending work survives a crash and can be
+    submitted and inspected from outside the converting process.
+
+    Each job converts one source file, entering the pipeline at the stage of
+    its input type. A job is pending, running, done or failed. A worker
+    claims the pending job with the highest priority and holds a lease on it,
+    which it renews with heartbeats while the job runs. The job of a worker
+    that died is claimed again once its lease expires. A failed job is
+    retried after an exponential backoff until its attempts are used up.
+    """
+    STATES = ['pending', 'running', 'done', 'failed']
+    # The default priorities of the jobs by input stage: the jobs that skip
+    # the extraction stages finish soonest, so they go first
+    STAGE_PRIORITIES = {'mkv': 0, 'sup': 10, 'sub': 20}
+
+    def __init__(self, filename, lease=60, retries=2, backoff=30):
+        """
+        :param filename: The SQLite database file, created when it does not exist
+        :param lease: The number of seconds a claimed job is held without a heartbeat
+        :param retries: The number of times a failed job is retried
+        :param backoff: The number of seconds before the first retry, doubling with each retry
+        """
+        self.filename = filename
+        self.lease = lease
+        self.retries = retries
+        self.backoff = backoff
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+
+        # autocommit, the claims are explicit IMMEDIATE transactions
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, input_file TEXT NOT NULL, output_path TEXT, stage TEXT NOT NULL, '
+            'priority INTEGER NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+            'max_attempts INTEGER NOT NULL, not_before REAL NOT NULL, lease_until REAL, worker TEXT, error TEXT, '
+            'created REAL NOT NULL, updated REAL NOT NULL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority DESC, id)')
+
+    def close(self):
+        self.db.close()
+
+    def transaction(self, func, *args):
+        """ Runs a function in a write transaction, which other processes wait for """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def submit(self, job_item, stage, priority=None):
+        """
+        Adds a job, unless the source file already has a pending or running one.
+
+        :param job_item: The QueueItem of the source file
+        :param stage: The name of the stage the job enters the pipeline at
+        :param priority: The job's priority, higher first, by default the stage's priority
+        :return: The job ID
+        """
+        priority = self.STAGE_PRIORITIES.get(stage, 0) if priority is None else priority
+
+        def submit():
+            row = self.db.execute(
+                "SELECT id FROM jobs WHERE input_file = ? AND state IN ('pending', 'running')", (job_item.input_file,)
+            ).fetchone()
+            if row:
+                return row[0]
+            now = time.time()
+            return self.db.execute(
+                'INSERT INTO jobs (input_file, output_path, stage, priority, state, max_attempts, not_before, created, updated) '
+                "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?)",
+                (job_item.input_file, job_item.output_path, stage, priority, self.retries + 1, now, now, now)
+            ).lastrowid
+        return self.transaction(submit)
+
+    def claim(self, stages):
+        """
+        Claims the next job, taking over the jobs whose lease expired.
+
+        :param stages: The names of the stages the claiming pipeline can start jobs at
+        :return: A tuple of the job ID, the stage name and the QueueItem, or None when no job is ready
+        """
+        def claim():
+            now = time.time()
+            # the jobs of the workers that died on their last attempt
+            self.db.execute(
+                "UPDATE jobs SET state = 'failed', error = 'The worker stopped renewing its lease.', updated = ? "
+                "WHERE state = 'running' AND lease_until < ? AND attempts >= max_attempts", (now, now)
+            )
+            row = self.db.execute(
+                f"SELECT id, input_file, output_path, stage FROM jobs WHERE stage IN ({', '.join('?' * len(stages))}) "
+                "AND ((state = 'pending' AND not_before <= ?) OR (state = 'running' AND lease_until < ?)) "
+                "ORDER BY priority DESC, id LIMIT 1", (*stages, now, now)
+            ).fetchone()
+            if not row:
+                return None
+            self.db.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, updated = ? WHERE id = ?",
+                (self.worker, now + self.lease, now, row[0])
+            )
+            return row[0], row[3], QueueItem(input_file=row[1], output_path=row[2])
+        return self.transaction(claim)
+
+    def heartbeat(self, job_ids):
+        """ Renews the leases of this worker's running jobs """
+        if not job_ids:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                f"UPDATE jobs SET lease_until = ?, updated = ? WHERE id IN ({', '.join('?' * len(job_ids))}) "
+                "AND worker = ? AND state = 'running'", (now + self.lease, now, *job_ids, self.worker)
+            )
+
+    def release(self, job_id):
+        """ Returns a job to the pending jobs without counting its attempt, when its worker can not run it """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET state = 'pending', attempts = MAX(attempts - 1, 0), lease_until = NULL, worker = NULL, "
+                "not_before = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                (now, now, job_id, self.worker)
+            )
+
+    def complete(self, job_id):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL, updated = ? WHERE id = ? AND worker = ?",
+                (now, job_id, self.worker)
+            )
+
+    def fail(self, job_id, error):
+        """
+        Fails a job, scheduling its retry when it has attempts left.
+
+        :return: The job's new state
+        """
+        def fail():
+            now = time.time()
+            row = self.db.execute('SELECT attempts, max_attempts FROM jobs WHERE id = ? AND worker = ?', (job_id, self.worker)).fetchone()
+            if not row:
+                return None
+            attempts, max_attempts = row
+            state = 'pending' if attempts < max_attempts else 'failed'
+            self.db.execute(
+                'UPDATE jobs SET state = ?, not_before = ?, lease_until = NULL, error = ?, updated = ? WHERE id = ?',
+                (state, now + self.backoff * 2 ** (attempts - 1), str(error).strip(), now, job_id)
+            )
+            return state
+        return self.transaction(fail)
+
+    def pending(self, stages):
+        """ The number of pending jobs of the stages, including the ones waiting for a retry """
+        with self.lock:
+            return self.db.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE state = 'pending' AND stage IN ({', '.join('?' * len(stages))})", stages
+            ).fetchone()[0]
+
+    def jobs(self):
+        """
+        Lists the jobs, for inspecting the store.
+
+        :return: A list of (id, input_file, stage, priority, state, attempts, worker, error) tuples
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT id, input_file, stage, priority, state, attempts, worker, error FROM jobs ORDER BY id'
+            ).fetchall()
+
+
+class jobPipeline:
+    """
+    Runs the conversion stages concurrently.
+
+    Each stage has its own worker threads that take jobs from the stage's
+    queue and put the jobs they produce on the next stage's queue, so the
+    stages overlap and a full queue blocks its producer until the next
+    stage catches up. When a stage's input is closed and drained its
+    workers stop and the next stage's queue is closed in turn.
+
+    Stages can also share a resource limit, e.g. 'io' for the stages that
+    stream whole MKV files and 'cpu' for conversion and OCR, which caps the
+    number of jobs running across all the stages of that resource.
+
+    Jobs can also be submitted to running stages one at a time, e.g. by a
+    watched folder or from a JobStore. The jobs derived from each source
+    file are counted, so the on_finished callback is called once the last
+    of them is done.
+    """
+    # Marks the end of a queue
+    STOP = None
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.stages = []
+        self.resources = {}
+        self.failures = []
+        self.results = []
+        # the last stage's results by the source file they were derived from
+        self.outputs = {}
+        # the number of unfinished jobs by the source file they were derived from
+        self.pending = {}
+        # the source files a job of which failed, until the source is finished
+        self.failed_sources = set()
+        # the error that stopped feed() from claiming more jobs, because this worker can not run them
+        self.worker_fault = None
+        # called with the source file, its results and whether a job failed once all its jobs are done
+        self.on_finished = None
+        self.lock = threading.Lock()
+
+    def limit(self, resource, jobs):
+        """
+        Limits the number of jobs that may use a resource at the same time.
+
+        :param resource: The resource name
+        :param jobs: The maximum number of concurrent jobs
+        """
+        self.resources[resource] = threading.BoundedSemaphore(max(1, jobs))
+
+    def add_stage(self, name, handler, queue, workers=1, resource=None):
+        """
+        Adds a stage to the end of the pipeline.
+
+        :param name: The stage name, used in log messages
+        :param handler: A function that processes one job and returns the jobs for the next stage
+        :param queue: The stage's input queue
+        :param workers: The number of jobs the stage processes concurrently
+        :param resource: The name of the resource limit the stage's jobs count against
+        """
+        self.stages.append({
+            'name': name, 'handler': handler, 'queue': queue, 'workers': max(1, workers), 'resource': resource
+        })
+
+    def close(self, stage=0):
+        """ Signals that no more jobs will be put on a stage's queue """
+        for _ in range(self.stages[stage]['workers']):
+            self.stages[stage]['queue'].put(self.STOP)
+
+    def submit(self, job_item, stage=None):
+        """
+        Puts a job on a stage's queue of the running pipeline.
+
+        :param job_item: The job
+        :param stage: The name of the stage, by default the first stage
+        """
+        index = [stage['name'] for stage in self.stages].index(stage) if stage else 0
+        with self.lock:
+            self.pending[job_item.source_file] = self.pending.get(job_item.source_file, 0) + 1
+        self.stages[index]['queue'].put(job_item)
+
+    def finish(self, source):
+        """ Counts a finished job of a source file, calling on_finished after its last one """
+        with self.lock:
+            self.pending[source] -= 1
+            if self.pending[source]:
+                return
+            del self.pending[source]
+            outputs = self.outputs.get(source, [])
+            failed = source in self.failed_sources
+            self.failed_sources.discard(source)
+        if self.on_finished:
+            self.on_finished(source, outputs, failed)
+
+    def worker(self, index):
+        stage = self.stages[index]
+        next_queue = self.stages[index + 1]['queue'] if index + 1 < len(self.stages) else None
+        while True:
+            job_item = stage['queue'].get()
+            if job_item is self.STOP:
+                stage['queue'].task_done()
+                return
+            try:
+                limit = self.resources.get(stage['resource'])
+                if limit:
+                    with tracer.span(stage['name'], 'wait', resource=stage['resource']):
+                        limit.acquire()
+                    try:
+                        with tracer.span(stage['name'], 'stage', file=job_item):
+                            next_items = stage['handler'](job_item) or []
+                    finally:
+                        limit.release()
+                else:
+                    with tracer.span(stage['name'], 'stage', file=job_item):
+                        next_items = stage['handler'](job_item) or []
+                if next_queue is not None:
+                    with self.lock:
+                        self.pending[job_item.source_file] += len(next_items)
+                for next_item in next_items:
+                    if next_queue is not None:
+                        next_queue.put(next_item)
+                    else:
+                        with self.lock:
+                            self.results.append(next_item)
+                            self.outputs.setdefault(job_item.source_file, []).append(next_item)
+            except Exception as e:
+                self.logger.error(f"{stage['name']} failed on '{job_item}': {e}")
+                with self.lock:
+                    # drop the traceback so the failed job's frames are released
+                    self.failures.append((stage['name'], job_item, e.with_traceback(None)))
+                    self.failed_sources.add(job_item.source_file)
+            finally:
+                self.finish(job_item.source_file)
+                stage['queue'].task_done()
+
+    def start(self):
+        """
+        Starts the worker threads of every stage.
+
+        :return: A list of the worker threads of each stage
+        """
+        threads = []
+        for index, stage in enumerate(self.stages):
+            stage_threads = [
+                threading.Thread(target=self.worker, args=(index,), name=f"{stage['name']}-{n}", daemon=True)
+                for n in range(stage['workers'])
+            ]
+            for thread in stage_threads:
+                thread.start()
+            threads.append(stage_threads)
+        return threads
+
+    def join(self, threads):
+        """ Waits for every stage to finish, closing each next stage as its producer finishes """
+        for index, stage_threads in enumerate(threads):
+            for thread in stage_threads:
+                # join with a timeout so KeyboardInterrupt is still delivered
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+            if index + 1 < len(self.stages):
+                self.close(index + 1)
+
+    def run(self, job_items):
+        """
+        Runs the pipeline to completion.
+
+        :param job_items: The jobs for the first stage
+        :return: A list of (stage_name, job_item, exception) tuples of the failed jobs
+        """
+        threads = self.start()
+        for job_item in job_items:
+            self.submit(job_item)
+        self.close()
+        self.join(threads)
+        return self.failures
+
+    def forget(self, source):
+        """
+        Drops the results and failures of a finished source file, so a long
+        running pipeline does not accumulate them.
+
+        :return: The source file's (stage_name, job_item, exception) failures
+        """
+        with self.lock:
+            outputs = set(self.outputs.pop(source, []))
+            self.results = [result for result in self.results if result not in outputs]
+            failures = [failure for failure in self.failures if failure[1].source_file == source]
+            self.failures = [failure for failure in self.failures if failure[1].source_file != source]
+        return failures
+
+    def feed(self, store, stop, jobs=1, wait=False):
+        """
+        Runs the jobs of a JobStore through the started pipeline, keeping up
+        to a number of claimed jobs in flight, renewing their leases and
+        completing or failing them as their source files finish. Once it is
+        stopped, it returns after the claimed jobs finished.
+
+        A job that failed on a worker fault, like a broken OCR worker pool or
+        a missing tool, is released for another worker without counting the
+        attempt, and this worker stops claiming jobs.
+
+        :param store: The JobStore
+        :param stop: A threading.Event that stops claiming jobs
+        :param jobs: The maximum number of claimed jobs in flight
+        :param wait: Wait for new jobs when none are pending, instead of returning
+        """
+        stages = [stage['name'] for stage in self.stages]
+        claimed = {}
+        on_finished = self.on_finished
+
+        def finished(source, outputs, failed):
+            with self.lock:
+                job_id = claimed.pop(source)
+            if failed:
+                error = next(e for _, job_item, e in reversed(self.failures) if job_item.source_file == source)
+                if isinstance(error, WORKER_FAULTS):
+                    store.release(job_id)
+                    if not self.worker_fault:
+                        self.logger.error(f"Not claiming more jobs, this worker can not run them: {error}")
+                    self.worker_fault = error
+                elif store.fail(job_id, error) == 'pending':
+                    self.logger.warning(f"Retrying '{source}' later, job {job_id} failed: {error}")
+            else:
+                store.complete(job_id)
+            if on_finished:
+                on_finished(source, outputs, failed)
+
+        self.on_finished = finished
+        heartbeat = time.monotonic()
+        try:
+            while True:
+                with self.lock:
+                    running = len(claimed)
+                stopped = stop.is_set() or self.worker_fault is not None
+                job = store.claim(stages) if running < jobs and not stopped else None
+                if job:
+                    job_id, stage, job_item = job
+                    self.logger.info(f"Claimed job {job_id}: '{job_item}'")
+                    with self.lock:
+                        claimed[job_item.source_file] = job_id
+                    self.submit(job_item, stage)
+                    continue
+                if not running and (stopped or not (wait or store.pending(stages))):
+                    return
+                time.sleep(1.0)
+                if time.monotonic() - heartbeat >= store.lease / 3:
+                    with self.lock:
+                        job_ids = list(claimed.values())
+                    store.heartbeat(job_ids)
+                    heartbeat = time.monotonic()
+        finally:
+            self.on_finished = on_finished
+
+    def succeeded(self):
+        """
+        Lists the source files every job of which succeeded.
+
+        :return: A dict of the last stage's results by source file
+        """
+        failed = {job_item.source_file for _, job_item, _ in self.failures}
+        return {source: outputs for source, outputs in self.outputs.items() if source not in failed}
+
+    def log_summary(self, sources, elapsed):
+        """
+        Logs the outcome of a run.
+
+        :param sources: The source files the run was started with
+        :param elapsed: The wall time of the run in seconds
+        """
+        failed = {}
+        for stage, job_item, error in self.failures:
+            failed.setdefault(job_item.source_file, f"{stage}: {str(error).strip()}")
+        total_bytes = sum(os.path.getsize(source) for source in sources if os.path.isfile(source))
+
+        self.logger.info("-" * 40)
+        self.logger.info(f"Files: {len(sources)}, succeeded: {len(sources) - len(failed)}, failed: {len(failed)}")
+        self.logger.info(f"Subtitle files created: {len(self.results)}")
+        self.logger.info(
+            f"Wall time: {time.strftime('%H:%M:%S', time.gmtime(elapsed))}, "
+            f"throughput: {len(sources) / elapsed * 60:.2f} files/min, {total_bytes / elapsed / 1024 ** 2:.1f} MB/s"
+        )
+        for source, error in failed.items():
+            self.logger.error(f"Failed: '{source}' ({error})")
@@ -0,0 +1,74 @@
+import os
+import json
+
+
+class OcrJournal:
+    """
+    Journals the OCR results of a subtitle track as they complete, so a
+    conversion that was interrupted resumes where it stopped.
+
+    The journal is a JSON lines file next to the SRT file. Its first line
+    holds a key of the options the results depend on, and each following
+    line the result of one event. A result is only reused for an event
+    with the same index and times, and a journal with another key is
+    discarded.
+    """
+    def __init__(self, out_file, key):
+        """
+        :param out_file: The SRT filename the journal belongs to
+        :param key: A string identifying the options the OCR results depend on
+        """
+        directory, filename = os.path.split(out_file)
+        self.filename = os.path.join(directory, f".{filename}.journal")
+        self.key = key
+        self.stream = None
+
+    def load(self):
+        """
+        Reads the results of an earlier, interrupted run.
+
+        :return: A dict of (start_time, end_time, text) tuples by event index
+        """
+        results = {}
+        if not os.path.exists(self.filename):
+            return results
+        with open(self.filename) as stream:
+            lines = iter(stream)
+            try:
+                if json.loads(next(lines)).get('key') != self.key:
+                    return results
+                for line in lines:
+                    entry = json.loads(line)
+                    results[entry['index']] = (entry['start'], entry['end'], entry['text'])
+            except (StopIteration, ValueError, KeyError):
+                # the last line may have been cut off when the run was interrupted
+                pass
+        return results
+
+    def open(self, results):
+        """
+        Starts a new journal, keeping the results that will be reused.
+
+        :param results: A dict of (start_time, end_time, text) tuples by event index
+        """
+        self.stream = open(self.filename, 'w')
+        self.stream.write(json.dumps({'key': self.key}) + '\n')
+        for index, (start_time, end_time, text) in sorted(results.items()):
+            self.stream.write(json.dumps({'index': index, 'start': start_time, 'end': end_time, 'text': text}) + '\n')
+        self.stream.flush()
+
+    def append(self, index, start_time, end_time, text):
+        self.stream.write(json.dumps({'index': index, 'start': start_time, 'end': end_time, 'text': text}) + '\n')
+        # hand each result to the OS, so it survives the process being killed
+        self.stream.flush()
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+    def remove(self):
+        """ Removes the journal once the SRT file is complete """
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
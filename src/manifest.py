@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from tempfile import NamedTemporaryFile
+from functions import FILE_MODE
+
+# The size of each sampled chunk of the quick hash
+SAMPLE_SIZE = 1024 * 1024
+
+# The options that change the produced SRT files
+OUTPUT_OPTIONS = [
+    'mode', 'language', 'sup_decoder', 'demuxer', 'engine', 'limit',
+    'coalesce_threshold', 'no_coalesce', 'ocr_batch', 'preprocess'
+]
+
+
+def quick_hash(filename):
+    """
+    Hashes the size and the first, middle and last MB of a file. Reading
+    samples instead of the whole file keeps checking a library of large
+    MKV files fast, while any remux or re-encode changes the hash.
+
+    :param filename: The file to hash
+    :return: The hex digest
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.sha256(str(size).encode())
+    with open(filename, 'rb') as stream:
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}):
+            stream.seek(offset)
+            digest.update(stream.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Records how each SRT file was produced: the input's quick hash, the tool
+    versions and the options. An input whose entry still matches and whose
+    SRT files still exist is skipped by the next run, before any of the
+    extraction or conversion work.
+
+    The manifest is a JSON file in the output directory, replaced
+    atomically on every update.
+    """
+    FILENAME = '.sup2srt-manifest.json'
+
+    def __init__(self, output_path, options, tools):
+        """
+        :param output_path: The output directory
+        :param options: A dict of the option values that change the output
+        :param tools: A dict of the tool versions
+        """
+        self.filename = os.path.join(output_path, self.FILENAME)
+        self.options = options
+        self.tools = tools
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as stream:
+                    self.entries = json.load(stream).get('sources', {})
+            except ValueError:
+                self.entries = {}
+
+    def is_current(self, source):
+        """
+        Checks whether a source file was converted with the same input, tools and options.
+
+        :param source: The source filename
+        :return: True when the source can be skipped
+        """
+        entry = self.entries.get(os.path.realpath(source))
+        if not entry or not os.path.isfile(source):
+            return False
+        if entry.get('options') != self.options or entry.get('tools') != self.tools:
+            return False
+        if not entry.get('outputs') or not all(os.path.exists(output) for output in entry['outputs']):
+            return False
+        return entry.get('hash') == quick_hash(source)
+
+    def record(self, source, outputs):
+        """
+        Records the SRT files produced from a source file.
+
+        :param source: The source filename
+        :param outputs: The SRT filenames
+        """
+        if not os.path.isfile(source):
+            return
+        entry = {
+            'hash': quick_hash(source), 'options': self.options, 'tools': self.tools,
+            'outputs': sorted(outputs), 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        }
+        with self.lock:
+            self.entries[os.path.realpath(source)] = entry
+
+    def save(self):
+        with self.lock:
+            output_file = NamedTemporaryFile(
+                mode='w', prefix='.manifest', suffix='.json', dir=os.path.dirname(self.filename), delete=False
+            )
+            with output_file:
+                json.dump({'sources': self.entries}, output_file, indent=1, sort_keys=True)
+            os.chmod(output_file.name, FILE_MODE)
+            os.replace(output_file.name, self.filename)
@@ -1,8 +1,12 @@
 import os
+import sys
 import re
+import json
+import time
 import logging
 import subprocess
 import sqlite3
+import zlib
 
 from functions import find_binary_in_path, get_language
 from command import RunCommand
@@ -10,20 +14,22 @@ from job_queue import QueueItem
 from exceptions import MissingDependencyError, MkvExportError
 
 class supTrackExporter:
-    def __init__(self, queue, next_queue, mode, working_dir, language, logger):
+    def __init__(self, mode, working_dir, language, logger, queue=None, next_queue=None, demuxer='mkvextract'):
         self.logger = logger
+        self.demuxer = demuxer
         self.working_dir = f"{os.path.join(working_dir, 'tracks')}"
         self.queue = queue
         self.next_queue = next_queue
         self.mode = mode
         self.language = language
         self.mkvinfo_bin = find_binary_in_path('mkvinfo')
+        self.mkvmerge_bin = find_binary_in_path('mkvmerge')
         self.mkvextract_bin = find_binary_in_path('mkvextract')
-        self.cmd = RunCommand()
+        self.cmd = RunCommand(logger=self.logger)
 
         self.field_map = {
-            "start_tracks": r'^\|\+ Tracks$',
-            "start_track": r'^\|.*Track$',
+            "start_tracks": re.compile(r'^\|\+ Tracks$'),
+            "start_track": re.compile(r'^\|.*Track$'),
             "fields": {
                 'Track number:': [],
                 'Track type:': ['subtitles'],
@@ -31,14 +37,16 @@ class supTrackExporter:
                 'Language:': [],
                 '"Default track" flag:': ['0', '1']
             },
-            "end_track": r'^\| \+ EBML void:.*$'
+            "end_track": re.compile(r'^\| \+ EBML void:.*$')
         }
 
-        if not self.mkvinfo_bin:
-            raise MissingDependencyError(f"'mkvinfo' binary was not found in PATH")
+        # the native demuxer identifies the tracks itself when MKVToolNix is missing
+        if self.demuxer == 'mkvextract':
+            if not self.mkvmerge_bin and not self.mkvinfo_bin:
+                raise MissingDependencyError(f"'mkvmerge' or 'mkvinfo' binary was not found in PATH")
 
-        if not self.mkvextract_bin:
-            raise MissingDependencyError(f"'mkviextract' binary was not found in PATH")
+            if not self.mkvextract_bin:
+                raise MissingDependencyError(f"'mkviextract' binary was not found in PATH")
 
         # create the working directory
         if not os.path.isdir(self.working_dir):
@@ -47,48 +55,82 @@ class supTrackExporter:
         # Get valid language codes
         for code in self.language:
             lang = get_language(code)
-            for prop in ['pt1', 'pt2b']:
+            for prop in ['pt1', 'pt2b', 'pt2t']:
                 prop_code = getattr(lang, prop)
-                if prop_code not in self.field_map['fields']['Language:']:
+                if prop_code and prop_code not in self.field_map['fields']['Language:']:
                     self.logger.info(f"Adding language: {lang.name} ({prop_code}) to track filter")
                     self.field_map['fields']['Language:'].append(prop_code)
 
+    def run(self):
+        """ Processes every job in the queue, putting the exported tracks on the next queue """
         while not self.queue.empty():
             job_item = self.queue.get()
-            
-            if os.path.isdir(f"{job_item}"):
-                # This is a directory we need to find the mkv file(s)
-                self.logger.debug("Directory passed in.")
-                mkv_dir = job_item.input_file
-                mkv_files = [f for f in os.listdir(job_item.input_file) if f.lower().endswith('.mkv')]
-                if len(mkv_files) == 0:
-                    raise ConverterError(f"No mkv files found in {job_item}")
-                elif len(mkv_files) > 1:
-                    # Prompt the user to select one of the found files
-                    job_item.input_file = self.prompt_user_to_select(
-                        mkv_files,
-                        header="- Multiple MKV Files found -"
-                        )
-                
-                else:
-                    job_item.input_file = f"{mkv_files[0]}"
-            
-                # append the input_path to the infout file
-                job_item.input_file = os.path.join(mkv_dir, job_item.input_file)
-                # self.queue.task_done()
-                # continue
-
-            # execute the export job
-            out_files = self.export(job_item)
-
-            self.logger.info(f"Finished exporting tracks from '{job_item}'")
+            for next_item in self.process(job_item):
+                self.next_queue.put(next_item)
             self.queue.task_done()
-            # Add the jobs to the next queue
-            for out_file in out_files:
-                self.next_queue.put(QueueItem(input_file=out_file, output_path=job_item.output_path))
 
+    def process(self, job_item):
+        """
+        Exports the subtitle tracks of an MKV file.
+
+        :param job_item: The QueueItem of an MKV file or a directory containing one
+        :return: A list of QueueItems of the exported SUP files, or with the native
+                 demuxer a single QueueItem of the MKV file and its selected tracks
+        """
+        if os.path.isdir(f"{job_item}"):
+            # This is a directory we need to find the mkv file(s)
+            self.logger.debug("Directory passed in.")
+            mkv_dir = job_item.input_file
+            mkv_files = [f for f in os.listdir(job_item.input_file) if f.lower().endswith('.mkv')]
+            if len(mkv_files) == 0:
+                raise MkvExportError(f"No mkv files found in {job_item}")
+            elif len(mkv_files) > 1:
+                # Prompt the user to select one of the found files
+                job_item.input_file = self.prompt_user_to_select(
+                    mkv_files,
+                    header="- Multiple MKV Files found -"
+                    )
+
+            else:
+                job_item.input_file = f"{mkv_files[0]}"
+
+            # append the input_path to the infout file
+            job_item.input_file = os.path.join(mkv_dir, job_item.input_file)
+
+        if self.demuxer == 'native':
+            # the OCR stage demuxes the tracks straight from the MKV file
+            subtitle_tracks = self.select_tracks(job_item)
+            if not subtitle_tracks:
+                return []
+            return [QueueItem(
+                input_file=job_item.input_file, output_path=job_item.output_path,
+                source_file=job_item.source_file, tracks=subtitle_tracks
+            )]
+
+        # execute the export job
+        out_files = self.export(job_item)
+
+        self.logger.info(f"Finished exporting tracks from '{job_item}'")
+        # Add the jobs to the next queue
+        return [
+            QueueItem(input_file=out_file, output_path=job_item.output_path, source_file=job_item.source_file, language=track.language)
+            for out_file, track in out_files.items()
+        ]
+
+
+    def version(self):
+        """ The version of the MKVToolNix tools the tracks are extracted with, or 'native' """
+        if self.demuxer == 'native':
+            return 'native'
+        return_code, output, _ = self.cmd.run_command_return_output(
+            command=[self.mkvextract_bin, "--version"]
+        )
+        return output.strip().splitlines()[0] if output.strip() else 'unknown'
 
     def prompt_user_to_select(self, options, header=None):
+        if not sys.stdin.isatty():
+            raise MkvExportError(f"{header or 'Multiple options found'}: use --batch to convert all of them.")
+
         # Display the options to the user
         print("\n\n")
         if header:
@@ -117,12 +159,67 @@ class supTrackExporter:
         return {parts.pop(0): ': '.join(parts).strip()}
 
 
-    def export(self, job_item):
-        self.sup_filename = f"{os.path.join(self.working_dir, 'subtitles.sup')}"
-        self.logger.info(f"Extracting subtitle tracks from '{os.path.basename(job_item.input_file)}'")
-        self.logger.info(f"Filtering tracks by language(s): {', '.join(self.language)}")
+    def identify(self, job_item):
+        """
+        Finds the subtitle tracks to extract with 'mkvmerge -J', which only
+        reads the file headers and reports the tracks as JSON.
 
-        
+        :param job_item: The QueueItem of the MKV file
+        :return: A list of mkvTrack objects
+        """
+        return_code, mkvmerge_result, return_error = self.cmd.run_command_return_output(
+            command=[self.mkvmerge_bin, "-J", f"{job_item.input_file}"]
+        )
+        # mkvmerge exits with 1 for warnings
+        if return_code > 1:
+            raise MkvExportError(f"{mkvmerge_result} {return_error}")
+
+        try:
+            identification = json.loads(mkvmerge_result)
+        except ValueError as e:
+            raise MkvExportError(f"Invalid mkvmerge identification output: {e}")
+        return self.filter_tracks(identification.get('tracks', []), job_item.input_file)
+
+    def identify_native(self, job_item):
+        """
+        Finds the subtitle tracks to extract by reading the Tracks element
+        of the MKV file directly. This is the fallback when MKVToolNix is
+        not installed.
+
+        :param job_item: The QueueItem of the MKV file
+        :return: A list of mkvTrack objects
+        """
+        with mkvDemuxer(job_item.input_file) as demuxer:
+            return self.filter_tracks(demuxer.tracks(), job_item.input_file)
+
+    def filter_tracks(self, track_infos, mkv_filename):
+        """
+        Selects the subtitle tracks with a supported codec and language.
+
+        :param track_infos: The track dicts in the 'mkvmerge -J' layout
+        :param mkv_filename: The MKV filename
+        :return: A list of mkvTrack objects
+        """
+        subtitle_tracks = []
+        languages = self.field_map['fields']['Language:']
+        for track_info in track_infos:
+            track = mkvTrack.from_mkvmerge(track_info, mkv_filename=mkv_filename)
+            if track.type != 'subtitles' or track.codec not in self.field_map['fields']['Codec ID:']:
+                continue
+            if track.language not in languages and track.language_ietf not in languages:
+                continue
+            self.logger.debug(f"Saving track: {track.filename}")
+            subtitle_tracks.append(track)
+        return subtitle_tracks
+
+    def parse_mkvinfo(self, job_item):
+        """
+        Finds the subtitle tracks to extract by parsing the 'mkvinfo' dump.
+        This is the fallback when mkvmerge is not installed.
+
+        :param job_item: The QueueItem of the MKV file
+        :return: A list of mkvTrack objects
+        """
         # Run mkvinfo to get all the subtitle tracks
         return_code, mkvinfo_result, return_error = self.cmd.run_command_return_output(
             command=[self.mkvinfo_bin, f"{job_item.input_file}"]
@@ -140,7 +237,7 @@ class supTrackExporter:
         # extract the subtitle tracks with the specified language
         for line in mkvinfo_result.splitlines():
             # Detect the beginning of the tracks section
-            if re.fullmatch(self.field_map['start_tracks'], line.strip()):
+            if self.field_map['start_tracks'].fullmatch(line.strip()):
                 in_tracks = True
                 continue
 
@@ -148,19 +245,21 @@ class supTrackExporter:
                 continue        
 
             # Detect the beginning of a track
-            if re.fullmatch(self.field_map['start_track'], line.strip()):
+            if self.field_map['start_track'].fullmatch(line.strip()):
                 in_track = True
                 subtitle_track = {}
                 continue
 
             # Detect the end of a track
-            if re.fullmatch(self.field_map['end_track'], line.strip()) and in_track:
+            if self.field_map['end_track'].fullmatch(line.strip()) and in_track:
                 in_track = False
                 if len(subtitle_track) > 0:
                     # create the track object
                     track = mkvTrack(track_info=subtitle_track, mkv_filename=job_item.input_file)
-                    self.logger.debug(f"Saving track: {track.filename}")
-                    subtitle_tracks.append(track)
+                    # only the allowed codecs are recorded
+                    if track.codec:
+                        self.logger.debug(f"Saving track: {track.filename}")
+                        subtitle_tracks.append(track)
                 continue
 
             # Set all the track fields
@@ -178,27 +277,67 @@ class supTrackExporter:
                         else:
                             # an empty list means any value is accepted
                             subtitle_track.update(line_dict)
-         
+
+        return subtitle_tracks
+
+    def select_tracks(self, job_item):
+        """
+        Identifies the MKV file's tracks and selects the ones to convert.
+
+        :param job_item: The QueueItem of the MKV file
+        :return: A list of mkvTrack objects
+        """
+        self.logger.info(f"Extracting subtitle tracks from '{os.path.basename(job_item.input_file)}'")
+        self.logger.info(f"Filtering tracks by language(s): {', '.join(self.language)}")
+
+        start = time.monotonic()
+        if self.mkvmerge_bin:
+            subtitle_tracks = self.identify(job_item)
+        elif self.mkvinfo_bin:
+            subtitle_tracks = self.parse_mkvinfo(job_item)
+        else:
+            subtitle_tracks = self.identify_native(job_item)
+        self.logger.debug(f"Found the tracks of '{os.path.basename(job_item.input_file)}' in {(time.monotonic() - start) * 1000:.0f}ms")
+
         self.logger.info(f"Found {len(subtitle_tracks)} subtitle track(s) to extract.")
         if self.mode == 'first':
             self.logger.info("Exporting only the first track in order.")
+            subtitle_tracks = subtitle_tracks[:1]
+        return subtitle_tracks
 
-        sup_filenames = []
+    def export(self, job_item):
+        """
+        Extracts the selected subtitle tracks of an MKV file to SUP files.
+
+        :param job_item: The QueueItem of an MKV file
+        :return: A dict of the mkvTrack of each SUP filename
+        """
+        self.sup_filename = f"{os.path.join(self.working_dir, 'subtitles.sup')}"
+        subtitle_tracks = self.select_tracks(job_item)
+        if not subtitle_tracks:
+            return {}
+
+        # extract every selected track in a single pass over the MKV file
+        sup_filenames = {}
+        cmd = [self.mkvextract_bin, 'tracks', f'{job_item.input_file}']
         for track in subtitle_tracks:
             self.logger.info(f"Extracting Track: id:{track.id}, default: {track.default}, language:{track.language}, codec: {track.codec} file:'{track.filename}'")
-            # execute mkvextract to get extract the subtitle tracks
             sup_filename = f'{os.path.join(job_item.output_path, track.filename)}'
-            cmd = [
-                self.mkvextract_bin,
-                'tracks',
-                f'{job_item.input_file}',
-                f'{track.id}:{sup_filename}'
-            ]
-            self.cmd.run_command_with_scroll_window(cmd, header=[f"mkvextract: extracting subtitle track: {track.id}"])
-            sup_filenames.append(sup_filename)
-            if self.mode == 'first':
-                break
-
+            cmd.append(f'{track.id}:{sup_filename}')
+            sup_filenames[sup_filename] = track
+
+        track_ids = ', '.join(track.id for track in subtitle_tracks)
+        start = time.monotonic()
+        self.cmd.run_command_with_scroll_window(cmd, header=[f"mkvextract: extracting subtitle track(s): {track_ids}"])
+        elapsed = time.monotonic() - start
+
+        # Every extra mkvextract call would have read the whole file again
+        read_bytes = os.path.getsize(job_item.input_file)
+        extra_passes = len(subtitle_tracks) - 1
+        self.logger.info(
+            f"Extracted {len(subtitle_tracks)} track(s) in one pass: read {read_bytes / 1024 ** 2:.1f} MB in {elapsed:.1f}s"
+            + (f", saved ~{read_bytes * extra_passes / 1024 ** 2:.1f} MB of reads and ~{elapsed * extra_passes:.1f}s" if extra_passes else "")
+        )
         return sup_filenames
 
 class mkvTrack:
@@ -220,6 +359,8 @@ class mkvTrack:
         self.language = None
         self.default = None
         self.codec = None
+        self.language_ietf = None
+        self.track_number = None
         self.ext = "ukn"
         
 
@@ -234,6 +375,27 @@ class mkvTrack:
 
         self.filename = self.__set_track_filename__()
 
+    @classmethod
+    def from_mkvmerge(cls, track_info, mkv_filename):
+        """
+        Creates a track from an entry of the 'mkvmerge -J' tracks list.
+
+        :param track_info: The track dict from the mkvmerge JSON
+        :param mkv_filename: The MKV filename
+        :return: An mkvTrack object
+        """
+        track = cls(track_info={}, mkv_filename=mkv_filename)
+        properties = track_info.get('properties', {})
+        track.type = track_info.get('type')
+        track.id = f"{track_info['id']}"
+        track.track_number = properties.get('number')
+        track.language = properties.get('language')
+        track.language_ietf = properties.get('language_ietf')
+        track.default = bool(properties.get('default_track'))
+        track.__set_codec_ext__('Codec ID', properties.get('codec_id', ''))
+        track.filename = track.__set_track_filename__()
+        return track
+
     @property
     def ending(self):
         return f"{self.language}.{self.ext}"
@@ -247,9 +409,12 @@ class mkvTrack:
         # See if there is an ID for mkvextract
         print(f"'{field}' = '{value}'")
         mkey = "mkvextract:"
+        number = re.match(r'\d+', value)
+        if number:
+            self.track_number = int(number.group(0))
         if mkey in value:
             value_parts = value.split(mkey)
-            self.id = value_parts[-1].strip()[0]
+            self.id = re.match(r'\d+', value_parts[-1].strip()).group(0)
 
     def __set_codec_ext__(self, field, value):
         if value in self.CODEC_MAP.keys():
@@ -260,4 +425,335 @@ class mkvTrack:
         self.type = value
 
     def __set_default__(self, field, value):
-        self.default = True if int(value) == 1 else False
\ No newline at end of file
+        self.default = True if int(value) == 1 else False
+
+class mkvDemuxer:
+    """
+    A minimal Matroska reader that streams the blocks of selected tracks.
+
+    Only the EBML element headers are parsed on the way: the Tracks element
+    is read for the track list, and the payloads of blocks that belong to
+    other tracks (video, audio) are skipped with a seek, so the memory use
+    does not depend on the file size.
+    """
+    # EBML element IDs
+    EBML = 0x1A45DFA3
+    SEGMENT = 0x18538067
+    SEEK_HEAD = 0x114D9B74
+    SEEK = 0x4DBB
+    SEEK_ID = 0x53AB
+    SEEK_POSITION = 0x53AC
+    INFO = 0x1549A966
+    TIMESTAMP_SCALE = 0x2AD7B1
+    TRACKS = 0x1654AE6B
+    TRACK_ENTRY = 0xAE
+    TRACK_NUMBER = 0xD7
+    TRACK_TYPE = 0x83
+    CODEC_ID = 0x86
+    LANGUAGE = 0x22B59C
+    LANGUAGE_BCP47 = 0x22B59D
+    FLAG_DEFAULT = 0x88
+    CONTENT_ENCODINGS = 0x6D80
+    CONTENT_ENCODING = 0x6240
+    CONTENT_COMPRESSION = 0x5034
+    CONTENT_COMP_ALGO = 0x4254
+    CONTENT_COMP_SETTINGS = 0x4255
+    CLUSTER = 0x1F43B675
+    TIMESTAMP = 0xE7
+    SIMPLE_BLOCK = 0xA3
+    BLOCK_GROUP = 0xA0
+    BLOCK = 0xA1
+    CUES = 0x1C53BB6B
+    CUE_POINT = 0xBB
+    CUE_TRACK_POSITIONS = 0xB7
+    CUE_TRACK = 0xF7
+    CUE_CLUSTER_POSITION = 0xF1
+
+    # Elements that may follow a Cluster of unknown size
+    TOP_LEVEL = {SEEK_HEAD, INFO, TRACKS, CLUSTER, CUES, 0x1941A469, 0x1043A770, 0x1254C367}
+    TRACK_TYPES = {1: 'video', 2: 'audio', 17: 'subtitles'}
+
+    def __init__(self, filename, use_cues=True):
+        """
+        :param filename: The MKV filename, or a seekable binary stream of an MKV file
+        :param use_cues: Only visit the clusters the Cues index for the selected tracks,
+                         when the index has entries for them. mkvmerge indexes every
+                         subtitle block, but other muxers may only index video frames.
+        """
+        self.use_cues = use_cues
+        # a stream handed in is left open for its owner
+        self.owns_stream = isinstance(filename, (str, os.PathLike))
+        self.stream = open(filename, 'rb') if self.owns_stream else filename
+        self.filename = filename if self.owns_stream else getattr(filename, 'name', '<stream>')
+        self.size = self.stream.seek(0, os.SEEK_END)
+        self.stream.seek(0)
+        self.timestamp_scale = 1000000
+        self.track_entries = []
+        self.segment_start = None
+        self.segment_end = None
+        self.first_cluster = None
+        self.cues_position = None
+        self.read_headers()
+
+    def close(self):
+        if self.owns_stream:
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_vint(self, keep_marker=False):
+        first = self.stream.read(1)
+        if not first:
+            return None, 0
+        length = 1
+        mask = 0x80
+        while length <= 8 and not first[0] & mask:
+            mask >>= 1
+            length += 1
+        if length > 8:
+            raise MkvExportError(f"Invalid EBML data at offset {self.stream.tell() - 1}")
+        value = first[0] if keep_marker else first[0] & (mask - 1)
+        for byte in self.stream.read(length - 1):
+            value = (value << 8) | byte
+        return value, length
+
+    def elements(self, end):
+        """
+        Iterates the child elements up to an end offset. Each element's data
+        is skipped after it was yielded, unless its size is unknown.
+
+        :param end: The end offset, or None to read up to the next top level element
+        :return: A generator of (element_id, data_offset, size) tuples
+        """
+        while end is None or self.stream.tell() < end:
+            offset = self.stream.tell()
+            element_id, _ = self.read_vint(keep_marker=True)
+            if element_id is None:
+                return
+            if end is None and element_id in self.TOP_LEVEL:
+                # the end of an element of unknown size
+                self.stream.seek(offset)
+                return
+            size, length = self.read_vint()
+            if size == (1 << (7 * length)) - 1:
+                size = None
+            start = self.stream.tell()
+            yield element_id, start, size
+            if size is not None:
+                self.stream.seek(start + size)
+
+    def read_uint(self, size):
+        return int.from_bytes(self.stream.read(size), 'big')
+
+    def read_string(self, size):
+        return self.stream.read(size).rstrip(b'\0').decode('utf-8', errors='replace')
+
+    def read_headers(self):
+        """ Reads the segment's Info and Tracks, stopping at the first Cluster """
+        header_id, _ = self.read_vint(keep_marker=True)
+        if header_id != self.EBML:
+            raise MkvExportError(f"Not a Matroska file: '{self.filename}'")
+        size, _ = self.read_vint()
+        self.stream.seek(size, os.SEEK_CUR)
+
+        for element_id, start, size in self.elements(self.size):
+            if element_id == self.SEGMENT:
+                self.segment_start = start
+                self.segment_end = start + size if size is not None else None
+                break
+        if self.segment_start is None:
+            raise MkvExportError(f"No Matroska segment found in '{self.filename}'")
+
+        for element_id, start, size in self.elements(self.segment_end):
+            if element_id == self.SEEK_HEAD:
+                self.read_seek_head(start + size)
+            elif element_id == self.INFO:
+                for child_id, child_start, child_size in self.elements(start + size):
+                    if child_id == self.TIMESTAMP_SCALE:
+                        self.timestamp_scale = self.read_uint(child_size)
+            elif element_id == self.TRACKS:
+                self.read_tracks(start + size)
+            elif element_id == self.CLUSTER:
+                self.first_cluster = start - self.header_size(self.CLUSTER, size)
+                break
+            elif element_id == self.CUES and self.cues_position is None:
+                # like the SeekHead position, the offset of the element header
+                self.cues_position = start - self.header_size(self.CUES, size)
+
+    def header_size(self, element_id, size):
+        # the length of the ID plus the length of the size
+        id_length = (element_id.bit_length() + 7) // 8
+        if size is None:
+            return id_length + 1
+        size_length = 1
+        while size >= (1 << (7 * size_length)) - 1:
+            size_length += 1
+        return id_length + size_length
+
+    def read_seek_head(self, end):
+        for element_id, start, size in self.elements(end):
+            if element_id != self.SEEK:
+                continue
+            seek_id = seek_position = None
+            for child_id, child_start, child_size in self.elements(start + size):
+                if child_id == self.SEEK_ID:
+                    seek_id = self.read_uint(child_size)
+                elif child_id == self.SEEK_POSITION:
+                    seek_position = self.read_uint(child_size)
+            if seek_id == self.CUES and seek_position is not None:
+                self.cues_position = self.segment_start + seek_position
+
+    def read_tracks(self, end):
+        for element_id, start, size in self.elements(end):
+            if element_id != self.TRACK_ENTRY:
+                continue
+            entry = {'number': None, 'type': None, 'codec_id': None, 'language': 'eng',
+                     'language_ietf': None, 'default_track': True, 'compression': None}
+            for child_id, child_start, child_size in self.elements(start + size):
+                if child_id == self.TRACK_NUMBER:
+                    entry['number'] = self.read_uint(child_size)
+                elif child_id == self.TRACK_TYPE:
+                    entry['type'] = self.TRACK_TYPES.get(self.read_uint(child_size))
+                elif child_id == self.CODEC_ID:
+                    entry['codec_id'] = self.read_string(child_size)
+                elif child_id == self.LANGUAGE:
+                    entry['language'] = self.read_string(child_size)
+                elif child_id == self.LANGUAGE_BCP47:
+                    entry['language_ietf'] = self.read_string(child_size)
+                elif child_id == self.FLAG_DEFAULT:
+                    entry['default_track'] = bool(self.read_uint(child_size))
+                elif child_id == self.CONTENT_ENCODINGS:
+                    entry['compression'] = self.read_compression(child_start + child_size)
+            self.track_entries.append(entry)
+
+    def read_compression(self, end):
+        compression = None
+        for element_id, start, size in self.elements(end):
+            if element_id != self.CONTENT_ENCODING:
+                continue
+            for child_id, child_start, child_size in self.elements(start + size):
+                if child_id != self.CONTENT_COMPRESSION:
+                    continue
+                # zlib is the default algorithm
+                compression = {'algo': 0, 'settings': b''}
+                for comp_id, comp_start, comp_size in self.elements(child_start + child_size):
+                    if comp_id == self.CONTENT_COMP_ALGO:
+                        compression['algo'] = self.read_uint(comp_size)
+                    elif comp_id == self.CONTENT_COMP_SETTINGS:
+                        compression['settings'] = self.stream.read(comp_size)
+        return compression
+
+    def tracks(self):
+        """
+        Lists the tracks in the same layout as 'mkvmerge -J', where the
+        track ID is the track's index.
+
+        :return: A list of track dicts
+        """
+        return [
+            {'id': index, 'type': entry['type'], 'properties': {
+                'number': entry['number'], 'codec_id': entry['codec_id'], 'language': entry['language'],
+                'language_ietf': entry['language_ietf'], 'default_track': entry['default_track']}}
+            for index, entry in enumerate(self.track_entries)
+        ]
+
+    def cue_clusters(self, track_numbers):
+        """ Finds the positions of the clusters the Cues index for the tracks """
+        positions = set()
+        self.stream.seek(self.cues_position)
+        for element_id, start, size in self.elements(self.segment_end):
+            if element_id == self.CUES:
+                cues_end = start + size
+                break
+        else:
+            return []
+        for element_id, start, size in self.elements(cues_end):
+            if element_id != self.CUE_POINT:
+                continue
+            for child_id, child_start, child_size in self.elements(start + size):
+                if child_id != self.CUE_TRACK_POSITIONS:
+                    continue
+                track = position = None
+                for cue_id, cue_start, cue_size in self.elements(child_start + child_size):
+                    if cue_id == self.CUE_TRACK:
+                        track = self.read_uint(cue_size)
+                    elif cue_id == self.CUE_CLUSTER_POSITION:
+                        position = self.read_uint(cue_size)
+                if track in track_numbers and position is not None:
+                    positions.add(self.segment_start + position)
+        return sorted(positions)
+
+    def packets(self, track_numbers):
+        """
+        Streams the blocks of the selected tracks.
+
+        :param track_numbers: The Matroska track numbers to read
+        :return: A generator of (track_number, pts, payload) tuples, with the
+                 timestamp converted to the 90kHz PTS clock
+        """
+        track_numbers = set(track_numbers)
+        compression = {entry['number']: entry['compression'] for entry in self.track_entries}
+        if self.first_cluster is None:
+            return
+
+        clusters = None
+        if self.use_cues and self.cues_position is not None:
+            clusters = self.cue_clusters(track_numbers) or None
+
+        if clusters is None:
+            self.stream.seek(self.first_cluster)
+            for element_id, start, size in self.elements(self.segment_end):
+                if element_id == self.CLUSTER:
+                    yield from self.cluster_packets(start, size, track_numbers, compression)
+        else:
+            for position in clusters:
+                self.stream.seek(position)
+                for element_id, start, size in self.elements(self.segment_end):
+                    if element_id == self.CLUSTER:
+                        yield from self.cluster_packets(start, size, track_numbers, compression)
+                    break
+
+    def cluster_packets(self, start, size, track_numbers, compression):
+        cluster_timestamp = 0
+        end = start + size if size is not None else None
+        for element_id, child_start, child_size in self.elements(end):
+            if element_id == self.TIMESTAMP:
+                cluster_timestamp = self.read_uint(child_size)
+            elif element_id == self.SIMPLE_BLOCK:
+                packet = self.read_block(child_start + child_size, cluster_timestamp, track_numbers, compression)
+                if packet:
+                    yield packet
+            elif element_id == self.BLOCK_GROUP:
+                for group_id, group_start, group_size in self.elements(child_start + child_size):
+                    if group_id == self.BLOCK:
+                        packet = self.read_block(group_start + group_size, cluster_timestamp, track_numbers, compression)
+                        if packet:
+                            yield packet
+
+    def read_block(self, end, cluster_timestamp, track_numbers, compression):
+        # read only the track number of other tracks' blocks
+        track_number, _ = self.read_vint()
+        if track_number not in track_numbers:
+            return None
+        header = self.stream.read(3)
+        timestamp = cluster_timestamp + int.from_bytes(header[:2], 'big', signed=True)
+        if header[2] & 0x06:
+            raise MkvExportError(f"Laced blocks are not supported for track {track_number}")
+        payload = self.stream.read(end - self.stream.tell())
+
+        settings = compression.get(track_number)
+        if settings:
+            if settings['algo'] == 0:
+                payload = zlib.decompress(payload)
+            elif settings['algo'] == 3:
+                # header stripping
+                payload = settings['settings'] + payload
+            else:
+                raise MkvExportError(f"Unsupported compression algorithm {settings['algo']} for track {track_number}")
+
+        pts = timestamp * self.timestamp_scale * 9 // 100000
+        return track_number, pts, payload
@@ -0,0 +1,350 @@
+import time
+import importlib.util
+from functions import get_language
+from exceptions import ArgumentError, MissingDependencyError
+
+# Characters tesseract is allowed to recognize in English subtitle text
+CHAR_WHITELIST = r"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789♪♩♫♬,.`~[](){}!@#$%^&*<>?+:-_/\ \n"
+
+# The traineddata names that are not the ISO 639-2/T code of their language
+TRAINEDDATA = {
+    'zho': 'chi_sim',
+}
+
+
+def ocr_language(code):
+    """
+    Maps a track or --language code to the name of its tesseract traineddata.
+
+    :param code: An ISO 639-1 or 639-2 language code, e.g. 'de', 'ger' or 'deu'
+    :return: The traineddata name, e.g. 'deu', or None for an undetermined or invalid language
+    """
+    if not code or code in ('und', 'mul', 'zxx'):
+        return None
+    try:
+        language = get_language(code).pt2t or code
+    except ArgumentError:
+        return None
+    return TRAINEDDATA.get(language, language)
+
+
+def ocr_languages(codes):
+    """
+    Maps several --language codes to a tesseract model combining their
+    traineddata, which recognizes text in any of the languages.
+
+    :param codes: A list of ISO 639 language codes, e.g. ['eng', 'ger']
+    :return: The traineddata names joined with '+', e.g. 'eng+deu', or None when no code is a valid language
+    """
+    names = []
+    for code in codes:
+        name = ocr_language(code)
+        if name and name not in names:
+            names.append(name)
+    return '+'.join(names) or None
+
+
+class OcrEngine:
+    """
+    Base class for the OCR engines.
+
+    An engine is created once per (worker) process and reused for every
+    subtitle image. Images are passed in as 8-bit grayscale NumPy arrays.
+    """
+    name = None
+
+    def __init__(self, language='eng', oem=3, psm=6, whitelist=CHAR_WHITELIST):
+        self.language = language
+        self.oem = oem
+        self.psm = psm
+        self.whitelist = whitelist
+
+    @property
+    def config(self):
+        """ The tesseract command line options for this engine """
+        config = f"--oem {self.oem} --psm {self.psm}"
+        if self.whitelist:
+            config += f" -c tessedit_char_whitelist='{self.whitelist}'"
+        return config
+
+    def recognize(self, image):
+        """
+        OCR scans an image.
+
+        :param image: The image, as a 2-dimensional uint8 NumPy array
+        :return: The recognized text
+        """
+        raise NotImplementedError
+
+    def recognize_lines(self, image):
+        """
+        OCR scans an image and reports where each text line was found.
+
+        :param image: The image, as a 2-dimensional uint8 NumPy array
+        :return: A list of (top, bottom, text) tuples, one per text line
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def version():
+        """ The version of the engine's tesseract library """
+        raise NotImplementedError
+
+
+class PytesseractEngine(OcrEngine):
+    """ Runs one tesseract process per image through pytesseract """
+    name = 'pytesseract'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        import pytesseract
+        self.pytesseract = pytesseract
+        # tesseract is started per image, so only check that it and the model are installed
+        try:
+            languages = pytesseract.get_languages()
+        except (pytesseract.TesseractNotFoundError, pytesseract.TesseractError) as e:
+            raise MissingDependencyError(f"tesseract is not usable: {str(e).strip()}")
+        # a combined model like 'eng+deu' needs the traineddata of each language
+        missing = [name for name in self.language.split('+') if name not in languages]
+        if missing:
+            raise MissingDependencyError(f"The tesseract '{'+'.join(missing)}' traineddata is not installed.")
+
+    def recognize(self, image):
+        return self.pytesseract.image_to_string(image, lang=self.language, config=self.config).strip()
+
+    @staticmethod
+    def version():
+        import pytesseract
+        return f"tesseract {pytesseract.get_tesseract_version()}"
+
+    def recognize_lines(self, image):
+        data = self.pytesseract.image_to_data(
+            image, lang=self.language, config=self.config, output_type=self.pytesseract.Output.DICT
+        )
+        # group the words by the line they were found on
+        lines = {}
+        for index, text in enumerate(data['text']):
+            if not text.strip():
+                continue
+            key = (data['block_num'][index], data['par_num'][index], data['line_num'][index])
+            top, bottom = data['top'][index], data['top'][index] + data['height'][index]
+            line = lines.setdefault(key, [top, bottom, []])
+            line[0], line[1] = min(line[0], top), max(line[1], bottom)
+            line[2].append(text)
+        return [(top, bottom, ' '.join(words)) for top, bottom, words in lines.values()]
+
+
+class TesserocrEngine(OcrEngine):
+    """ Keeps the tesseract model loaded in-process through the tesserocr C-API binding """
+    name = 'tesserocr'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            from tesserocr import PyTessBaseAPI
+        except ImportError:
+            raise MissingDependencyError("The 'tesserocr' python module is not installed.")
+
+        try:
+            self.api = PyTessBaseAPI(lang=self.language, oem=self.oem, psm=self.psm)
+        except RuntimeError:
+            raise MissingDependencyError(f"The tesseract '{self.language}' traineddata is not installed.")
+        if self.whitelist:
+            self.api.SetVariable('tessedit_char_whitelist', self.whitelist)
+
+    def recognize(self, image):
+        import numpy as np
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        # hand the buffer straight to tesseract, without an image file
+        self.api.SetImageBytes(image.tobytes(), width, height, 1, width)
+        return self.api.GetUTF8Text().strip()
+
+    def recognize_lines(self, image):
+        import numpy as np
+        from tesserocr import RIL, iterate_level
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        self.api.SetImageBytes(image.tobytes(), width, height, 1, width)
+        self.api.Recognize()
+        lines = []
+        for line in iterate_level(self.api.GetIterator(), RIL.TEXTLINE):
+            text = (line.GetUTF8Text(RIL.TEXTLINE) or '').strip()
+            box = line.BoundingBox(RIL.TEXTLINE)
+            if text and box:
+                lines.append((box[1], box[3], text))
+        return lines
+
+    def close(self):
+        self.api.End()
+
+    @staticmethod
+    def version():
+        import tesserocr
+        return f"tesseract {tesserocr.tesseract_version().split()[1]}"
+
+
+class OcrEnginePool:
+    """
+    The OCR engines of a (worker) process, one per language. An engine is
+    created the first time a track of its language is scanned and is reused
+    for every later track of that language, so tracks of several languages
+    share the worker processes without reloading a model per file.
+
+    The character whitelist only fits English, every other language is
+    recognized with the full character set of its model.
+    """
+    def __init__(self, engine='pytesseract', **options):
+        """
+        :param engine: The engine name, one of ENGINES or 'auto'
+        :param options: Extra OcrEngine options, e.g. oem and psm
+        """
+        self.engine = engine
+        self.options = options
+        self.engines = {}
+        # the name and version of each engine type, which pytesseract looks up by running tesseract
+        self.versions = {}
+        # the [load, recognize] seconds of each language since the last drain
+        self.timings = {}
+
+    def get(self, language='eng'):
+        """
+        The engine of a language, loading its model on first use.
+
+        :param language: The traineddata name, see ocr_language()
+        :return: An OcrEngine instance
+        """
+        if language not in self.engines:
+            start = time.perf_counter()
+            whitelist = CHAR_WHITELIST if language == 'eng' else None
+            self.engines[language] = create_engine(self.engine, language=language, whitelist=whitelist, **self.options)
+            self.timings.setdefault(language, [0.0, 0.0])[0] += time.perf_counter() - start
+        return self.engines[language]
+
+    def engine_id(self, engine):
+        """
+        The name and version of an engine, e.g. for the OCR cache keys.
+
+        :param engine: An OcrEngine instance of this pool
+        :return: A string like 'tesserocr tesseract 5.3.0'
+        """
+        if engine.name not in self.versions:
+            try:
+                self.versions[engine.name] = f"{engine.name} {engine.version()}"
+            except Exception:
+                self.versions[engine.name] = f"{engine.name} unknown"
+        return self.versions[engine.name]
+
+    def record(self, language, seconds):
+        """ Adds to the recognition time of a language """
+        self.timings.setdefault(language, [0.0, 0.0])[1] += seconds
+
+    def drain_timings(self):
+        """
+        Takes the load and recognition times, e.g. to send them from a worker
+        process to the main process.
+
+        :return: A dict of (load, recognize) seconds by language
+        """
+        timings, self.timings = self.timings, {}
+        return {language: tuple(seconds) for language, seconds in timings.items()}
+
+    def close(self):
+        for engine in self.engines.values():
+            engine.close()
+        self.engines = {}
+
+
+class OcrPage:
+    """
+    Stacks several subtitle images into one page, so the engine's fixed
+    per-call cost of layout analysis is paid once for all of them.
+
+    The images are placed below each other with a blank gap the height of
+    the tallest image, and the recognized lines are mapped back to their
+    image by their vertical position. Each image owns the page area up to
+    the middle of the gaps around it, and a line crossing into the area of
+    another image is ambiguous.
+    """
+    def __init__(self, images, margin=16, background=255):
+        """
+        :param images: The preprocessed images, dark text on a light background
+        :param margin: The blank border around the page in pixels
+        :param background: The page background level
+        """
+        import numpy as np
+        self.gap = max(32, max(image.shape[0] for image in images))
+        width = max(image.shape[1] for image in images) + 2 * margin
+        height = sum(image.shape[0] for image in images) + self.gap * (len(images) - 1) + 2 * margin
+
+        self.image = np.full((height, width), background, dtype=np.uint8)
+        self.slots = []
+        top = margin
+        for image in images:
+            self.image[top:top + image.shape[0], margin:margin + image.shape[1]] = image
+            self.slots.append((top, top + image.shape[0]))
+            top += image.shape[0] + self.gap
+
+    def slot(self, y):
+        """ Finds the image whose area holds a page row """
+        for index, (top, bottom) in enumerate(self.slots):
+            if y < bottom + self.gap // 2:
+                return index
+        return len(self.slots) - 1
+
+    def assign(self, lines):
+        """
+        Maps recognized lines back to the images.
+
+        :param lines: A list of (top, bottom, text) tuples of the page
+        :return: A list with the text of each image, None where the mapping is ambiguous
+        """
+        texts = [[] for _ in self.slots]
+        ambiguous = set()
+        for top, bottom, text in lines:
+            first, last = self.slot(top), self.slot(bottom - 1)
+            if first != last:
+                ambiguous.update(range(first, last + 1))
+                continue
+            texts[first].append((top, text))
+        # an image without any line may have been merged into a neighbour's line
+        return [
+            None if index in ambiguous or not found else '\n'.join(text for _, text in sorted(found))
+            for index, found in enumerate(texts)
+        ]
+
+
+ENGINES = {
+    'tesserocr': {'class': TesserocrEngine, 'module': 'tesserocr',
+                  'description': "In-process tesseract C-API, the model stays loaded."},
+    'pytesseract': {'class': PytesseractEngine, 'module': 'pytesseract',
+                    'description': "One tesseract process per subtitle image."}
+}
+
+
+def resolve_engine(name):
+    """
+    Resolves an engine name, picking the first installed engine for 'auto'.
+
+    :param name: The engine name or 'auto'
+    :return: The name of the engine to use
+    """
+    if name != 'auto':
+        return name
+    for engine, metadata in ENGINES.items():
+        if importlib.util.find_spec(metadata['module']):
+            return engine
+    raise MissingDependencyError("No OCR engine is installed.")
+
+
+def create_engine(name, **kwargs):
+    """
+    Creates an OCR engine.
+
+    :param name: The engine name, one of ENGINES or 'auto'
+    :return: An OcrEngine instance
+    """
+    return ENGINES[resolve_engine(name)]['class'](**kwargs)
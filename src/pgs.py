@@ -0,0 +1,471 @@
+import os
+import io
+import mmap
+import struct
+import numpy as np
+from exceptions import SupConverterError
+
+# PGS segment types
+SEGMENT_PDS = 0x14  # Palette Definition Segment
+SEGMENT_ODS = 0x15  # Object Definition Segment
+SEGMENT_PCS = 0x16  # Presentation Composition Segment
+SEGMENT_WDS = 0x17  # Window Definition Segment
+SEGMENT_END = 0x80  # End of Display Set Segment
+
+# PCS composition states
+EPOCH_START = 0x80
+ACQUISITION_POINT = 0x40
+
+# PTS/DTS clock rate
+PTS_RATE = 90000
+
+# Display time of a caption that is never cleared (5 seconds)
+DEFAULT_DURATION = 5 * PTS_RATE
+
+SEGMENT_HEADER = struct.Struct('>2sIIBH')
+
+# A display set of a SUP file index: the byte range from its PCS to its END
+# segment, its PTS, whether it starts an epoch and its number of objects
+DISPLAY_SET = np.dtype([
+    ('offset', '<u8'), ('end', '<u8'), ('pts', '<u4'), ('epoch_start', '?'), ('objects', 'u1')
+])
+
+
+def read_sup_segments(stream):
+    """
+    Reads the segments of a SUP (PGS) stream.
+
+    :param stream: A binary file object positioned at the start of a segment
+    :return: A generator of (pts, segment_type, payload) tuples
+    """
+    while True:
+        header = stream.read(SEGMENT_HEADER.size)
+        if len(header) < SEGMENT_HEADER.size:
+            return
+        magic, pts, dts, segment_type, size = SEGMENT_HEADER.unpack(header)
+        if magic != b'PG':
+            raise SupConverterError(f"Invalid PGS segment header at offset {stream.tell() - SEGMENT_HEADER.size}")
+        payload = stream.read(size)
+        if len(payload) < size:
+            raise SupConverterError("Unexpected end of PGS stream.")
+        yield pts, segment_type, payload
+
+
+def split_block_segments(pts, payload):
+    """
+    Splits a Matroska S_HDMV/PGS block into its segments. Matroska stores
+    the segments of a display set without the 'PG' timestamp headers,
+    each block carrying its timestamp instead.
+
+    :param pts: The block timestamp on the 90kHz PTS clock
+    :param payload: The block data
+    :return: A generator of (pts, segment_type, payload) tuples
+    """
+    offset = 0
+    size = len(payload)
+    while offset + 3 <= size:
+        segment_type = payload[offset]
+        length = int.from_bytes(payload[offset + 1:offset + 3], 'big')
+        offset += 3
+        if offset + length > size:
+            raise SupConverterError("Truncated PGS segment in Matroska block.")
+        yield pts, segment_type, payload[offset:offset + length]
+        offset += length
+
+
+def decode_rle(data, width, height):
+    """
+    Decodes a run-length encoded PGS object bitmap.
+
+    A code is a single pixel byte, or a 0 byte followed by a flag byte and
+    up to two more bytes, so where a code starts depends on every code
+    before it. The length of a code starting at each byte is computed at
+    once, the chain of code starts from the first byte is found by pointer
+    doubling, and the codes are then decoded into (color, length) runs and
+    expanded with a single np.repeat into the palette index bitmap.
+
+    :param data: The RLE encoded object data
+    :param width: The object width in pixels
+    :param height: The object height in pixels
+    :return: A (height, width) uint8 array of palette indexes
+    """
+    size = len(data)
+    # the zero padding lets the codes near the end read past it
+    buffer = np.zeros(size + 4, dtype=np.uint8)
+    buffer[:size] = np.frombuffer(data, dtype=np.uint8)
+    first = buffer[:size]
+    flags = buffer[1:size + 1]
+
+    # the length of the code starting at each byte, and where the next one starts
+    code_lengths = np.where(first != 0, 1, 2 + ((flags & 0x40) != 0) + ((flags & 0x80) != 0))
+    following = np.empty(size + 1, dtype=np.intp)
+    following[:size] = np.minimum(np.arange(size) + code_lengths, size)
+    following[size] = size
+
+    # mark the code starts reached from the first byte within 1, 2, 4, ... codes
+    reached = np.zeros(size + 1, dtype=bool)
+    reached[0] = True
+    starts = np.zeros(1, dtype=np.intp)
+    while not reached[size]:
+        reached[following[starts]] = True
+        starts = np.flatnonzero(reached)
+        following = following[following]
+    starts = np.flatnonzero(reached[:size])
+
+    # keep the codes up to the end of the last line
+    escape = first[starts] == 0
+    end_of_line = escape & (flags[starts] == 0)
+    line_ends = np.flatnonzero(end_of_line)
+    if len(line_ends) >= height:
+        count = line_ends[height - 1] + 1 if height else 0
+        starts, escape, end_of_line = starts[:count], escape[:count], end_of_line[:count]
+    if np.any(starts + code_lengths[starts] > size):
+        raise SupConverterError("Truncated PGS object data.")
+
+    flag = flags[starts].astype(np.intp)
+    extended = escape & (flag & 0x40 != 0)
+    lengths = np.where(escape, flag & 0x3F, 1)
+    lengths = np.where(extended, (lengths << 8) | buffer[starts + 2], lengths)
+    colors = np.where(escape & (flag & 0x80 != 0), buffer[starts + 2 + extended], 0)
+    colors = np.where(escape, colors, first[starts])
+
+    # never let a run wrap into the next line, and pad short lines with color 0
+    ends = np.cumsum(lengths)
+    line_starts = np.maximum.accumulate(np.where(end_of_line, ends, 0))
+    line_starts = np.concatenate(([0], line_starts[:-1]))
+    line_end = np.minimum(ends - line_starts, width)
+    line_start = np.minimum(ends - lengths - line_starts, width)
+    lengths = np.where(end_of_line, width - line_end, line_end - line_start)
+
+    pixels = np.repeat(colors.astype(np.uint8), lengths)
+    if pixels.size < width * height:
+        pixels = np.pad(pixels, (0, width * height - pixels.size))
+    return pixels[:width * height].reshape(height, width)
+
+
+def palette_to_gray(entries):
+    """
+    Builds a lookup table that maps palette indexes to gray levels.
+
+    Each entry's luma is scaled to full range and premultiplied by its
+    alpha, so transparent pixels become black like BDSup2Sub's images.
+
+    :param entries: A dict of palette index to (Y, Cr, Cb, Alpha)
+    :return: A 256 entry uint8 lookup table
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    if entries:
+        index = np.fromiter(entries.keys(), dtype=np.intp)
+        values = np.array(list(entries.values()), dtype=np.float32)
+        luma = np.clip((values[:, 0] - 16) * 255 / 219, 0, 255)
+        lut[index] = np.round(luma * values[:, 3] / 255).astype(np.uint8)
+    return lut
+
+
+class PgsDecoder:
+    """
+    Decodes PGS display sets into subtitle events.
+
+    Palettes and objects are kept for the whole epoch, since a display
+    set may reference objects that were defined by an earlier one.
+    """
+    def __init__(self):
+        self.palettes = {}
+        self.objects = {}
+        self.bitmaps = {}
+        self.caption = None
+        self.composition = None
+
+    def decode(self, segments):
+        """
+        Decodes a stream of PGS segments.
+
+        :param segments: An iterable of (pts, segment_type, payload) tuples
+        :return: A generator of (start_pts, end_pts, image) tuples where the image is
+                 a uint8 grayscale array of the composed subtitle
+        """
+        for pts, segment_type, payload in segments:
+            event = self.feed(pts, segment_type, payload)
+            if event:
+                yield event
+        event = self.flush()
+        if event:
+            yield event
+
+    def feed(self, pts, segment_type, payload):
+        """
+        Decodes the next PGS segment. Segments can be pushed one at a time,
+        so several streams can be decoded side by side in a single pass.
+
+        :return: The (start_pts, end_pts, image) tuple of the caption this
+                 segment ended, or None
+        """
+        event = None
+        if segment_type == SEGMENT_PCS:
+            self.composition = self.parse_pcs(pts, payload)
+        elif segment_type == SEGMENT_PDS:
+            self.parse_pds(payload)
+        elif segment_type == SEGMENT_ODS:
+            self.parse_ods(payload)
+        elif segment_type == SEGMENT_END and self.composition:
+            # Each display set replaces whatever is on the screen
+            if self.caption:
+                event = (self.caption[0], self.composition['pts'], self.caption[1])
+                self.caption = None
+            image = self.compose(self.composition)
+            if image is not None:
+                self.caption = (self.composition['pts'], image)
+            self.composition = None
+        return event
+
+    def flush(self):
+        """ Ends the stream, returning the caption that is still on the screen, or None """
+        caption, self.caption = self.caption, None
+        if caption:
+            return caption[0], caption[0] + DEFAULT_DURATION, caption[1]
+        return None
+
+    def parse_pcs(self, pts, payload):
+        width, height, _, number, state, palette_update, palette_id, count = struct.unpack_from('>HHBHBBBB', payload)
+        if state == EPOCH_START:
+            self.palettes = {}
+            self.objects = {}
+            self.bitmaps = {}
+
+        objects = []
+        offset = 11
+        for _ in range(count):
+            object_id, window_id, cropped, x, y = struct.unpack_from('>HBBHH', payload, offset)
+            offset += 8
+            crop = None
+            if cropped & 0x40:
+                crop = struct.unpack_from('>HHHH', payload, offset)
+                offset += 8
+            objects.append({'id': object_id, 'x': x, 'y': y, 'crop': crop})
+
+        return {'pts': pts, 'state': state, 'palette_id': palette_id, 'objects': objects}
+
+    def parse_pds(self, payload):
+        palette_id = payload[0]
+        entries = self.palettes.setdefault(palette_id, {})
+        for offset in range(2, len(payload) - 4, 5):
+            index, luma, cr, cb, alpha = payload[offset:offset + 5]
+            entries[index] = (luma, cr, cb, alpha)
+
+    def parse_ods(self, payload):
+        object_id, _, sequence = struct.unpack_from('>HBB', payload)
+        if sequence & 0x80:
+            # first fragment: data length, width and height precede the data
+            width, height = struct.unpack_from('>HH', payload, 7)
+            self.objects[object_id] = {'width': width, 'height': height, 'data': bytearray(payload[11:])}
+        elif object_id in self.objects:
+            self.objects[object_id]['data'] += payload[4:]
+        self.bitmaps.pop(object_id, None)
+
+    def bitmap(self, object_id):
+        if object_id not in self.bitmaps:
+            obj = self.objects[object_id]
+            self.bitmaps[object_id] = decode_rle(obj['data'], obj['width'], obj['height'])
+        return self.bitmaps[object_id]
+
+    def compose(self, composition):
+        """
+        Composes the objects of a display set into one grayscale image
+        covering their bounding box.
+        """
+        placed = []
+        for item in composition['objects']:
+            if item['id'] not in self.objects:
+                continue
+            bitmap = self.bitmap(item['id'])
+            if item['crop']:
+                x, y, width, height = item['crop']
+                bitmap = bitmap[y:y + height, x:x + width]
+            placed.append((item['x'], item['y'], bitmap))
+        if not placed:
+            return None
+
+        left = min(x for x, _, _ in placed)
+        top = min(y for _, y, _ in placed)
+        right = max(x + bitmap.shape[1] for x, _, bitmap in placed)
+        bottom = max(y + bitmap.shape[0] for _, y, bitmap in placed)
+
+        lut = palette_to_gray(self.palettes.get(composition['palette_id']))
+        image = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        for x, y, bitmap in placed:
+            region = image[y - top:y - top + bitmap.shape[0], x - left:x - left + bitmap.shape[1]]
+            np.maximum(region, lut[bitmap], out=region)
+        return image
+
+
+def read_sup_events(filename, start=0, end=None, end_pts=None):
+    """
+    Decodes the subtitle events of a SUP file, or of a byte range of it
+    that starts at an epoch.
+
+    :param filename: The full path to the SUP file
+    :param start: The offset of the first display set to decode
+    :param end: The offset after the last display set to decode, or None for the end of the file
+    :param end_pts: The PTS of the display set following the range, which ends
+                    the caption still on the screen at the end of the range
+    :return: A generator of (start_pts, end_pts, image) tuples
+    """
+    with open(filename, 'rb') as stream:
+        if start or end is not None:
+            stream.seek(start)
+            stream = io.BytesIO(stream.read(-1 if end is None else end - start))
+        decoder = PgsDecoder()
+        for pts, segment_type, payload in read_sup_segments(stream):
+            event = decoder.feed(pts, segment_type, payload)
+            if event:
+                yield event
+        event = decoder.flush()
+        if event:
+            yield (event[0], end_pts, event[2]) if end_pts is not None else event
+
+
+def decode_sup_range(filename, start, end, end_pts):
+    """ Decodes a byte range of a SUP file into a list of events, e.g. in a worker process """
+    return list(read_sup_events(filename, start, end, end_pts))
+
+
+def index_display_sets(filename):
+    """
+    Scans the segment headers of a SUP file for its display sets, without
+    decoding them. The file is memory-mapped and only the 13 byte headers
+    and the start of each PCS are read, so a feature-length track is
+    indexed in milliseconds.
+
+    :param filename: The full path to the SUP file
+    :return: A DISPLAY_SET array
+    """
+    display_sets = []
+    size = os.path.getsize(filename)
+    if not size:
+        return np.array(display_sets, dtype=DISPLAY_SET)
+    with open(filename, 'rb') as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offset = 0
+        current = None
+        while offset + SEGMENT_HEADER.size <= size:
+            magic, pts, _, segment_type, length = SEGMENT_HEADER.unpack_from(data, offset)
+            if magic != b'PG':
+                raise SupConverterError(f"Invalid PGS segment header at offset {offset}")
+            payload = offset + SEGMENT_HEADER.size
+            if segment_type == SEGMENT_PCS and length >= 11:
+                current = [offset, 0, pts, data[payload + 7] == EPOCH_START, data[payload + 10]]
+            elif segment_type == SEGMENT_END and current:
+                current[1] = payload + length
+                display_sets.append(tuple(current))
+                current = None
+            offset = payload + length
+    return np.array(display_sets, dtype=DISPLAY_SET)
+
+
+class SupIndex:
+    """
+    An index of the display sets of a SUP file, which gives random access
+    to the file: the number of events is known up front, a --limit run
+    only reads the display sets it needs, and long tracks are split into
+    shards at epoch starts, where the decoder state is reset, so the
+    shards can be decoded independently.
+
+    The index is stored as a sidecar file in the cache directory, keyed by
+    the quick hash of the SUP file.
+    """
+    SIDECAR_DIR = 'sup_index'
+
+    def __init__(self, filename, cache_dir=None):
+        """
+        :param filename: The full path to the SUP file
+        :param cache_dir: The directory of the sidecar index files, or None to not store the index
+        """
+        self.filename = filename
+        self.sidecar = None
+        if cache_dir:
+            from manifest import quick_hash
+            self.sidecar = os.path.join(cache_dir, self.SIDECAR_DIR, f"{quick_hash(filename)}.npy")
+        self.display_sets = self.__load__()
+
+    def __load__(self):
+        if self.sidecar and os.path.exists(self.sidecar):
+            try:
+                return np.load(self.sidecar, allow_pickle=False)
+            except (OSError, ValueError):
+                pass
+        display_sets = index_display_sets(self.filename)
+        if self.sidecar:
+            os.makedirs(os.path.dirname(self.sidecar), exist_ok=True)
+            temp_filename = f"{self.sidecar}.{os.getpid()}.npy"
+            np.save(temp_filename, display_sets)
+            os.replace(temp_filename, self.sidecar)
+        return display_sets
+
+    @property
+    def event_count(self):
+        """ The number of display sets that show a caption """
+        return int(np.count_nonzero(self.display_sets['objects']))
+
+    def limit_end(self, events):
+        """
+        The byte range needed to decode the first events of the file.
+
+        :param events: The number of events
+        :return: A tuple of the offset after the display set that ends the
+                 last of the events, or None for the whole file, and the PTS
+                 of the display set following the range, or None
+        """
+        captions = np.flatnonzero(self.display_sets['objects'])
+        if events >= len(captions):
+            return None, None
+        # the caption is ended by the display set following it
+        last = captions[events - 1] + 1
+        if last + 1 >= len(self.display_sets):
+            return None, None
+        return int(self.display_sets['end'][last]), int(self.display_sets['pts'][last + 1])
+
+    def shards(self, count, end=None):
+        """
+        Splits the file at epoch starts into about evenly sized byte ranges.
+
+        :param count: The wanted number of shards
+        :param end: The offset to stop at, e.g. from limit_end()
+        :return: A list of (start, end, end_pts) tuples for read_sup_events()
+        """
+        display_sets = self.display_sets
+        if end is not None:
+            display_sets = display_sets[display_sets['end'] <= end]
+        if not len(display_sets):
+            return [(0, end, None)]
+        epochs = np.flatnonzero(display_sets['epoch_start'])
+        epochs = epochs[epochs > 0]
+        # the epoch starts closest to evenly spaced display set counts
+        targets = np.arange(1, count) * len(display_sets) / count
+        boundaries = sorted({int(epochs[np.abs(epochs - target).argmin()]) for target in targets} if len(epochs) else set())
+
+        shards = []
+        starts = [0, *boundaries]
+        for first, following in zip(starts, [*boundaries, None]):
+            start = 0 if first == 0 else int(display_sets['offset'][first])
+            if following is None:
+                shards.append((start, end, self.__following_pts__(display_sets, end)))
+            else:
+                shards.append((start, int(display_sets['offset'][following]), int(display_sets['pts'][following])))
+        return shards
+
+    def __following_pts__(self, display_sets, end):
+        if end is None:
+            return None
+        following = self.display_sets[self.display_sets['offset'] >= end]
+        return int(following['pts'][0]) if len(following) else None
+
+    def write_range(self, end, filename):
+        """ Writes the start of the SUP file up to an offset, e.g. for BDSup2Sub to convert only that part """
+        with open(self.filename, 'rb') as source, open(filename, 'wb') as target:
+            remaining = end
+            while remaining > 0:
+                chunk = source.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                target.write(chunk)
+                remaining -= len(chunk)
+        return filename
@@ -0,0 +1,220 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+# Pixels at or below this brightness are background
+BACKGROUND_LEVEL = 32
+
+# Frames with fewer text pixels than this are blank
+MIN_INK_PIXELS = 8
+
+# The median glyph height in pixels the image is scaled to for OCR
+TARGET_GLYPH_HEIGHT = 40
+
+# Glyph components smaller than this are dots, accents or noise
+MIN_GLYPH_HEIGHT = 4
+
+
+def ink_mask(image):
+    """
+    Finds the text pixels of a grayscale subtitle image.
+
+    :param image: A grayscale image with light text on a dark background
+    :return: A boolean mask of the text pixels, or None when the image is blank
+    """
+    peak = int(image.max()) if image.size else 0
+    if peak <= BACKGROUND_LEVEL:
+        return None
+    # threshold at half the peak so faded captions are measured the same way
+    mask = image > max(BACKGROUND_LEVEL, peak // 2)
+    if np.count_nonzero(mask) < MIN_INK_PIXELS:
+        return None
+    return mask
+
+
+def content_box(mask, padding=10):
+    """
+    Finds the bounding box of the text pixels.
+
+    :param mask: The text pixel mask
+    :param padding: The number of pixels to keep around the text
+    :return: A (top, bottom, left, right) tuple of slice bounds
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    height, width = mask.shape
+    return (
+        max(0, rows[0] - padding), min(height, rows[-1] + 1 + padding),
+        max(0, columns[0] - padding), min(width, columns[-1] + 1 + padding)
+    )
+
+
+def glyph_height(mask):
+    """
+    Measures the median height of the glyphs in a text mask.
+
+    :param mask: The text pixel mask
+    :return: The median glyph height in pixels, or None when no glyphs were found
+    """
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    heights = stats[1:count, cv2.CC_STAT_HEIGHT]
+    heights = heights[heights >= MIN_GLYPH_HEIGHT]
+    if not heights.size:
+        return None
+    return float(np.median(heights))
+
+
+def scale_factor(height, target=TARGET_GLYPH_HEIGHT, max_scale=4):
+    """
+    Chooses the scale factor that brings glyphs to the target height. The
+    factor is rounded to a quarter so that captions of the same size are
+    scaled alike, and never shrinks the image.
+
+    :param height: The measured glyph height, or None
+    :return: The scale factor
+    """
+    if not height:
+        return 2
+    return min(max_scale, max(1, round(target / height * 4) / 4))
+
+
+def prepare_image(image, padding=10, target_height=TARGET_GLYPH_HEIGHT):
+    """
+    Crops a subtitle image to its text, scales it to the target glyph height,
+    smooths it and inverts it to dark text on a light background.
+
+    :param image: A grayscale image with light text on a dark background
+    :param padding: The number of background pixels to keep around the text
+    :param target_height: The median glyph height to scale to
+    :return: The image ready for OCR, or None when the image is blank
+    """
+    mask = ink_mask(image)
+    if mask is None:
+        return None
+    top, bottom, left, right = content_box(mask, padding)
+    image = image[top:bottom, left:right]
+
+    scale = scale_factor(glyph_height(mask[top:bottom, left:right]), target=target_height)
+    if scale != 1:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+    # the 5x5 blur of a 2x upscale, in proportion to the scale
+    kernel = 2 * round(scale) + 1
+    image = cv2.GaussianBlur(image, (kernel, kernel), 0)
+    return cv2.bitwise_not(image)
+
+
+# Palette entries more transparent than this are background
+MIN_ALPHA = 128
+
+# Visible palette levels closer than this are all text fill, there is no outline
+MIN_OUTLINE_CONTRAST = 64
+
+# The luminance levels of a grayscale image used as its own palette
+GRAY_LEVELS = np.arange(256, dtype=np.uint8)
+
+
+def load_palette_image(filename):
+    """
+    Reads a subtitle PNG with its palette, without expanding it to color.
+    BDSup2Sub writes palette-indexed PNGs, other images are read as grayscale.
+
+    :param filename: The full path to the subtitle image
+    :return: A tuple of the palette index array, the luminance of each of the
+             256 palette entries and their alpha, or None for opaque entries
+    """
+    with Image.open(filename) as image:
+        if image.mode != 'P':
+            return np.asarray(image.convert('L')), GRAY_LEVELS, None
+        indexes = np.asarray(image)
+        colors = np.zeros((256, 3), dtype=np.uint32)
+        palette = np.frombuffer(bytes(image.getpalette()), dtype=np.uint8).reshape(-1, 3)[:256]
+        colors[:len(palette)] = palette
+        levels = ((colors @ np.array([299, 587, 114], dtype=np.uint32)) // 1000).astype(np.uint8)
+
+        alpha = None
+        transparency = image.info.get('transparency')
+        if isinstance(transparency, bytes):
+            alpha = np.full(256, 255, dtype=np.uint8)
+            alpha[:len(transparency)] = np.frombuffer(transparency, dtype=np.uint8)
+        elif isinstance(transparency, int):
+            alpha = np.full(256, 255, dtype=np.uint8)
+            alpha[transparency] = 0
+    return indexes, levels, alpha
+
+
+def load_palette_levels(filename):
+    """
+    Reads a subtitle PNG as the luminance of its palette entries, with the
+    transparent entries black, through a single lookup table pass instead
+    of a color copy. Used to compare images, e.g. when coalescing events.
+
+    :param filename: The full path to the subtitle image
+    :return: The grayscale image
+    """
+    indexes, levels, alpha = load_palette_image(filename)
+    if alpha is not None:
+        levels = levels * (alpha >= MIN_ALPHA)
+    return cv2.LUT(indexes, levels)
+
+
+def fill_lut(indexes, levels, alpha=None):
+    """
+    Classifies the palette entries of an image as text fill, outline or
+    background. Transparent and near black entries are background, and of
+    the visible entries the brighter half of the luminance range is the
+    fill, the darker half the outline around it.
+
+    A grayscale image has no palette, so the gray levels it uses stand in
+    for the palette entries, which costs a histogram of the image.
+
+    :param indexes: The palette index array
+    :param levels: The luminance of each of the 256 palette entries
+    :param alpha: The alpha of each palette entry, or None for opaque entries
+    :return: A 256 entry uint8 lookup table, 1 for the fill entries, or None when no entry is visible
+    """
+    visible = levels > BACKGROUND_LEVEL
+    if levels is GRAY_LEVELS:
+        visible &= cv2.calcHist([indexes], [0], None, [256], [0, 256]).ravel() > 0
+    if alpha is not None:
+        visible &= alpha >= MIN_ALPHA
+    if not visible.any():
+        return None
+    lowest, highest = int(levels[visible].min()), int(levels[visible].max())
+    if highest - lowest >= MIN_OUTLINE_CONTRAST:
+        visible &= levels >= (lowest + highest) // 2
+    return visible.astype(np.uint8)
+
+
+# Maps the fill mask to black text on white
+FILL_TO_IMAGE = np.array([255, 0] + [0] * 254, dtype=np.uint8)
+
+
+def prepare_palette_image(indexes, levels=GRAY_LEVELS, alpha=None, padding=10, target_height=TARGET_GLYPH_HEIGHT):
+    """
+    Binarizes a palette-indexed subtitle image with a single lookup table
+    pass, then crops it to its text and scales it to the target glyph height.
+    Unlike prepare_image() there is no blur and no intermediate gray or color
+    copy, the result is black text fill on white.
+
+    :param indexes: The palette index array, or a grayscale image with the default levels
+    :param levels: The luminance of each of the 256 palette entries
+    :param alpha: The alpha of each palette entry, or None for opaque entries
+    :param padding: The number of background pixels to keep around the text
+    :param target_height: The median glyph height to scale to
+    :return: The image ready for OCR, or None when the image is blank
+    """
+    lut = fill_lut(indexes, levels, alpha)
+    if lut is None:
+        return None
+    mask = cv2.LUT(indexes, lut)
+    if cv2.countNonZero(mask) < MIN_INK_PIXELS:
+        return None
+    top, bottom, left, right = content_box(mask, padding)
+    mask = mask[top:bottom, left:right]
+
+    image = cv2.LUT(mask, FILL_TO_IMAGE)
+    scale = scale_factor(glyph_height(mask), target=target_height)
+    if scale != 1:
+        # nearest neighbour scaling keeps the image binary
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+    return image
@@ -1,77 +1,386 @@
 import os
-import shutil
-import pytesseract
-import cv2
+import time
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
-from PIL import Image
-import numpy as np
 import xml.etree.ElementTree as ET
-from functions import convert_to_srt_time, print_progress_bar
+from functions import FILE_MODE, convert_to_srt_time, pts_to_srt_time, print_progress_bar
+from mkv import mkvDemuxer
+from ocr import ENGINES, OcrEnginePool, OcrPage, create_engine, ocr_language, ocr_languages, resolve_engine
+from cache import OcrCache
+from tracing import tracer
+from journal import OcrJournal
 from exceptions import MissingDependencyError, SubConverterError
 
+# OpenCV, NumPy and Pillow are imported by the steps that decode and
+# prepare images, so the runs that never get that far start without them.
+
+# The OCR engines, result cache and preprocessing mode of the current (worker) process
+ocr_engines = None
+ocr_cache = None
+preprocess_mode = 'gray'
+
+
+def init_ocr_worker(engine='pytesseract', omp_threads=None, cache_dir=None, cache_size=256, trace=False, languages=(),
+                    preprocess='gray'):
+    """
+    Initializes an OCR worker process.
+
+    :param engine: The name of the OCR engine, whose models are loaded per language on first use
+    :param omp_threads: The number of OpenMP threads each tesseract instance may use
+    :param cache_dir: The OCR result cache directory, None disables the cache
+    :param cache_size: The OCR result cache size limit in MB
+    :param trace: Record tracing spans of the OCR steps
+    :param languages: The traineddata names of the models to load up front
+    :param preprocess: The preprocessing mode, 'gray' or 'palette'
+    """
+    global ocr_engines, ocr_cache, preprocess_mode
+    tracer.enable(trace)
+    preprocess_mode = preprocess
+    # tesseract reads this when it is loaded or forked
+    if omp_threads:
+        os.environ['OMP_THREAD_LIMIT'] = str(omp_threads)
+    ocr_engines = OcrEnginePool(engine)
+    for language in languages:
+        ocr_engines.get(language)
+    if cache_dir:
+        ocr_cache = OcrCache(cache_dir, max_size=cache_size)
+
+
+def load_image(image):
+    """
+    Loads a subtitle image as grayscale.
+
+    :param image: The full path to the subtitle image, or a decoded grayscale image
+    :return: The grayscale image
+    """
+    if not isinstance(image, str):
+        return image
+    import cv2
+    subimg = cv2.imread(image)
+    return cv2.cvtColor(subimg, cv2.COLOR_BGR2GRAY)
+
+
+def load_palette_levels(image):
+    """
+    Loads a subtitle image as the luminance of its palette entries, without a color copy.
+
+    :param image: The full path to the subtitle image, or a decoded grayscale image
+    :return: The grayscale image
+    """
+    if not isinstance(image, str):
+        return image
+    from preprocess import load_palette_levels
+    return load_palette_levels(image)
+
+
+def preprocess_image(image):
+    """
+    Prepares a subtitle image for OCR: crops it to the text, scales it to
+    the target glyph height, and either smooths and inverts it, or in the
+    'palette' mode binarizes it by its palette entries.
+
+    :param image: The full path to the subtitle image, or a decoded grayscale image
+    :return: The preprocessed grayscale image, or None when the image is blank
+    """
+    from preprocess import load_palette_image, prepare_image, prepare_palette_image
+    if preprocess_mode == 'palette':
+        if isinstance(image, str):
+            return prepare_palette_image(*load_palette_image(image))
+        # the gray levels of a decoded image stand in for its palette entries
+        return prepare_palette_image(image)
+    return prepare_image(load_image(image))
+
+
+def ocr_batch(images, language='eng'):
+    """
+    Preprocesses subtitle images and OCR scans the ones that are not cached
+    together on a single page. Images whose lines can not be mapped back
+    from the page unambiguously are scanned on their own.
+
+    :param images: A list of subtitle image file paths or decoded images
+    :param language: The traineddata name of the subtitle language
+    :return: A list of (text, cached) tuples for each image, where the text is None for a blank image
+    """
+    if language not in ocr_engines.engines:
+        with tracer.span('load model', 'ocr', language=language):
+            ocr_engines.get(language)
+    ocr_engine = ocr_engines.get(language)
+    results = [(None, False)] * len(images)
+    pending = []
+    for index, image in enumerate(images):
+        with tracer.span('preprocess', 'ocr'):
+            subimg = preprocess_image(image)
+        if subimg is None:
+            continue
+        key = None
+        if ocr_cache:
+            key = OcrCache.key(subimg, ocr_engines.engine_id(ocr_engine), ocr_engine.config, ocr_engine.language)
+            subtext = ocr_cache.get(key)
+            if subtext is not None:
+                results[index] = (subtext, True)
+                continue
+        pending.append((index, subimg, key))
+
+    start = time.perf_counter()
+    texts = [None] * len(pending)
+    if len(pending) > 1:
+        page = OcrPage([subimg for _, subimg, _ in pending])
+        with tracer.span('recognize page', 'ocr', images=len(pending)):
+            texts = page.assign(ocr_engine.recognize_lines(page.image))
+
+    for (index, subimg, key), subtext in zip(pending, texts):
+        if subtext is None:
+            with tracer.span('recognize', 'ocr'):
+                subtext = ocr_engine.recognize(subimg)
+        if ocr_cache:
+            ocr_cache.put(key, subtext)
+        results[index] = (subtext, False)
+    ocr_engines.record(language, time.perf_counter() - start)
+    return results
+
+
+def ocr_task(images, language='eng'):
+    """
+    Runs ocr_batch in a worker process and hands the model load and
+    recognition times, and the tracing spans, back to the main process
+    with the results.
+
+    :return: A tuple of the ocr_batch results, a dict of the (load, recognize) seconds
+             by language and the drained spans, or None while tracing is off
+    """
+    results = ocr_batch(images, language)
+    return results, ocr_engines.drain_timings(), tracer.drain() if tracer.enabled else None
+
+
 class SubFileProcessor:
-    def __init__(self, queue, logger, working_dir, limit=None, progress=True, overwrite=False):
+    # The fewest events of a SUP file shard decoded by a worker process
+    MIN_SHARD_EVENTS = 50
+    # The most decoded events of each track of an MKV file waiting to be OCR scanned
+    TRACK_QUEUE_SIZE = 32
+
+    def __init__(self, logger, working_dir, queue=None, limit=None, progress=True, overwrite=False, jobs=1, omp_threads=1, engine='auto',
+                 cache_dir=None, cache_size=256, coalesce_threshold=2, batch_size=1, resume=True, language='eng',
+                 preprocess='gray'):
         self.logger = logger
         self.queue = queue
         self.working_dir = os.path.join(working_dir,'subtitles')
         self.limit = limit
         self.progress = progress
         self.overwrite = overwrite
+        self.jobs = jobs
+        self.omp_threads = omp_threads
+        self.engine = resolve_engine(engine)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.coalesce_threshold = coalesce_threshold
+        self.batch_size = max(1, batch_size)
+        self.resume = resume
+        self.preprocess = preprocess
+        # the OCR language of the inputs whose track language is not known, several languages are combined
+        self.language = ocr_languages(language) if isinstance(language, (list, tuple)) else ocr_language(language)
+        # the [load, recognize] seconds of the OCR models by language, across the workers
+        self.timings = {}
+        # the options the OCR results of a journal depend on
+        self.journal_key = f"{self.engine}:{self.coalesce_threshold}:{self.batch_size}:{self.preprocess}"
+        self.pool = None
+        self.lock = threading.Lock()
 
         # create the working directory
         if not os.path.isdir(self.working_dir):
             os.makedirs(self.working_dir)   
 
-        while not self.queue.empty():
-            job_item = self.queue.get()
-            output_filename = self.convert(job_item)
-            self.logger.info(f"Finished converting subtitles: '{job_item}'")
-            self.queue.task_done()
+        # Start the OCR worker pool, or load the engine in this process. The
+        # default language's model is loaded up front, the others on first use.
+        if self.jobs > 1:
+            # check the engine and model here, a worker that fails to load them would only break the pool
+            create_engine(self.engine, language=self.language).close()
+            self.logger.info(f"Starting {self.jobs} OCR worker processes using the '{self.engine}' engine.")
+            # the pipeline stages already run threads, which a forked worker could inherit in a locked state
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.jobs,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=init_ocr_worker,
+                initargs=(
+                    self.engine, self.omp_threads, self.cache_dir, self.cache_size, tracer.enabled, (self.language,), self.preprocess
+                )
+            )
+        else:
+            self.logger.info(f"Using the '{self.engine}' OCR engine.")
+            init_ocr_worker(
+                self.engine, omp_threads=self.omp_threads, cache_dir=self.cache_dir, cache_size=self.cache_size, trace=tracer.enabled,
+                languages=(self.language,), preprocess=self.preprocess
+            )
+        if self.cache_dir:
+            self.logger.info(f"Using the OCR cache in '{self.cache_dir}'")
+        if self.batch_size > 1:
+            self.logger.info(f"OCR scanning up to {self.batch_size} subtitle images per page.")
 
-    def convert(self, job_item):
+    def run(self):
+        """ Processes every job in the queue """
+        try:
+            while not self.queue.empty():
+                job_item = self.queue.get()
+                self.process(job_item)
+                self.queue.task_done()
+        finally:
+            self.close()
+
+    def process(self, job_item):
+        """
+        Converts a SUB/XML or SUP file, or the selected tracks of an MKV file, to SRT.
+
+        :param job_item: The QueueItem of the file to convert
+        :return: A list with the filenames of the created SRT files
+        """
+        if job_item.tracks:
+            out_files = self.convert_mkv(job_item)
+        else:
+            out_files = [self.convert(job_item)]
+        self.logger.info(f"Finished converting subtitles: '{job_item}'")
+        return [out_file for out_file in out_files if out_file]
+
+    def close(self):
+        """ Stops the OCR workers, trims the OCR cache and logs the OCR model times """
+        if self.pool:
+            self.pool.shutdown()
+        elif ocr_engines:
+            self.add_timings(ocr_engines.drain_timings())
+            ocr_engines.close()
+        if self.cache_dir:
+            self.evict_cache()
+        for language, (load, recognize) in sorted(self.timings.items()):
+            self.logger.info(f"OCR model '{language}': loaded in {load:.2f}s, recognized text for {recognize:.2f}s")
+
+    def add_timings(self, timings):
+        """ Adds the drained (load, recognize) seconds of a worker's OCR models """
+        with self.lock:
+            for language, (load, recognize) in timings.items():
+                total = self.timings.setdefault(language, [0.0, 0.0])
+                total[0] += load
+                total[1] += recognize
+
+    def engine_version(self):
+        """ The OCR engine's version, for the manifest """
+        try:
+            return f"{self.engine} {ENGINES[self.engine]['class'].version()}"
+        except Exception:
+            return f"{self.engine} unknown"
+
+    def evict_cache(self):
+        cache = OcrCache(self.cache_dir, max_size=self.cache_size)
+        evicted = cache.evict()
+        cache.close()
+        if evicted:
+            self.logger.info(f"Evicted {evicted} results from the OCR cache.")
+
+    def create_coalescer(self):
+        """
+        Creates the EventCoalescer of the preprocessing mode. The 'palette'
+        mode compares the images by their palette entries and hands on the
+        image filenames, so the OCR step reads the palette itself.
+
+        :return: An EventCoalescer
+        """
+        from timeline import EventCoalescer
+        if self.preprocess == 'palette':
+            return EventCoalescer(load_palette_levels, threshold=self.coalesce_threshold, keep_sources=True)
+        return EventCoalescer(load_image, threshold=self.coalesce_threshold)
+
+    def ocr_events(self, images, language=None):
+        """
+        OCR scans the subtitle images, in order.
+
+        Images are scanned in batches of the batch size. Batches are handed
+        to the worker pool when one is running, keeping a bounded number of
+        them in flight so results come back in order. The tracks of every
+        language share the workers, each of which keeps the model of a
+        language loaded once it was used.
+
+        :param images: An iterable of subtitle image file paths or decoded images
+        :param language: The traineddata name of the subtitle language, None for the default language
+        :return: A generator of (text, cached) tuples for each image
+        """
+        language = language or self.language
+        images = iter(images)
+        batches = iter(lambda: list(islice(images, self.batch_size)), [])
+        if not self.pool:
+            for batch in batches:
+                # the in-process engines are shared by the stage's threads
+                with self.lock:
+                    results = ocr_batch(batch, language)
+                yield from results
+            return
+
+        def results(future):
+            results, timings, spans = future.result()
+            self.add_timings(timings)
+            if spans:
+                tracer.merge(spans)
+            return results
+
+        pending = deque()
+        for batch in batches:
+            pending.append(self.pool.submit(ocr_task, batch, language))
+            if len(pending) >= self.jobs * 4:
+                yield from results(pending.popleft())
+        while pending:
+            yield from results(pending.popleft())
+
+    def read_xml(self, job_item):
+        """
+        Reads the subtitle events of a BDSup2Sub XML file.
+
+        The file is parsed incrementally and each event element is freed once
+        it was read, so the memory use does not grow with the number of events.
+
+        :return: A tuple of the SRT filename, a generator of (start_time, end_time, image_filename)
+                 tuples and the number of events, if the XML states it
+        """
         img_dir = os.path.dirname(job_item.input_file)
+        parser = ET.iterparse(job_item.input_file, events=('start', 'end'))
 
-        # Load and parse the XML file containing the subtitle data
-        tree = ET.parse(job_item.input_file)
-        root = tree.getroot()
+        # Read the description ahead of the events
+        root = None
+        metadata = None
+        for action, element in parser:
+            if action == 'start' and root is None:
+                root = element
+            elif action == 'end' and element.tag == 'Description':
+                metadata = element
+                break
+        if metadata is None or metadata.find('Format') is None:
+            raise SubConverterError(f"No subtitle description found in '{job_item.input_file}'")
 
         # Get the framerate and language
-        metadata = root.find('Description')
         frame_rate = metadata.find('Format').attrib['FrameRate']
         video_format = metadata.find('Format').attrib['VideoFormat']
         language = metadata.find('Language').attrib['Code']
+        total = metadata.find('Events').attrib.get('NumberofEvents') if metadata.find('Events') is not None else None
         self.logger.info(f"Format: '{video_format}' Subtitle Language: '{language}', Frame Rate: '{frame_rate}'")
 
         # Build the output file name
         out_file = os.path.join(job_item.output_path, os.path.basename(job_item.input_file.replace('xml', f'{language}.srt')))
 
-        # Verify that the final output file does not already exist
-        if os.path.exists(out_file) and not self.overwrite:
-            self.logger.error(f"SRT File: {out_file} exists and overwrite is False.")
-            return None
-
-        # Iterate over each subtitle entry
-        ittr_limit = self.limit
-        ittr = 0
-
-        # output_file = open(f'{out_tmp_file}', 'w')
-        output_file = NamedTemporaryFile(mode='w', prefix='subtitle', suffix='.srt', dir=self.working_dir, delete=False)
-
-        # Parse the XML SUB file contents
-        for subtitle in root.findall('Events'):
-            total_subtitles = len(subtitle) if not ittr_limit else ittr_limit
-            self.logger.info(f"OCR Scanning {total_subtitles} subtitles")
-
-            for event in subtitle.findall('Event'):
-                ittr += 1
-                # Show a progress bar
-                if self.progress:
-                    print_progress_bar(ittr, total_subtitles)
-
+        def events():
+            for action, event in parser:
+                if action != 'end' or event.tag != 'Event':
+                    continue
                 # Extract the timing information
                 start_time = event.attrib['InTC'].strip() if 'InTC' in event.attrib else None
                 end_time = event.attrib['OutTC'].strip() if 'OutTC' in event.attrib else None
-                image_file = event.find('Graphic').text
+                graphic = event.find('Graphic')
+                image_file = graphic.text if graphic is not None else None
+                # free the event, and drop it from the events element
+                event.clear()
+                container = root.find('Events')
+                if container is not None and len(container) and container[-1] is event:
+                    del container[-1]
 
                 if start_time:
                     start_time = convert_to_srt_time(start_time, frame_rate)
@@ -82,29 +391,292 @@ class SubFileProcessor:
                     self.logger.warning('No image file found: skipping.')
                     continue
 
-                # OCR scan each image file
                 filename = f"{os.path.join(img_dir, image_file)}"
                 if not os.path.exists(filename):
                     raise SubConverterError(f"SUB format images not found in {img_dir}")
-                
-                subimg = cv2.imread(filename)
-                subimg = cv2.cvtColor(subimg, cv2.COLOR_BGR2GRAY)
-                subimg = cv2.resize(subimg, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-                subimg = cv2.GaussianBlur(subimg, (5, 5), 0)
-                subimg = cv2.bitwise_not(subimg)
-                custom_config = r"--oem 3 --psm 6 -c tessedit_char_whitelist='abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789♪♩♫♬,.`~[](){}!@#$%^&*<>?+:-_/\ \n'"
-                subtext = pytesseract.image_to_string(subimg, config=custom_config).strip()
-
-                # Write the SRT subtitle line
-                output_file.write(f"{ittr}\n{start_time} --> {end_time}\n{subtext}\n\n")
-                
-                # Stop here if there is a limit set
-                if ittr_limit and ittr == ittr_limit:
-                    break
-
-        output_file.close()
-        # move the temporary outfile top the final outfile location
-        shutil.copyfile(output_file.name, out_file)
-        self.logger.info(f"SRT creation complete. {ittr} subtitles created.")
+                yield start_time, end_time, filename
+
+        return out_file, events(), int(total) if total and total.isdigit() else None
+
+    def read_sup(self, job_item):
+        """
+        Decodes the subtitle events of a SUP file with the native PGS decoder.
+
+        The file's display sets are indexed first, which gives the number of
+        events up front. With OCR worker processes, long files are split at
+        epoch starts into shards that the workers decode side by side.
+
+        The limit counts the subtitles left after coalescing, so with
+        coalescing the file is decoded lazily in one pass until the limit is
+        reached, else only the part of the file up to the last subtitle.
+
+        :return: A tuple of the SRT filename, a generator of (start_time, end_time, image)
+                 tuples and the number of events
+        """
+        self.logger.info(f"Decoding SUP File: '{os.path.basename(job_item.input_file)}'")
+
+        # Build the output file name
+        out_file = os.path.join(job_item.output_path, f"{os.path.splitext(os.path.basename(job_item.input_file))[0]}.srt")
+
+        from pgs import SupIndex, read_sup_events
+        index = SupIndex(job_item.input_file, cache_dir=self.cache_dir)
+        lazy = self.limit and self.coalesce_threshold is not None
+        end, end_pts = index.limit_end(self.limit) if self.limit and not lazy else (None, None)
+        shards = [(0, end, end_pts)]
+        if self.pool and not lazy and index.event_count >= self.MIN_SHARD_EVENTS * 2:
+            shards = index.shards(min(self.jobs * 2, index.event_count // self.MIN_SHARD_EVENTS), end)
+            self.logger.info(f"Decoding {index.event_count} subtitle events in {len(shards)} shards.")
+
+        def events():
+            if len(shards) == 1:
+                decoded = read_sup_events(job_item.input_file, *shards[0])
+            else:
+                decoded = self.decode_shards(job_item.input_file, shards)
+            for start_pts, end_pts, image in decoded:
+                yield pts_to_srt_time(start_pts), pts_to_srt_time(end_pts), image
+
+        return out_file, events(), index.event_count
+
+    def decode_shards(self, filename, shards):
+        """
+        Decodes the shards of a SUP file in the OCR worker processes,
+        keeping a few shards ahead of the one being OCR scanned.
+
+        :param filename: The SUP filename
+        :param shards: A list of (start, end, end_pts) tuples from SupIndex.shards()
+        :return: A generator of (start_pts, end_pts, image) tuples, in order
+        """
+        from pgs import decode_sup_range
+        pending = deque()
+        shards = iter(shards)
+        for shard in shards:
+            pending.append(self.pool.submit(decode_sup_range, filename, *shard))
+            if len(pending) >= self.jobs:
+                break
+        while pending:
+            yield from pending.popleft().result()
+            shard = next(shards, None)
+            if shard:
+                pending.append(self.pool.submit(decode_sup_range, filename, *shard))
+
+    def read_mkv(self, job_item):
+        """
+        Decodes the subtitle events of the selected PGS tracks of an MKV file
+        in a single pass, streaming the blocks through the native demuxer.
+
+        :return: A tuple of a dict of the SRT filenames by track number and a generator
+                 of (track_number, (start_time, end_time, image)) tuples
+        """
+        out_files = {}
+        for track in job_item.tracks:
+            if track.codec != 'S_HDMV/PGS':
+                self.logger.warning(f"Skipping track {track.id}: the native demuxer only decodes PGS subtitles.")
+                continue
+            out_file = os.path.join(job_item.output_path, f"{os.path.splitext(track.filename)[0]}.srt")
+            if os.path.exists(out_file) and not self.overwrite:
+                self.logger.error(f"SRT File: {out_file} exists and overwrite is False.")
+                continue
+            out_files[track.track_number] = out_file
+        self.logger.info(f"Demuxing {len(out_files)} track(s) from: '{os.path.basename(job_item.input_file)}'")
+
+        def events():
+            from pgs import PgsDecoder, split_block_segments
+            decoders = {track_number: PgsDecoder() for track_number in out_files}
+            with mkvDemuxer(job_item.input_file) as demuxer:
+                for track_number, pts, payload in demuxer.packets(out_files):
+                    for segment in split_block_segments(pts, payload):
+                        event = decoders[track_number].feed(*segment)
+                        if event:
+                            yield track_number, event
+            for track_number, decoder in decoders.items():
+                event = decoder.flush()
+                if event:
+                    yield track_number, event
+
+        return out_files, events()
+
+    def convert_mkv(self, job_item):
+        out_files, events = self.read_mkv(job_item)
+        if not out_files:
+            return []
+        languages = {track.track_number: ocr_language(track.language) for track in job_item.tracks}
+
+        if len(out_files) == 1:
+            # a single track is OCR scanned while it is being demuxed
+            ((track_number, out_file),) = out_files.items()
+            return [self.write_srt(out_file, (
+                (pts_to_srt_time(start_pts), pts_to_srt_time(end_pts), image)
+                for _, (start_pts, end_pts, image) in events
+            ), language=languages[track_number])]
+
+        # The tracks' blocks are interleaved, so the demuxer hands each track's events
+        # to the thread writing its SRT file through a bounded queue. A full queue
+        # blocks the demuxer until that track catches up, which bounds the memory.
+        # With OCR workers the tracks are scanned side by side, each with the model
+        # of its track's language, else the threads take turns on the engines.
+        queues = {track_number: Queue(maxsize=self.TRACK_QUEUE_SIZE) for track_number in out_files}
+
+        def write_track(track_number):
+            ended = []
+
+            def track_events():
+                yield from iter(queues[track_number].get, None)
+                ended.append(True)
+
+            try:
+                return self.write_srt(out_files[track_number], track_events(), language=languages[track_number], progress=False)
+            finally:
+                # a track that stopped early, at the limit or on an error, must not block the demuxer
+                if not ended:
+                    for _ in iter(queues[track_number].get, None):
+                        pass
+
+        with ThreadPoolExecutor(max_workers=len(out_files), thread_name_prefix='track') as executor:
+            futures = [executor.submit(write_track, track_number) for track_number in out_files]
+            try:
+                for track_number, (start_pts, end_pts, image) in events:
+                    queues[track_number].put((pts_to_srt_time(start_pts), pts_to_srt_time(end_pts), image))
+            finally:
+                for track_queue in queues.values():
+                    track_queue.put(None)
+            return [future.result() for future in futures]
+
+    def convert(self, job_item):
+        if job_item.input_file.lower().endswith('.sup'):
+            out_file, events, total = self.read_sup(job_item)
+        else:
+            out_file, events, total = self.read_xml(job_item)
+
+        # Verify that the final output file does not already exist
+        if os.path.exists(out_file) and not self.overwrite:
+            self.logger.error(f"SRT File: {out_file} exists and overwrite is False.")
+            return None
+        return self.write_srt(out_file, events, total, ocr_language(job_item.language))
+
+    def write_srt(self, out_file, events, total=None, language=None, progress=True):
+        """
+        OCR scans subtitle events and writes them to an SRT file.
+
+        The events are streamed: they are read, coalesced and scanned as the
+        SRT file is written, so only the events in flight are held in memory.
+        The SRT file is written to a temporary file in the destination
+        directory and renamed into place once it is complete.
+
+        :param out_file: The SRT filename
+        :param events: An iterable of (start_time, end_time, image) tuples
+        :param total: The number of events, if known, for the progress bar
+        :param language: The traineddata name of the subtitle language, None for the default language
+        :param progress: Show the progress bar, if the processor shows one
+        :return: The SRT filename
+        """
+        # Merge adjacent duplicate events so each one is only scanned once
+        coalescer = None
+        if self.coalesce_threshold is not None:
+            coalescer = self.create_coalescer()
+            events = coalescer.coalesce(events)
+
+        # Stop at the limit if one is set
+        events = islice(events, self.limit)
+        if self.limit:
+            total = min(total or self.limit, self.limit)
+        self.logger.info(f"OCR Scanning {total if total else 'the'} subtitles with the '{language or self.language}' model")
+
+        # Reuse the results journaled by an interrupted run for the same events
+        journal = OcrJournal(out_file, self.journal_key) if self.resume else None
+        journaled = {}
+        if journal:
+            journaled = journal.load()
+            if journaled:
+                self.logger.info(f"Resuming: {len(journaled)} subtitles were already scanned.")
+            journal.open(journaled)
+
+        # Queue each event's times and journaled text in order, handing only
+        # the images that still need scanning to the OCR workers
+        unscanned = object()
+        queued = deque()
+
+        def images():
+            for index, (start_time, end_time, image) in enumerate(events):
+                result = journaled.get(index)
+                if result and result[:2] == (start_time, end_time):
+                    queued.append((index, start_time, end_time, result[2]))
+                else:
+                    queued.append((index, start_time, end_time, unscanned))
+                    yield image
+
+        output_file = NamedTemporaryFile(
+            mode='w', prefix=f".{os.path.basename(out_file)}.", suffix='.tmp', dir=os.path.dirname(out_file) or '.', delete=False
+        )
+
+        # OCR scan each image and write the SRT subtitle lines in event order
+        ittr = 0
+        number = 0
+        blank = 0
+        resumed = 0
+        cache_hits = 0
+        misses = 0
+        start = time.monotonic()
+        results = self.ocr_events(images(), language)
+        try:
+            result = None
+            while True:
+                if queued and queued[0][3] is not unscanned:
+                    index, start_time, end_time, subtext = queued.popleft()
+                    resumed += 1
+                elif queued and result is not None:
+                    # the result belongs to the first unscanned event in the queue
+                    index, start_time, end_time, _ = queued.popleft()
+                    (subtext, cached), result = result, None
+                    cache_hits += cached
+                    misses += not cached and subtext is not None
+                    if journal:
+                        journal.append(index, start_time, end_time, subtext)
+                else:
+                    # fetching the next result queues the events up to its image
+                    result = next(results, None)
+                    # the last events may have been queued from the journal
+                    if result is None and not (queued and queued[0][3] is not unscanned):
+                        break
+                    continue
+
+                ittr += 1
+                # Show a progress bar
+                if self.progress and progress:
+                    print_progress_bar(ittr, max(total or ittr, ittr))
+
+                # blank frames were not scanned and have no subtitle
+                if subtext is None:
+                    blank += 1
+                    continue
+                number += 1
+                output_file.write(f"{number}\n{start_time} --> {end_time}\n{subtext}\n\n")
+            output_file.close()
+        except BaseException:
+            output_file.close()
+            os.remove(output_file.name)
+            if journal:
+                journal.close()
+            raise
+        elapsed = time.monotonic() - start
+
+        # move the complete file into place in a single rename, readable like a file open() created
+        os.chmod(output_file.name, FILE_MODE)
+        os.replace(output_file.name, out_file)
+        if journal:
+            journal.remove()
+        if coalescer:
+            self.logger.info(f"Coalesced {coalescer.collapsed} duplicate subtitle events.")
+        self.logger.info(f"SRT creation complete. {number} subtitles created.")
+        if resumed:
+            self.logger.info(f"Resumed {resumed} subtitles from the journal.")
+        if blank:
+            self.logger.info(f"Skipped {blank} blank subtitle images.")
+        # the rate only counts the events scanned by this run, not the ones resumed from the journal
+        scanned = ittr - resumed
+        if scanned:
+            rate = f"{scanned / elapsed:.2f} events/sec" if elapsed > 0 else "too fast to rate"
+            self.logger.info(f"OCR scanned {scanned} subtitles in {elapsed:.1f}s ({rate}, jobs: {self.jobs})")
+            if self.cache_dir:
+                self.logger.info(f"OCR cache: {cache_hits} hits, {misses} misses ({cache_hits / max(cache_hits + misses, 1):.0%} hit rate)")
         self.logger.info(f"Saved File: {out_file}")
         return out_file
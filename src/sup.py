@@ -1,4 +1,8 @@
 import os
+import json
+import time
+import hashlib
+import threading
 from tempfile import TemporaryDirectory
 from functions import find_binary_in_path
 from command import RunCommand
@@ -6,60 +10,195 @@ from job_queue import QueueItem
 from exceptions import MissingDependencyError, SupConverterError
 
 class supFileConverter:
-    def __init__(self, queue, next_queue, bdsup2sub_jar, working_dir, logger):
+    CREDITS = [
+        " * URL: https://github.com/mjuhasz/BDSup2Sub",
+        " * Documentation: https://github.com/mjuhasz/BDSup2Sub/wiki"
+    ]
+    # The cached BDSup2Sub version strings by jar and java fingerprint
+    VERSION_CACHE = 'bdsup2sub_versions.json'
+    # Lets JVMs older than 13 start with the class data sharing options they do not know
+    JVM_OPTIONS = ['-XX:+IgnoreUnrecognizedVMOptions']
+
+    def __init__(self, bdsup2sub_jar, working_dir, logger, queue=None, next_queue=None, cache_dir=None, class_data_sharing=True,
+                 limit=None):
+        """
+        :param bdsup2sub_jar: The path to the BDSup2Sub.jar file
+        :param working_dir: The working directory of the converted files
+        :param logger: The logger
+        :param cache_dir: The directory of the cached version probe and the class data sharing archive, or None
+        :param class_data_sharing: Create an AppCDS archive of the BDSup2Sub classes on the first
+                                   conversion and start the later JVMs from it
+        :param limit: Only convert the display sets of this many subtitles
+        """
         self.logger = logger
         self.queue = queue
         self.next_queue = next_queue
         self.bdsup2sub_jar = bdsup2sub_jar
         self.working_dir = f"{os.path.join(working_dir, 'subtitles')}"
+        self.cache_dir = cache_dir
+        self.limit = limit
         self.java_bin = find_binary_in_path('java')
-        self.cmd = RunCommand()
-        self.credits = [
-            " * URL: https://github.com/mjuhasz/BDSup2Sub",
-            " * Documentation: https://github.com/mjuhasz/BDSup2Sub/wiki"
-        ]
+        self.cmd = RunCommand(logger=self.logger)
+        self.lock = threading.Lock()
+        self.__version = None
+        self.__archiving = False
         if 'JAVA_HOME' in os.environ:
                 self.java_bin = f"{os.environ['JAVA_HOME']}/bin/java"
 
-        if not os.path.exists(self.java_bin):
-            raise MissingDependencyError("Java JRE not found.")   
+        if not self.java_bin or not os.path.exists(self.java_bin):
+            raise MissingDependencyError("Java JRE not found.")
         self.logger.debug(f"Using java binary: '{self.java_bin}'")
 
         # create the working directory
         if not os.path.isdir(self.working_dir):
             os.makedirs(self.working_dir)
 
-        # Append command version string to the credits
+        # The jar and java binary the cached version and archive belong to
+        self.fingerprint = self.__fingerprint__()
+        self.cds_archive = None
+        if cache_dir and class_data_sharing:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cds_archive = os.path.join(cache_dir, f"bdsup2sub-{self.fingerprint[:16]}.jsa")
+
+    @property
+    def credits(self):
+        return [self.version(), *self.CREDITS]
+
+    def __fingerprint__(self):
+        digest = hashlib.sha256()
+        for filename in [self.bdsup2sub_jar, self.java_bin]:
+            filename = os.path.realpath(filename)
+            stat = os.stat(filename) if os.path.exists(filename) else None
+            digest.update(f"{filename}\0{stat and stat.st_size}\0{stat and stat.st_mtime_ns}\0".encode())
+        return digest.hexdigest()
+
+    def version(self):
+        """
+        The BDSup2Sub version string. Probing it starts a JVM, so it is only
+        done when the version is first needed, and is cached in the cache
+        directory until the jar or the java binary changes.
+
+        :return: The version string
+        """
+        with self.lock:
+            if self.__version is None:
+                self.__version = self.__cached_version__()
+            return self.__version
+
+    def __cached_version__(self):
+        filename = os.path.join(self.cache_dir, self.VERSION_CACHE) if self.cache_dir else None
+        versions = {}
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename) as stream:
+                    versions = json.load(stream)
+            except ValueError:
+                versions = {}
+        if self.fingerprint in versions:
+            return versions[self.fingerprint]
+
         cmdline = [f"{self.java_bin}", "-jar", f"{self.bdsup2sub_jar}", "--version"]
-        self.credits.insert(
-            0, self.cmd.run_command_return_output(command=cmdline)[1].strip()
-        )
+        version = self.cmd.run_command_return_output(command=cmdline)[1].strip()
+        if filename and version:
+            versions[self.fingerprint] = version
+            with open(f"{filename}.{os.getpid()}", 'w') as stream:
+                json.dump(versions, stream, indent=1)
+            os.replace(f"{filename}.{os.getpid()}", filename)
+        return version
 
+    def __class_data_options__(self):
+        """
+        The JVM options of the class data sharing archive. The first JVM dumps
+        the classes it loaded into the archive when it exits, and the later
+        JVMs map the archive instead of loading and verifying those classes
+        from the jar again.
+
+        :return: A tuple of the JVM options and the archive being created, if any
+        """
+        if not self.cds_archive:
+            return [], None
+        if os.path.exists(self.cds_archive):
+            return [f"-XX:SharedArchiveFile={self.cds_archive}", "-Xshare:auto"], None
+        with self.lock:
+            if self.__archiving:
+                return [], None
+            self.__archiving = True
+        archive = f"{self.cds_archive}.{os.getpid()}.tmp"
+        return [f"-XX:ArchiveClassesAtExit={archive}"], archive
+
+    def run(self):
+        """ Processes every job in the queue, putting the converted files on the next queue """
         while not self.queue.empty():
             job_item = self.queue.get()
-            output_filename = self.convert(job_item)
-            self.logger.info(f"Finished converting track: '{job_item}'")
-            self.next_queue.put(QueueItem(input_file=output_filename, output_path=job_item.output_path))
+            for next_item in self.process(job_item):
+                self.next_queue.put(next_item)
             self.queue.task_done()
 
+    def process(self, job_item):
+        """
+        Converts a SUP file to SUB/XML.
+
+        :param job_item: The QueueItem of a SUP file
+        :return: A list with the QueueItem of the converted XML file
+        """
+        output_filename = self.convert(job_item)
+        self.logger.info(f"Finished converting track: '{job_item}'")
+        return [QueueItem(
+            input_file=output_filename, output_path=job_item.output_path, source_file=job_item.source_file, language=job_item.language
+        )]
 
     def convert(self, job_item):
         working_dir = TemporaryDirectory(dir=self.working_dir, delete=False).name
         output_filename = f"{os.path.join(working_dir, os.path.basename(job_item.input_file.replace('sup', 'xml')))}"
-                
+
         self.logger.info(f"Converting {job_item.input_file} to SUB/XML format")
-        self.credits.append(f" - Converting SUP File: '{os.path.basename(job_item.input_file)}'")
-        self.cmd.run_command_with_scroll_window(
-            command = [
-                self.java_bin, "-jar", f"{self.bdsup2sub_jar}",
-                "-o", output_filename,
-                job_item.input_file
-            ],
-            header=self.credits,
-            height=None
-        )
+        input_file = job_item.input_file
+        if self.limit:
+            # BDSup2Sub converts the whole file, so only hand it the display sets within the limit
+            from pgs import SupIndex
+            index = SupIndex(input_file, cache_dir=self.cache_dir)
+            end, _ = index.limit_end(self.limit)
+            if end is not None:
+                input_file = index.write_range(end, os.path.join(working_dir, os.path.basename(input_file)))
+                self.logger.info(f"Converting the first {end / 1024:.0f} KB of display sets for the limit of {self.limit} subtitles.")
+        header = self.credits + [f" - Converting SUP File: '{os.path.basename(job_item.input_file)}'"]
+        class_data_options, archive = self.__class_data_options__()
+        start = time.monotonic()
+        converted = False
+        try:
+            startup = self.cmd.run_command_with_scroll_window(
+                command = [
+                    self.java_bin, *self.JVM_OPTIONS, *class_data_options, "-jar", f"{self.bdsup2sub_jar}",
+                    "-o", output_filename,
+                    input_file
+                ],
+                header=header,
+                height=None
+            )
+            converted = True
+        finally:
+            if archive:
+                self.__finish_archive__(archive, converted)
+        elapsed = time.monotonic() - start
         if not os.path.exists(output_filename):
             self.logger.error(f"File Not Found: '{output_filename}'")
             raise SupConverterError(f"Failed to convert SUP: '{job_item.input_file}' to SUB")
 
+        cds = 'created' if archive else 'used' if class_data_options else 'off'
+        self.logger.info(
+            f"BDSup2Sub converted '{os.path.basename(job_item.input_file)}' in {elapsed:.1f}s"
+            + (f", JVM startup: {startup * 1000:.0f}ms" if startup is not None else "")
+            + f", class data sharing: {cds}"
+        )
         return output_filename
+
+    def __finish_archive__(self, archive, converted):
+        # Another process may have created the archive in the meantime, either one will do
+        if os.path.exists(archive):
+            os.replace(archive, self.cds_archive)
+            self.logger.debug(f"Created the class data sharing archive: '{self.cds_archive}'")
+        elif converted:
+            self.logger.debug("The JVM did not create a class data sharing archive, it needs Java 13 or newer.")
+            self.cds_archive = None
+        with self.lock:
+            self.__archiving = False
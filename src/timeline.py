@@ -0,0 +1,97 @@
+import hashlib
+import cv2
+import numpy as np
+
+
+def ink_hash(image, scale=4):
+    """
+    Computes a perceptual hash of the text pixels in an image.
+
+    The image is thresholded at half of its peak brightness, so palette
+    fades keep the same hash, then shrunk by the scale factor. Subtitle
+    images are wide strips of text, so the hash keeps enough resolution
+    to tell two lines that differ by a single character apart.
+
+    :param image: A grayscale image
+    :return: The hash as a 2-dimensional boolean array
+    """
+    height, width = image.shape[:2]
+    mask = (image > int(image.max()) // 2).astype(np.float32)
+    small = cv2.resize(mask, (max(1, width // scale), max(1, height // scale)), interpolation=cv2.INTER_AREA)
+    return small > 0.25
+
+
+class EventCoalescer:
+    """
+    Merges runs of adjacent, duplicate subtitle events.
+
+    PGS streams re-send a composition for epoch refreshes, palette-only
+    updates (fades) and window moves, which decode into back-to-back events
+    with the same text. Events are merged when one starts exactly where the
+    previous one ended and their bitmaps are identical, or their perceptual
+    hashes differ in no more than the threshold percent of text pixels.
+    The merged event spans the whole run and keeps its most opaque image.
+    """
+    def __init__(self, load_image, threshold=2, size_tolerance=2, keep_sources=False):
+        """
+        :param load_image: A function that loads an event image as a grayscale array
+        :param threshold: The maximum percent of differing perceptual hash bits, 0 only merges exact matches
+        :param size_tolerance: The maximum difference in image width or height in pixels
+        :param keep_sources: Hand on the event images as they were given, e.g. filenames, instead of
+                             the loaded arrays, for a later step that reads more than the gray levels
+        """
+        self.load_image = load_image
+        self.threshold = threshold
+        self.size_tolerance = size_tolerance
+        self.keep_sources = keep_sources
+        self.collapsed = 0
+
+    def fingerprint(self, image):
+        digest = hashlib.sha1(image.tobytes()).digest()
+        return image.shape, digest, ink_hash(image) if self.threshold else None
+
+    def matches(self, a, b):
+        (shape_a, digest_a, hash_a), (shape_b, digest_b, hash_b) = a, b
+        if shape_a == shape_b and digest_a == digest_b:
+            return True
+        if not self.threshold:
+            return False
+        if any(abs(x - y) > self.size_tolerance for x, y in zip(shape_a, shape_b)):
+            return False
+        # compare the overlapping part of the hashes
+        rows, columns = min(hash_a.shape[0], hash_b.shape[0]), min(hash_a.shape[1], hash_b.shape[1])
+        hash_a, hash_b = hash_a[:rows, :columns], hash_b[:rows, :columns]
+        ink = max(np.count_nonzero(hash_a), np.count_nonzero(hash_b), 1)
+        return np.count_nonzero(hash_a != hash_b) * 100 <= self.threshold * ink
+
+    def coalesce(self, events):
+        """
+        Coalesces a stream of subtitle events.
+
+        :param events: An iterable of (start_time, end_time, image) tuples
+        :return: A generator of the coalesced (start_time, end_time, image) tuples, where each
+                 image is a loaded grayscale array, or the image as given with keep_sources
+        """
+        run = None
+        for start_time, end_time, source in events:
+            loaded = self.load_image(source)
+            fingerprint = self.fingerprint(loaded)
+            weight = int(loaded.sum())
+            image = source if self.keep_sources else loaded
+            if run and start_time == run['end_time'] and self.matches(run['fingerprint'], fingerprint):
+                self.collapsed += 1
+                run['end_time'] = end_time
+                run['fingerprint'] = fingerprint
+                if weight > run['weight']:
+                    run['image'], run['weight'] = image, weight
+                continue
+
+            if run:
+                yield run['start_time'], run['end_time'], run['image']
+            run = {
+                'start_time': start_time, 'end_time': end_time, 'image': image,
+                'weight': weight, 'fingerprint': fingerprint
+            }
+
+        if run:
+            yield run['start_time'], run['end_time'], run['image']
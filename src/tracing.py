@@ -0,0 +1,215 @@
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+
+
+class Span:
+    """ Times a block of code and records it with the tracer when the block ends """
+    __slots__ = ('tracer', 'name', 'category', 'args', 'start')
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.category, self.start, time.monotonic_ns() - self.start, self.args)
+        return False
+
+
+class NullSpan:
+    """ The span handed out while tracing is off, which does nothing """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class SpanStats:
+    """
+    The aggregate durations of the spans of one name: the count, total and
+    maximum, and a histogram of logarithmic buckets for the percentiles.
+
+    Each bucket is BUCKET_RATIO wide, so a percentile is within 2% of the
+    exact value however many spans there are.
+    """
+    __slots__ = ('count', 'total', 'maximum', 'buckets')
+
+    BUCKET_RATIO = 1.02
+    LOG_RATIO = math.log(BUCKET_RATIO)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.buckets = {}
+
+    def add(self, duration):
+        """ Adds a span duration in nanoseconds """
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        bucket = int(math.log(duration) / self.LOG_RATIO) if duration > 0 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """ Adds the durations of another SpanStats of the same span name """
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def percentile(self, percent):
+        """ The nearest-rank percentile in nanoseconds, as the upper bound of its bucket """
+        rank = max(1, math.ceil(percent / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.maximum, self.BUCKET_RATIO ** (bucket + 1))
+        return self.maximum
+
+
+class Tracer:
+    """
+    Records timed spans of the conversion stages, external commands and
+    OCR steps.
+
+    A span is a (name, category, start, duration, pid, tid, args) tuple with
+    the times in nanoseconds of the monotonic clock, which is shared by every
+    process of the machine, so the spans of the OCR worker processes can be
+    merged into the trace of the main process. While tracing is off a span
+    costs a single attribute check.
+
+    Only the last MAX_SPANS spans are kept for the trace file, so a long
+    watch or job queue run does not grow without bound, while the summary
+    is kept in the SpanStats of every span.
+    """
+    MAX_SPANS = 200000
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = deque(maxlen=self.MAX_SPANS)
+        self.stats = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def enable(self, enabled=True):
+        # a forked worker process starts with an empty trace, not a copy of its parent's
+        if self.pid != os.getpid():
+            self.spans = deque(maxlen=self.MAX_SPANS)
+            self.stats = {}
+            self.threads = {}
+            self.lock = threading.Lock()
+            self.pid = os.getpid()
+        self.enabled = enabled
+
+    def span(self, name, category='app', **args):
+        """
+        Creates a span to time a block of code with.
+
+        :param name: The span name the summary groups the spans by
+        :param category: The span category, e.g. 'stage', 'command' or 'ocr'
+        :param args: Extra values shown with the span in the trace viewer
+        :return: A context manager
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, name, category, start, duration, args=None):
+        thread = threading.current_thread()
+        tid = threading.get_native_id()
+        key = (os.getpid(), tid)
+        if key not in self.threads:
+            self.threads[key] = thread.name
+        with self.lock:
+            self.spans.append((name, category, start, duration, os.getpid(), tid, args))
+            self.stats.setdefault(f"{category}:{name}", SpanStats()).add(duration)
+
+    def drain(self):
+        """
+        Takes the recorded spans and their stats, e.g. to send them from a
+        worker process to the main process.
+
+        :return: A tuple of the spans, the thread names and the SpanStats by span name
+        """
+        with self.lock:
+            spans, self.spans = list(self.spans), deque(maxlen=self.MAX_SPANS)
+            stats, self.stats = self.stats, {}
+        return spans, dict(self.threads), stats
+
+    def merge(self, drained):
+        """ Adds the spans taken from another tracer with drain() """
+        spans, threads, stats = drained
+        with self.lock:
+            self.spans.extend(spans)
+            for name, span_stats in stats.items():
+                self.stats.setdefault(name, SpanStats()).merge(span_stats)
+        self.threads.update(threads)
+
+    def write_chrome_trace(self, filename):
+        """
+        Writes the spans in the Chrome trace event format, which can be
+        opened with chrome://tracing or https://ui.perfetto.dev.
+
+        :param filename: The JSON filename
+        """
+        with self.lock:
+            spans = list(self.spans)
+        origin = min((span[2] for span in spans), default=0)
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for (pid, tid), name in self.threads.items()
+        ]
+        for name, category, start, duration, pid, tid, args in spans:
+            event = {
+                'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': (start - origin) / 1000, 'dur': duration / 1000
+            }
+            if args:
+                event['args'] = {key: str(value) for key, value in args.items()}
+            events.append(event)
+        with open(filename, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+    def summary(self):
+        """
+        Summarizes the span durations by span name.
+
+        :return: A list of (name, count, total, p50, p95, max) tuples with the
+                 times in milliseconds, ordered by the total time
+        """
+        with self.lock:
+            stats = list(self.stats.items())
+        rows = [
+            (name, span_stats.count, span_stats.total / 1e6, span_stats.percentile(50) / 1e6,
+             span_stats.percentile(95) / 1e6, span_stats.maximum / 1e6)
+            for name, span_stats in stats
+        ]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def log_summary(self, logger):
+        logger.info(f"{'span':<32} {'count':>7} {'total ms':>11} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for name, count, total, p50, p95, maximum in self.summary():
+            logger.info(f"{name:<32} {count:>7} {total:>11.1f} {p50:>9.2f} {p95:>9.2f} {maximum:>9.2f}")
+
+
+# The tracer of the current process
+tracer = Tracer()
@@ -0,0 +1,198 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from functions import find_files
+
+# The inotify flags and event masks of <sys/inotify.h>
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# wd, mask, cookie and name length of each event, followed by the padded name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    A minimal inotify binding through ctypes, reporting the files created,
+    written and moved into a directory tree.
+
+    Raises OSError where inotify is not available, e.g. outside of Linux or
+    when the watch limit is reached.
+    """
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # the watched directories by watch descriptor
+        self.directories = {}
+
+    def add_watch(self, directory):
+        """ Watches a directory and the directories below it """
+        for root, dirs, _ in os.walk(directory):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Can not watch '{root}': {os.strerror(ctypes.get_errno())}")
+            self.directories[wd] = root
+
+    def read(self, timeout):
+        """
+        Waits for events.
+
+        :param timeout: The maximum number of seconds to wait
+        :return: A list of (path, mask) tuples, with a None path when events were dropped
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self.directories and name:
+                events.append((os.path.join(self.directories[wd], os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """
+    Watches a directory tree for new files and reports each one once it is
+    fully written.
+
+    Files are copied into a share over seconds to minutes, so a file is only
+    reported once its size and modification time have not changed for the
+    settle time. inotify wakes the watcher when a file is created, written
+    or moved in. Where inotify is not available, or does not see the writes
+    of other hosts as on network shares, the tree is rescanned every poll
+    interval instead.
+
+    The files already in the tree are reported when the watch starts.
+    """
+    def __init__(self, directory, extension, logger, settle=10, poll_interval=5, polling=False):
+        """
+        :param directory: The directory to watch
+        :param extension: The extension of the files to report, e.g. 'mkv'
+        :param logger: The logger
+        :param settle: The number of seconds a file must be unchanged before it is reported
+        :param poll_interval: The number of seconds between rescans when polling
+        :param polling: Always rescan the tree, instead of using inotify
+        """
+        self.directory = directory
+        self.extension = extension
+        self.logger = logger
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.polling = polling
+        self.stopped = threading.Event()
+        # the files being written, with their last (size, mtime) and since when it is unchanged
+        self.candidates = {}
+        # the (size, mtime) of each file when it was reported
+        self.reported = {}
+
+    def stop(self):
+        """ Ends the watch, from another thread or a signal handler """
+        self.stopped.set()
+
+    def matches(self, path):
+        name = os.path.basename(path)
+        # skip the hidden partial files that copy tools rename into place
+        return not name.startswith('.') and name.lower().endswith(f".{self.extension}")
+
+    def watch(self):
+        """
+        Watches the directory until the watch is stopped.
+
+        :return: A generator of the paths of the new and changed files, once they are fully written
+        """
+        inotify = None
+        if not self.polling:
+            try:
+                inotify = Inotify()
+                inotify.add_watch(self.directory)
+                self.logger.info(f"Watching '{self.directory}' for new {self.extension.upper()} files with inotify")
+            except OSError as e:
+                if inotify:
+                    inotify.close()
+                inotify = None
+                self.logger.warning(f"Falling back to polling, inotify is not usable: {e}")
+        if not inotify:
+            self.logger.info(f"Watching '{self.directory}' for new {self.extension.upper()} files every {self.poll_interval}s")
+
+        try:
+            self.rescan()
+            last_scan = time.monotonic()
+            while not self.stopped.is_set():
+                yield from self.settled()
+                # wake up at least every second, to check the candidates and whether the watch was stopped
+                if inotify:
+                    for path, mask in inotify.read(1.0):
+                        if path is None:
+                            self.rescan()
+                        elif mask & IN_ISDIR:
+                            # files may have landed in a new directory before it was watched
+                            inotify.add_watch(path)
+                            self.rescan(path)
+                        elif self.matches(path):
+                            self.candidates[path] = None
+                else:
+                    self.stopped.wait(1.0)
+                    if time.monotonic() - last_scan >= self.poll_interval:
+                        self.rescan()
+                        last_scan = time.monotonic()
+        finally:
+            if inotify:
+                inotify.close()
+
+    def rescan(self, directory=None):
+        """ Adds the files that are new or changed since they were reported to the candidates """
+        for path in find_files(directory or self.directory, self.extension):
+            if path not in self.candidates and self.matches(path) and self.reported.get(path) != signature(path):
+                self.candidates[path] = None
+
+    def settled(self):
+        """ Reports the candidates that have not changed for the settle time """
+        now = time.monotonic()
+        for path, state in list(self.candidates.items()):
+            current = signature(path)
+            if current is None:
+                del self.candidates[path]
+            elif state is None or state[0] != current:
+                self.candidates[path] = (current, now)
+            elif now - state[1] >= self.settle and current[0] > 0:
+                del self.candidates[path]
+                self.reported[path] = current
+                yield path
+
+
+def signature(path):
+    """ The size and modification time of a file, or None when it does not exist """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
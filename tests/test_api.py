@@ -0,0 +1,121 @@
+"""
+Tests of the in-memory Converter API.
+
+Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import api  # noqa: E402
+
+TRACKS = (2, 3)
+EVENTS_PER_TRACK = 200
+
+
+class FakeDemuxer:
+    """ Interleaves one block per event of each PGS track, logging every block it hands out """
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def tracks(self):
+        return [
+            {'properties': {'codec_id': 'S_HDMV/PGS', 'number': number, 'language': 'eng'}} for number in TRACKS
+        ]
+
+    def packets(self, selected):
+        for index in range(EVENTS_PER_TRACK):
+            for track_number in selected:
+                self.log.append(('demux', track_number))
+                yield track_number, index * 90000, b''
+        self.log.append(('demux end', None))
+
+
+class FakeDecoder:
+    """ Decodes each block into an event """
+    def __init__(self):
+        self.count = 0
+
+    def feed(self, pts):
+        self.count += 1
+        return pts, pts + 45000, f"image {self.count}"
+
+    def flush(self):
+        return None
+
+
+class FakeProcessor:
+    """ OCR scans images into their names, logging every image it scans """
+    TRACK_QUEUE_SIZE = 8
+
+    def __init__(self, log, **kwargs):
+        self.log = log
+
+    def ocr_events(self, images, language=None):
+        for image in images:
+            self.log.append(('ocr', image))
+            yield image, False
+
+    def close(self):
+        pass
+
+
+class ConverterTest(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        lock = threading.Lock()
+        log = self.log
+
+        class LockedLog:
+            def append(self, entry):
+                with lock:
+                    log.append(entry)
+
+        self.patches = [
+            mock.patch.object(api, 'mkvDemuxer', lambda source: FakeDemuxer(LockedLog())),
+            mock.patch.object(api, 'PgsDecoder', FakeDecoder),
+            mock.patch.object(api, 'split_block_segments', lambda pts, payload: [(pts,)]),
+            mock.patch.object(api, 'SubFileProcessor', lambda **kwargs: FakeProcessor(LockedLog(), **kwargs)),
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.converter = api.Converter(coalesce_threshold=None)
+
+    def tearDown(self):
+        self.converter.close()
+        for patch in reversed(self.patches):
+            patch.stop()
+
+    def test_convert_mkv_scans_while_demuxing(self):
+        cues = self.converter.convert_mkv('movie.mkv')
+
+        self.assertEqual(sorted(cues), list(TRACKS))
+        for track_number in TRACKS:
+            self.assertEqual(len(cues[track_number]), EVENTS_PER_TRACK)
+            self.assertEqual(cues[track_number][0].text, 'image 1')
+            self.assertEqual(cues[track_number][-1].end, (EVENTS_PER_TRACK - 1) * 1000 + 500)
+
+        demux_end = self.log.index(('demux end', None))
+        first_ocr = next(index for index, (step, _) in enumerate(self.log) if step == 'ocr')
+        self.assertLess(first_ocr, demux_end, "OCR only started once the demuxer was done")
+
+        # the events demuxed ahead of the OCR stay within the tracks' queues
+        ahead = most_ahead = 0
+        for step, _ in self.log:
+            ahead += {'demux': 1, 'ocr': -1}.get(step, 0)
+            most_ahead = max(most_ahead, ahead)
+        self.assertLessEqual(most_ahead, len(TRACKS) * (FakeProcessor.TRACK_QUEUE_SIZE + 2))
+
+
+if __name__ == '__main__':
+    unittest.main()